@@ -0,0 +1,56 @@
+{% macro ensure_indexes() %}
+    {#- Post-hook for every mart (see dbt_project.yml). dbt only creates a
+        model's configured indexes when it builds the table from scratch, so
+        an index added to an incremental model would otherwise need a
+        --full-refresh. This creates the configured indexes the table is
+        missing and drops the ones dbt created that are no longer configured.
+        dbt names indexes with a timestamped hash, so they are matched on
+        their definition. -#}
+    {%- if execute and config.get('materialized') in ('table', 'incremental') -%}
+        {%- set configured = {} -%}
+        {%- for index in config.get('indexes', []) -%}
+            {%- set definition = (('unique ' if index.get('unique') else '')
+                ~ (index.get('type') or 'btree') ~ ' (' ~ index['columns'] | join(', ') ~ ')') | lower -%}
+            {%- do configured.update({definition: index}) -%}
+        {%- endfor -%}
+        {%- set existing = run_query(index_definitions_sql(this)) -%}
+        {%- set existing_definitions = existing.columns['definition'].values() -%}
+        {%- for definition, index in configured.items() if definition not in existing_definitions %}
+            {{ get_create_index_sql(this, index) }};
+        {%- endfor -%}
+        {%- for row in existing.rows if row['dbt_named'] and row['definition'] not in configured %}
+            drop index if exists {{ this.schema }}."{{ row['index_name'] }}";
+        {%- endfor -%}
+    {%- endif -%}
+{% endmacro %}
+
+{% macro index_definitions_sql(relation) %}
+    {#- Each index of relation as "[unique ]<method> (<columns>)", lower-cased
+        ("total DESC"), the form ensure_indexes builds from the config. -#}
+    select
+        c.relname as index_name,
+        lower(case when ix.indisunique then 'unique ' else '' end
+            || replace(regexp_replace(pg_get_indexdef(ix.indexrelid), '^.* USING ', ''), '"', '')) as definition,
+        c.relname ~ '^[0-9a-f]{32}$' as dbt_named
+    from pg_index ix
+    join pg_class c on c.oid = ix.indexrelid
+    where ix.indrelid = '{{ relation.include(database=False) }}'::regclass
+{% endmacro %}
+
+{% macro ensure_constraint(constraint_type, columns) %}
+    {#- Post-hook adding a primary key or unique constraint unless the table
+        already has it. Postgres names the constraint, so a full refresh does
+        not clash with the backup table's constraint before it is dropped. -#}
+    {%- set column_list = columns | join(', ') -%}
+    do $$
+    begin
+        if not exists (
+            select 1 from pg_constraint
+            where conrelid = '{{ this.include(database=False) }}'::regclass
+              and pg_get_constraintdef(oid) = '{{ constraint_type | upper }} ({{ column_list }})'
+        ) then
+            alter table {{ this }} add {{ constraint_type }} ({{ column_list }});
+        end if;
+    end
+    $$
+{% endmacro %}
@@ -0,0 +1,17 @@
+{% macro stamp_pipeline_version() %}
+    {#- Bumped at the end of every dbt run so API caches know the marts changed. -#}
+    {% if flags.WHICH in ('run', 'build') %}
+        create table if not exists {{ target.schema }}.pipeline_version (
+            id integer primary key default 1 check (id = 1),
+            version bigint not null,
+            invocation_id text,
+            updated_at timestamp default current_timestamp
+        );
+        insert into {{ target.schema }}.pipeline_version (id, version, invocation_id)
+        values (1, 1, '{{ invocation_id }}')
+        on conflict (id) do update
+        set version = {{ target.schema }}.pipeline_version.version + 1,
+            invocation_id = excluded.invocation_id,
+            updated_at = current_timestamp;
+    {% endif %}
+{% endmacro %}
@@ -0,0 +1,9 @@
+{% macro surrogate_key(columns) -%}
+    {#- Stable bigint key: the first 64 bits of the md5 of the natural key, so
+        ids never change when other rows are added and need no lookup. -#}
+    ('x' || left(md5(concat_ws('|'
+        {%- for column in columns -%}
+            , coalesce(cast({{ column }} as text), '')
+        {%- endfor -%}
+    )), 16))::bit(64)::bigint
+{%- endmacro %}
@@ -1,9 +1,21 @@
-with channels as (
-    select distinct 'lobelia4cosmetics' as channel_name from {{ ref('stg_lobelia4cosmetics') }}
-    union
-    select distinct 'tikvahpharma' as channel_name from {{ ref('stg_tikvahpharma') }}
-)
+{{
+    config(
+        materialized='incremental',
+        unique_key='channel_id',
+        post_hook=[
+            "{{ ensure_constraint('primary key', ['channel_id']) }}",
+            "{{ ensure_constraint('unique', ['channel_name']) }}"
+        ]
+    )
+}}
+
+-- Every channel in the raw.channels registry. channel_id is a hash of
+-- channel_name, so adding a channel never changes the ids of existing ones.
+-- Incremental runs only insert channels not seen yet.
 select
-    row_number() over (order by channel_name) as channel_id,
+    {{ surrogate_key(['channel_name']) }} as channel_id,
     channel_name
-from channels 
\ No newline at end of file
+from {{ ref('stg_channels') }}
+{% if is_incremental() %}
+where channel_name not in (select channel_name from {{ this }})
+{% endif %}
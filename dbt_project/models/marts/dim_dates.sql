@@ -1,17 +1,30 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key='date_id',
+        post_hook=[
+            "{{ ensure_constraint('primary key', ['date_id']) }}",
+            "{{ ensure_constraint('unique', ['date']) }}"
+        ]
+    )
+}}
+
+-- date_id is the date as YYYYMMDD, stable across runs. Incremental runs only
+-- look at messages from the latest known date onwards.
 with all_dates as (
-    select message_date::date as date from {{ ref('stg_lobelia4cosmetics') }}
-    union
-    select message_date::date as date from {{ ref('stg_tikvahpharma') }}
+    select message_date::date as date from {{ ref('stg_telegram_messages') }}
+    {% if is_incremental() %}
+    where message_date >= (select max(date) from {{ this }})
+    {% endif %}
 ),
 distinct_dates as (
-    select distinct date from all_dates
+    select distinct date from all_dates where date is not null
 )
 select
-    row_number() over (order by date) as date_id,
+    to_char(date, 'YYYYMMDD')::integer as date_id,
     date,
     extract(year from date) as year,
     extract(month from date) as month,
     extract(day from date) as day,
     extract(dow from date) as weekday
 from distinct_dates
-order by date 
\ No newline at end of file
@@ -0,0 +1,62 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key=['channel_name', 'granularity', 'period_start'],
+        incremental_strategy='delete+insert',
+        indexes=[
+            {'columns': ['channel_name', 'granularity', 'period_start'], 'unique': True}
+        ]
+    )
+}}
+
+-- Channel activity rolled up to hour, day, week and month, used by
+-- /api/channels/{channel_name}/activity. Incremental runs rebuild every period
+-- that starts on or after the cutoff: the start of the week or month (whichever
+-- is earlier) containing the latest loaded day minus a lookback. Every period
+-- that can contain new messages starts after the cutoff, so each rebuilt
+-- period is complete and delete+insert replaces it.
+{% set granularities = ['hour', 'day', 'week', 'month'] %}
+
+{% if is_incremental() %}
+{% set cutoff %}
+    (
+        select least(date_trunc('week', d), date_trunc('month', d))
+        from (
+            select coalesce(max(period_start), '1900-01-01'::timestamp)
+                   - interval '{{ var('channel_activity_lookback_days', 1) }} days' as d
+            from {{ this }}
+            where granularity = 'day'
+        ) latest
+    )
+{% endset %}
+{% endif %}
+
+with messages as (
+    select
+        c.channel_name,
+        m.message_date,
+        m.has_image,
+        (m.raw_json->>'views')::bigint as views,
+        (m.raw_json->>'forwards')::bigint as forwards
+    from {{ ref('fct_messages') }} m
+    join {{ ref('dim_channels') }} c on m.channel_id = c.channel_id
+    where m.message_date is not null
+    {% if is_incremental() %}
+      and m.message_date >= {{ cutoff }}
+    {% endif %}
+)
+{% for granularity in granularities %}
+select
+    channel_name,
+    '{{ granularity }}' as granularity,
+    date_trunc('{{ granularity }}', message_date) as period_start,
+    count(*) as message_count,
+    count(*) filter (where has_image) as image_count,
+    coalesce(sum(views), 0) as total_views,
+    avg(views) as avg_views,
+    coalesce(sum(forwards), 0) as total_forwards,
+    avg(forwards) as avg_forwards
+from messages
+group by channel_name, date_trunc('{{ granularity }}', message_date)
+{% if not loop.last %}union all{% endif %}
+{% endfor %}
@@ -1,15 +1,57 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key=['image_path'],
+        incremental_strategy='delete+insert',
+        pre_hook="update raw.image_detection_changes set claimed = true where not claimed",
+        post_hook=[
+            """
+            delete from {{ this }} t
+            using raw.image_detection_changes c
+            where c.claimed and t.image_path = c.image_path
+              and not exists (select 1 from raw.image_detections d where d.image_path = t.image_path)
+            """,
+            "delete from raw.image_detection_changes where claimed"
+        ],
+        indexes=[
+            {'columns': ['image_path']},
+            {'columns': ['message_id']},
+            {'columns': ['channel_id']},
+            {'columns': ['date_id']}
+        ]
+    )
+}}
+
+-- The enrichment job replaces all of an image's detections when the image
+-- changes and queues the image in raw.image_detection_changes, in the same
+-- transaction. The pre-hook claims the changes committed so far; incremental
+-- runs delete+insert the claimed images, and retry the images whose message
+-- was not in fct_messages yet. The post-hooks delete the rows of claimed
+-- images that no longer have detections, then the claimed changes. dbt runs
+-- the hooks and the model in one transaction, so changes committed meanwhile
+-- stay queued for the next run, and a failed run leaves its claims unmade.
+-- Message ids are only unique within a channel, so detections are matched to
+-- their message by channel too. The enrichment job stores each image at
+-- <lake>/YYYY-MM-DD/<channel>/<message id>.jpg, so the channel is the name of
+-- the image's directory.
 with detections as (
     select
         message_id,
+        substring(image_path from '([^/\\]+)[/\\][^/\\]+$') as channel_name,
         image_path,
         detected_object_class,
         confidence_score,
         detection_timestamp
     from raw.image_detections
+    {% if is_incremental() %}
+    where image_path in (select image_path from raw.image_detection_changes where claimed)
+       or image_path in (select image_path from {{ this }} where channel_id is null)
+    {% endif %}
 ),
 messages as (
     select
         message_id,
+        channel_name,
         channel_id,
         date_id
     from {{ ref('fct_messages') }}
@@ -23,4 +65,4 @@ select
     d.image_path,
     d.detection_timestamp
 from detections d
-left join messages m on d.message_id = m.message_id 
\ No newline at end of file
+left join messages m on d.message_id = m.message_id and d.channel_name = m.channel_name 
\ No newline at end of file
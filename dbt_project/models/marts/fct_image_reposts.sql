@@ -0,0 +1,48 @@
+{{
+    config(
+        materialized='table',
+        indexes=[
+            {'columns': ['group_hash', 'message_date']},
+            {'columns': ['channel_name', 'message_date']}
+        ]
+    )
+}}
+
+-- One row per image message with its repost group: the canonical content the
+-- enrichment job's pHash index mapped the image to (itself unless it was
+-- within ENRICH_PHASH_DISTANCE bits of an earlier image). Rebuilt in full;
+-- raw.image_phashes has one row per image, so this stays small next to
+-- fct_messages.
+with phashes as (
+    select
+        image_path,
+        channel_name,
+        message_id,
+        content_hash,
+        canonical_hash,
+        distance
+    from raw.image_phashes
+),
+groups as (
+    select
+        canonical_hash,
+        count(*) as group_size
+    from phashes
+    group by canonical_hash
+)
+select
+    m.message_key,
+    p.message_id,
+    p.channel_name,
+    m.channel_id,
+    m.date_id,
+    m.message_date,
+    p.image_path,
+    p.content_hash,
+    p.canonical_hash as group_hash,
+    p.distance,
+    g.group_size
+from phashes p
+join groups g on p.canonical_hash = g.canonical_hash
+join {{ ref('fct_messages') }} m
+    on p.channel_name = m.channel_name and p.message_id = m.message_id
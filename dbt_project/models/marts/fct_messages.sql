@@ -1,33 +1,71 @@
-with stg as (
-    select *, 'lobelia4cosmetics' as channel_name from {{ ref('stg_lobelia4cosmetics') }}
-    union all
-    select *, 'tikvahpharma' as channel_name from {{ ref('stg_tikvahpharma') }}
-),
-channels as (
-    select * from {{ ref('dim_channels') }}
-),
-dates as (
-    select * from {{ ref('dim_dates') }}
+{{
+    config(
+        materialized='incremental',
+        unique_key=['channel_name', 'message_id'],
+        incremental_strategy='delete+insert',
+        pre_hook="create extension if not exists pg_trgm",
+        post_hook="{{ ensure_constraint('primary key', ['message_key']) }}",
+        indexes=[
+            {'columns': ['channel_name', 'message_id'], 'unique': True},
+            {'columns': ['search_vector'], 'type': 'gin'},
+            {'columns': ['search_text gin_trgm_ops'], 'type': 'gin'},
+            {'columns': ['message_date', 'message_id']},
+            {'columns': ['channel_id', 'message_date', 'message_id']},
+            {'columns': ['date_id']},
+            {'columns': ['message_date'], 'type': 'brin'}
+        ]
+    )
+}}
+
+-- Incremental runs replace only messages dated from the latest loaded day
+-- (minus a lookback for late edits) onwards, with delete+insert: dbt's
+-- merge strategy needs MERGE, which Postgres only has from version 15. Keys
+-- are hashes of the natural keys, so existing rows never need their
+-- channel_id or date_id rewritten.
+-- Messages loaded for older days (backfills) need a --full-refresh run.
+-- Messages arrive roughly in date order, so a BRIN index on message_date
+-- (a few pages for the whole table) prunes date-range scans; the B-tree on
+-- (message_date, message_id) serves the newest-first pages.
+with new_messages as (
+    select * from {{ ref('stg_telegram_messages') }}
+    {% if is_incremental() %}
+    where message_date >= (
+        select coalesce(max(message_date)::date, '1900-01-01'::date) - {{ var('messages_lookback_days', 1) }}
+        from {{ this }}
+    )
+    {% endif %}
 ),
 joined as (
     select
         stg.message_id,
-        ch.channel_id,
-        dt.date_id,
+        stg.channel_name,
+        {{ surrogate_key(['stg.channel_name']) }} as channel_id,
+        to_char(stg.message_date, 'YYYYMMDD')::integer as date_id,
         stg.text,
         stg.image_path,
         stg.message_date,
-        stg.raw_json
-    from stg
-    left join channels ch on stg.channel_name = ch.channel_name
-    left join dates dt on stg.message_date::date = dt.date
+        stg.raw_json,
+        -- Telethon exports keep the post text under "message"
+        coalesce(stg.raw_json->>'text', stg.raw_json->>'message') as message_text
+    from new_messages stg
+),
+normalized as (
+    select
+        *,
+        lower(regexp_replace(message_text, '\s+', ' ', 'g')) as search_text
+    from joined
 )
 select
+    {{ surrogate_key(['channel_name', 'message_id']) }} as message_key,
     message_id,
+    channel_name,
     channel_id,
     date_id,
     length(text) as message_length,
     case when image_path is not null and image_path != '' then true else false end as has_image,
     message_date,
-    raw_json
-from joined 
\ No newline at end of file
+    raw_json,
+    message_text,
+    search_text,
+    to_tsvector('simple', coalesce(search_text, '')) as search_vector
+from normalized
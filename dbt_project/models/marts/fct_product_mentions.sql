@@ -0,0 +1,53 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key=['channel_name', 'message_id'],
+        incremental_strategy='delete+insert',
+        indexes=[
+            {'columns': ['channel_name', 'message_id', 'position'], 'unique': True},
+            {'columns': ['product', 'message_date']},
+            {'columns': ['product', 'channel_name', 'message_date']},
+            {'columns': ['channel_name', 'message_date']}
+        ]
+    )
+}}
+
+-- One row per product mention the loader extracted (see
+-- src/loader/products.py), with the price and strength quoted next to it.
+-- Backs the /api/products endpoints. The loader replaces all of a message's
+-- mentions when the message is reloaded, so incremental runs delete+insert
+-- every message with newer mentions. A reloaded message that lost all of
+-- its mentions keeps the old ones here until a --full-refresh run.
+with mentions as (
+    select
+        channel_name,
+        message_id,
+        message_date,
+        position,
+        product,
+        matched_text,
+        strength,
+        price,
+        currency,
+        loaded_at
+    from raw.product_mentions
+    {% if is_incremental() %}
+    where loaded_at > (select coalesce(max(loaded_at), '1900-01-01'::timestamp) from {{ this }})
+    {% endif %}
+)
+select
+    {{ surrogate_key(['channel_name', 'message_id', 'position']) }} as mention_key,
+    {{ surrogate_key(['channel_name', 'message_id']) }} as message_key,
+    message_id,
+    channel_name,
+    {{ surrogate_key(['channel_name']) }} as channel_id,
+    to_char(message_date, 'YYYYMMDD')::integer as date_id,
+    message_date,
+    position,
+    product,
+    matched_text,
+    strength,
+    price,
+    currency,
+    loaded_at
+from mentions
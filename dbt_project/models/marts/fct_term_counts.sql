@@ -0,0 +1,50 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key=['message_date'],
+        incremental_strategy='delete+insert',
+        on_schema_change='append_new_columns',
+        indexes=[
+            {'columns': ['channel_name', 'message_date']},
+            {'columns': ['message_date']},
+            {'columns': ['term']}
+        ]
+    )
+}}
+
+-- Term frequencies per channel and day, used by /api/reports/top-products.
+-- Incremental runs only re-count the days from the latest loaded day onwards
+-- (minus a small lookback for late messages); delete+insert replaces every
+-- row of those days, so terms that no longer occur on a re-counted day are
+-- removed too. counted_at tells fct_term_totals which days were re-counted.
+with messages as (
+    select
+        m.message_date::date as message_date,
+        c.channel_name,
+        m.message_text as text
+    from {{ ref('fct_messages') }} m
+    join {{ ref('dim_channels') }} c on m.channel_id = c.channel_id
+    where m.message_text is not null
+    {% if is_incremental() %}
+      and m.message_date::date >= (
+          select coalesce(max(message_date), '1900-01-01'::date) - {{ var('term_counts_lookback_days', 1) }}
+          from {{ this }}
+      )
+    {% endif %}
+),
+terms as (
+    select
+        channel_name,
+        message_date,
+        unnest(string_to_array(lower(text), ' ')) as term
+    from messages
+)
+select
+    channel_name,
+    message_date,
+    term,
+    count(*) as mention_count,
+    current_timestamp as counted_at
+from terms
+where length(term) > 3
+group by channel_name, message_date, term
@@ -0,0 +1,52 @@
+{{
+    config(
+        materialized='incremental',
+        unique_key=['term'],
+        incremental_strategy='delete+insert',
+        post_hook="delete from {{ this }} where total = 0",
+        indexes=[
+            {'columns': ['term'], 'unique': True},
+            {'columns': ['total desc']}
+        ]
+    )
+}}
+
+-- All-time term totals across channels, so the unfiltered top-products
+-- report is a top-N read of the (total desc) index instead of an
+-- aggregation over all of fct_term_counts. Incremental runs re-total the
+-- terms of the days fct_term_counts re-counted since the last run, and the
+-- terms last seen on or after the earliest of those days, which covers terms
+-- that disappeared from a re-counted day. Terms left without any count get
+-- a zero total and are removed by the post-hook.
+{% if is_incremental() %}
+with recounted_days as (
+    select distinct message_date
+    from {{ ref('fct_term_counts') }}
+    where counted_at > (select coalesce(max(counted_at), '1900-01-01'::timestamp) from {{ this }})
+),
+affected as (
+    select term
+    from {{ ref('fct_term_counts') }}
+    where message_date in (select message_date from recounted_days)
+    union
+    select term
+    from {{ this }}
+    where last_seen >= (select min(message_date) from recounted_days)
+)
+select
+    a.term,
+    coalesce(sum(t.mention_count), 0) as total,
+    max(t.message_date) as last_seen,
+    max(t.counted_at) as counted_at
+from affected a
+left join {{ ref('fct_term_counts') }} t on t.term = a.term
+group by a.term
+{% else %}
+select
+    term,
+    sum(mention_count) as total,
+    max(message_date) as last_seen,
+    max(counted_at) as counted_at
+from {{ ref('fct_term_counts') }}
+group by term
+{% endif %}
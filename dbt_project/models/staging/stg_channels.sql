@@ -0,0 +1,12 @@
+with source as (
+    select
+        channel_name,
+        active,
+        added_at
+    from raw.channels
+)
+select
+    channel_name,
+    active,
+    added_at
+from source
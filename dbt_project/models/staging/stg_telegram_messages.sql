@@ -0,0 +1,20 @@
+-- raw.telegram_messages is partitioned by month on date; filters on
+-- message_date in downstream models prune the partitions they do not need.
+with source as (
+    select
+        channel_name,
+        message_id,
+        date,
+        text,
+        image_path,
+        raw_json
+    from raw.telegram_messages
+)
+select
+    channel_name,
+    message_id,
+    date::timestamp as message_date,
+    text,
+    image_path,
+    raw_json
+from source
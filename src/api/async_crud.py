@@ -0,0 +1,142 @@
+from src.api.async_database import get_db, to_asyncpg
+from src.api import metrics, schemas, crud
+from typing import AsyncIterator, List, Optional, Tuple
+from datetime import date
+import asyncpg
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+PIPELINE_VERSION_SQL = to_asyncpg(crud.PIPELINE_VERSION_SQL)
+
+
+async def get_top_products(limit: int = 10, channel: Optional[str] = None,
+                           start_date: Optional[date] = None, end_date: Optional[date] = None) -> List[schemas.TopProduct]:
+    try:
+        query, params = crud.top_products_query(limit, channel, start_date, end_date)
+        async with get_db() as conn:
+            with metrics.track_query('top_products') as stats:
+                rows = await conn.fetch(to_asyncpg(query), *params)
+                stats.rows = len(rows)
+        return [schemas.TopProduct(product=row[0], count=row[1]) for row in rows]
+    except Exception as e:
+        logging.error(f"Error in get_top_products: {e}")
+        raise
+
+async def get_channel_activity(channel_name: str, granularity: str = 'day', start_date: Optional[date] = None,
+                               end_date: Optional[date] = None) -> Optional[schemas.ChannelActivity]:
+    try:
+        sql, params = crud.channel_activity_query(channel_name, granularity, start_date, end_date)
+        async with get_db() as conn:
+            with metrics.track_query('channel_activity') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        return crud.channel_activity(channel_name, granularity, rows)
+    except Exception as e:
+        logging.error(f"Error in get_channel_activity: {e}")
+        raise
+
+async def get_reposts(limit: int = 20, min_posts: int = 2,
+                      channel: Optional[str] = None) -> List[schemas.RepostGroup]:
+    try:
+        sql, params = crud.reposts_query(limit, min_posts, channel)
+        async with get_db() as conn:
+            with metrics.track_query('reposts') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        return [crud.repost_group(row) for row in rows]
+    except Exception as e:
+        logging.error(f"Error in get_reposts: {e}")
+        raise
+
+async def get_product_summary(product: str, currency: str = 'ETB', start_date: Optional[date] = None,
+                              end_date: Optional[date] = None) -> Optional[schemas.ProductSummary]:
+    try:
+        sql, params = crud.product_summary_query(product, currency, start_date, end_date)
+        async with get_db() as conn:
+            with metrics.track_query('product_summary') as stats:
+                row = await conn.fetchrow(to_asyncpg(sql), *params)
+                stats.rows = 1 if row else 0
+        return crud.product_summary(product, currency, row)
+    except Exception as e:
+        logging.error(f"Error in get_product_summary: {e}")
+        raise
+
+async def get_product_prices(product: str, granularity: str = 'week', currency: str = 'ETB',
+                             strength: Optional[str] = None, start_date: Optional[date] = None,
+                             end_date: Optional[date] = None) -> Optional[schemas.ProductPrices]:
+    try:
+        sql, params = crud.product_prices_query(product, granularity, currency, strength, start_date, end_date)
+        async with get_db() as conn:
+            with metrics.track_query('product_prices') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        return crud.product_prices(product, granularity, currency, strength, rows)
+    except Exception as e:
+        logging.error(f"Error in get_product_prices: {e}")
+        raise
+
+async def get_cheapest_channels(product: str, currency: str = 'ETB', strength: Optional[str] = None,
+                                start_date: Optional[date] = None, end_date: Optional[date] = None,
+                                limit: int = 10) -> List[schemas.ChannelPrice]:
+    try:
+        sql, params = crud.cheapest_channels_query(product, currency, strength, start_date, end_date, limit)
+        async with get_db() as conn:
+            with metrics.track_query('cheapest_channels') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        return [crud.channel_price(row) for row in rows]
+    except Exception as e:
+        logging.error(f"Error in get_cheapest_channels: {e}")
+        raise
+
+async def search_messages(query: str, channel: Optional[str] = None, start_date: Optional[date] = None,
+                          end_date: Optional[date] = None, limit: int = 50, sort: str = 'rank',
+                          after: Optional[str] = None) -> Tuple[List[schemas.MessageSearchResult], Optional[str]]:
+    try:
+        fetch = limit + 1 if sort == 'date' else limit
+        sql, params = crud.search_messages_query(query, channel, start_date, end_date, fetch, sort, after)
+        async with get_db() as conn:
+            with metrics.track_query('search_messages') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        rows, next_cursor = crud.page(rows, limit)
+        return [schemas.MessageSearchResult(**crud.message_row(row), rank=row[4]) for row in rows], next_cursor
+    except Exception as e:
+        logging.error(f"Error in search_messages: {e}")
+        raise
+
+async def list_messages(channel: Optional[str] = None, start_date: Optional[date] = None,
+                        end_date: Optional[date] = None, limit: int = 100,
+                        after: Optional[str] = None) -> Tuple[List[schemas.Message], Optional[str]]:
+    try:
+        sql, params = crud.list_messages_query(channel, start_date, end_date, limit + 1, after)
+        async with get_db() as conn:
+            with metrics.track_query('list_messages') as stats:
+                rows = await conn.fetch(to_asyncpg(sql), *params)
+                stats.rows = len(rows)
+        rows, next_cursor = crud.page(rows, limit)
+        return [schemas.Message(**crud.message_row(row)) for row in rows], next_cursor
+    except Exception as e:
+        logging.error(f"Error in list_messages: {e}")
+        raise
+
+async def stream_messages(sql: str, params) -> AsyncIterator[dict]:
+    # asyncpg cursors need a transaction; rows are prefetched in batches of
+    # crud.STREAM_FETCH_SIZE.
+    async with get_db() as conn, conn.transaction():
+        with metrics.track_query('stream_messages') as stats:
+            async for row in conn.cursor(to_asyncpg(sql), *params, prefetch=crud.STREAM_FETCH_SIZE):
+                stats.rows += 1
+                yield crud.message_row(row)
+
+async def get_pipeline_version() -> int:
+    try:
+        async with get_db() as conn:
+            with metrics.track_query('pipeline_version') as stats:
+                version = await conn.fetchval(PIPELINE_VERSION_SQL)
+                stats.rows = 0 if version is None else 1
+            return version or 0
+    except asyncpg.exceptions.UndefinedTableError:
+        # dbt has not run yet
+        return 0
\ No newline at end of file
@@ -0,0 +1,102 @@
+import re
+import time
+import asyncio
+import asyncpg
+from src.api.database import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, PoolTimeout,
+)
+
+
+def to_asyncpg(query: str) -> str:
+    # Rewrites psycopg2 %s placeholders as asyncpg's $1, $2, ...
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', query)
+
+
+class AsyncDatabasePool:
+    # asyncpg pool with the same statistics as the sync DatabasePool. fetch()
+    # and friends prepare each distinct query text once per connection and
+    # keep it in asyncpg's per-connection statement cache (the last 100
+    # statements), so repeated queries skip parsing and planning setup.
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = None
+        self._waiting = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def open(self):
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                host=DB_HOST,
+                port=int(DB_PORT),
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                min_size=self.minconn,
+                max_size=self.maxconn,
+            )
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def connection(self):
+        return _PooledConnection(self)
+
+    def stats(self):
+        return {
+            'min_size': self.minconn,
+            'max_size': self.maxconn,
+            'in_use': self._in_use,
+            'waiting': self._waiting,
+            'checkouts': self._checkouts,
+            'discarded': 0,
+            'avg_checkout_ms': (self._wait_total / self._checkouts * 1000) if self._checkouts else 0.0,
+            'max_checkout_ms': self._wait_max * 1000,
+        }
+
+
+class _PooledConnection:
+    def __init__(self, pool: AsyncDatabasePool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        pool = self.pool
+        if pool._pool is None:
+            await pool.open()
+        started = time.perf_counter()
+        pool._waiting += 1
+        try:
+            self.conn = await pool._pool.acquire(timeout=pool.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f'No database connection available after {pool.timeout}s')
+        finally:
+            pool._waiting -= 1
+        waited = time.perf_counter() - started
+        pool._in_use += 1
+        pool._checkouts += 1
+        pool._wait_total += waited
+        pool._wait_max = max(pool._wait_max, waited)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # asyncpg resets the connection (including any open transaction)
+        # when it is released, and terminates it if the reset fails.
+        await self.pool._pool.release(self.conn)
+        self.pool._in_use -= 1
+
+
+pool = AsyncDatabasePool()
+
+
+def get_db():
+    return pool.connection()
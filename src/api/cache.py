@@ -0,0 +1,86 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Analytical endpoints only change when the pipeline's dbt step finishes, so
+# their responses are cached in-process. Entries are dropped when the
+# pipeline version stamp written by dbt (see the stamp_pipeline_version macro)
+# changes, when they are older than the TTL, or when the LRU bound is hit.
+
+API_CACHE_MAXSIZE = int(os.getenv('API_CACHE_MAXSIZE', '256'))
+API_CACHE_TTL = float(os.getenv('API_CACHE_TTL', '3600'))
+# Seconds between checks of the pipeline version stamp.
+API_CACHE_VERSION_INTERVAL = float(os.getenv('API_CACHE_VERSION_INTERVAL', '5'))
+
+
+class ResponseCache:
+    def __init__(self, maxsize=API_CACHE_MAXSIZE, ttl=API_CACHE_TTL, version_interval=API_CACHE_VERSION_INTERVAL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self.version = None
+        self._version_checked = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def version_is_stale(self):
+        return time.monotonic() - self._version_checked >= self.version_interval
+
+    def set_version(self, version):
+        with self._lock:
+            self._version_checked = time.monotonic()
+            if version != self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.version = version
+
+    def get(self, key):
+        # Returns (hit, value) so that None can be cached too.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, version=None):
+        # A value computed before a version change is not stored.
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.maxsize,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'pipeline_version': self.version,
+            }
+
+
+response_cache = ResponseCache()
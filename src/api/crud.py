@@ -1,90 +1,483 @@
+import base64
+import psycopg2
 from src.api.database import get_db
-from src.api import schemas
-from typing import List, Optional
+from src.api import metrics, schemas
+from typing import Iterator, List, Optional, Tuple
+from datetime import date, datetime
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+# Queries are shared with async_crud, which rewrites the %s placeholders for
+# asyncpg. Optional filters are only added to the SQL when given, so each
+# combination gets its own index-friendly plan.
 
-def get_top_products(limit: int = 10) -> List[schemas.TopProduct]:
+# Unfiltered requests read the all-time totals of fct_term_totals: a top-N
+# scan of its (total desc) index.
+TOP_TERMS_SQL = '''
+    SELECT term, total as count
+    FROM raw_marts.fct_term_totals
+    ORDER BY total DESC
+    LIMIT %s
+'''
+
+# Filtered requests aggregate the per-channel, per-day fct_term_counts mart.
+TOP_PRODUCTS_SQL = '''
+    SELECT term, SUM(mention_count) as count
+    FROM raw_marts.fct_term_counts
+    {where}
+    GROUP BY term
+    ORDER BY count DESC
+    LIMIT %s
+'''
+
+# Reads the fct_channel_activity rollup; a single range scan on its
+# (channel_name, granularity, period_start) index.
+CHANNEL_ACTIVITY_SQL = '''
+    SELECT period_start, message_count, image_count, total_views, avg_views,
+           total_forwards, avg_forwards
+    FROM raw_marts.fct_channel_activity
+    WHERE channel_name = %s AND granularity = %s
+    {filters}
+    ORDER BY period_start
+'''
+
+# Full-text matches (GIN on search_vector) are ranked first; the trigram GIN
+# index on search_text serves the substring LIKE for partial words.
+SEARCH_MESSAGES_SQL = '''
+    SELECT m.message_id, c.channel_name, m.message_date, m.message_text,
+           ts_rank_cd(m.search_vector, q.tsq) as rank
+    FROM raw_marts.fct_messages m
+    JOIN raw_marts.dim_channels c ON m.channel_id = c.channel_id
+    CROSS JOIN (SELECT plainto_tsquery('simple', %s) as tsq) q
+    WHERE (m.search_vector @@ q.tsq OR m.search_text LIKE %s)
+    {filters}
+    ORDER BY {order}
+    {limit}
+'''
+
+LIST_MESSAGES_SQL = '''
+    SELECT m.message_id, c.channel_name, m.message_date, m.message_text
+    FROM raw_marts.fct_messages m
+    JOIN raw_marts.dim_channels c ON m.channel_id = c.channel_id
+    WHERE true
+    {filters}
+    ORDER BY m.message_date DESC, m.message_id DESC
+    {limit}
+'''
+
+# Repost groups from fct_image_reposts, largest first. The channel filter
+# keeps groups with at least one post in the channel.
+REPOSTS_SQL = '''
+    SELECT group_hash,
+           (array_agg(image_path ORDER BY message_date, message_id))[1] as image_path,
+           count(*) as post_count,
+           count(DISTINCT channel_name) as channel_count,
+           array_agg(DISTINCT channel_name ORDER BY channel_name) as channels,
+           min(message_date) as first_seen,
+           max(message_date) as last_seen
+    FROM raw_marts.fct_image_reposts
+    {where}
+    GROUP BY group_hash
+    HAVING count(*) >= %s
+    ORDER BY post_count DESC, group_hash
+    LIMIT %s
+'''
+
+# The product endpoints read fct_product_mentions through its (product,
+# message_date) and (product, channel_name, message_date) indexes. Price
+# statistics only use prices in the requested currency.
+PRODUCT_SUMMARY_SQL = '''
+    SELECT count(*) as mention_count,
+           count(DISTINCT channel_name) as channel_count,
+           min(message_date) as first_seen,
+           max(message_date) as last_seen,
+           array_agg(DISTINCT strength ORDER BY strength) FILTER (WHERE strength IS NOT NULL) as strengths,
+           count(price) FILTER (WHERE currency = c.price_currency) as price_count,
+           min(price) FILTER (WHERE currency = c.price_currency) as min_price,
+           avg(price) FILTER (WHERE currency = c.price_currency) as avg_price,
+           max(price) FILTER (WHERE currency = c.price_currency) as max_price
+    FROM raw_marts.fct_product_mentions
+    CROSS JOIN (SELECT %s::text as price_currency) c
+    WHERE product = %s
+    {filters}
+'''
+
+PRODUCT_PRICES_SQL = '''
+    SELECT date_trunc(%s, message_date) as period_start,
+           count(*) as price_count,
+           count(DISTINCT channel_name) as channel_count,
+           min(price) as min_price,
+           avg(price) as avg_price,
+           max(price) as max_price
+    FROM raw_marts.fct_product_mentions
+    WHERE product = %s AND currency = %s
+    {filters}
+    GROUP BY period_start
+    ORDER BY period_start
+'''
+
+# Each channel's latest quoted price, cheapest channel first.
+CHEAPEST_CHANNELS_SQL = '''
+    SELECT channel_name, price, currency, strength, message_id, message_date
+    FROM (
+        SELECT DISTINCT ON (channel_name) channel_name, price, currency, strength, message_id, message_date
+        FROM raw_marts.fct_product_mentions
+        WHERE product = %s AND currency = %s
+        {filters}
+        ORDER BY channel_name, message_date DESC, message_id DESC, price
+    ) latest
+    ORDER BY price, channel_name
+    LIMIT %s
+'''
+
+# Written by the stamp_pipeline_version dbt macro at the end of every run.
+PIPELINE_VERSION_SQL = '''
+    SELECT version FROM raw.pipeline_version WHERE id = 1
+'''
+
+# Rows fetched per round trip by server-side cursors when streaming.
+STREAM_FETCH_SIZE = 2000
+
+
+def encode_cursor(message_date: datetime, message_id: int) -> str:
+    raw = f'{message_date.isoformat()}|{message_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    # Raises ValueError for anything that was not produced by encode_cursor.
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT word, COUNT(*) as count
-            FROM (
-                SELECT unnest(string_to_array(lower(raw_json->>'text'), ' ')) as word
-                FROM raw_marts.fct_messages
-                WHERE raw_json->>'text' IS NOT NULL
-            ) words
-            WHERE length(word) > 3
-            GROUP BY word
-            ORDER BY count DESC
-            LIMIT %s
-        ''', (limit,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        message_date, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(message_date), int(message_id)
+    except Exception as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+def message_filters(channel: Optional[str], start_date: Optional[date], end_date: Optional[date],
+                    after: Optional[str]):
+    # Shared WHERE conditions for the message endpoints. after is a keyset
+    # cursor on (message_date, message_id) in descending order.
+    conditions = []
+    params = []
+    if channel:
+        conditions.append('c.channel_name = %s')
+        params.append(channel)
+    if start_date:
+        conditions.append('m.message_date >= %s::date')
+        params.append(start_date)
+    if end_date:
+        conditions.append('m.message_date < %s::date + 1')
+        params.append(end_date)
+    if after:
+        conditions.append('(m.message_date, m.message_id) < (%s::timestamp, %s::bigint)')
+        params.extend(decode_cursor(after))
+    return ''.join(f' AND {condition}' for condition in conditions), params
+
+def limit_clause(limit: Optional[int]):
+    return ('LIMIT %s', [limit]) if limit is not None else ('', [])
+
+def top_products_query(limit: int, channel: Optional[str] = None,
+                       start_date: Optional[date] = None, end_date: Optional[date] = None):
+    conditions = []
+    params = []
+    if channel:
+        conditions.append('channel_name = %s')
+        params.append(channel)
+    if start_date:
+        conditions.append('message_date >= %s')
+        params.append(start_date)
+    if end_date:
+        conditions.append('message_date <= %s')
+        params.append(end_date)
+    if not conditions:
+        return TOP_TERMS_SQL, (limit,)
+    return TOP_PRODUCTS_SQL.format(where=f"WHERE {' AND '.join(conditions)}"), (*params, limit)
+
+def channel_activity_query(channel_name: str, granularity: str = 'day',
+                           start_date: Optional[date] = None, end_date: Optional[date] = None):
+    # start_date includes the whole period it falls in
+    filters = ''
+    params = [channel_name, granularity]
+    if start_date:
+        filters += ' AND period_start >= date_trunc(%s, %s::timestamp)'
+        params.extend([granularity, start_date])
+    if end_date:
+        filters += ' AND period_start < %s::date + 1'
+        params.append(end_date)
+    return CHANNEL_ACTIVITY_SQL.format(filters=filters), params
+
+def reposts_query(limit: int = 20, min_posts: int = 2, channel: Optional[str] = None):
+    where = ''
+    params = []
+    if channel:
+        where = ('WHERE group_hash IN (SELECT group_hash FROM raw_marts.fct_image_reposts '
+                 'WHERE channel_name = %s)')
+        params.append(channel)
+    return REPOSTS_SQL.format(where=where), (*params, min_posts, limit)
+
+def normalize_product(product: str) -> str:
+    # Canonical names in the dictionary are lower-cased, single-spaced
+    return ' '.join(product.lower().split())
+
+def normalize_strength(strength: str) -> str:
+    # Same form as the loader stores: 500mg, 120mg/5ml
+    return ''.join(strength.lower().split()).replace(',', '').replace('gm', 'g')
+
+def product_filters(strength: Optional[str], start_date: Optional[date], end_date: Optional[date]):
+    filters = ''
+    params = []
+    if strength:
+        filters += ' AND strength = %s'
+        params.append(normalize_strength(strength))
+    if start_date:
+        filters += ' AND message_date >= %s::date'
+        params.append(start_date)
+    if end_date:
+        filters += ' AND message_date < %s::date + 1'
+        params.append(end_date)
+    return filters, params
+
+def product_summary_query(product: str, currency: str = 'ETB', start_date: Optional[date] = None,
+                          end_date: Optional[date] = None):
+    filters, params = product_filters(None, start_date, end_date)
+    return PRODUCT_SUMMARY_SQL.format(filters=filters), (currency, normalize_product(product), *params)
+
+def product_prices_query(product: str, granularity: str = 'week', currency: str = 'ETB',
+                         strength: Optional[str] = None, start_date: Optional[date] = None,
+                         end_date: Optional[date] = None):
+    filters, params = product_filters(strength, start_date, end_date)
+    return PRODUCT_PRICES_SQL.format(filters=filters), (granularity, normalize_product(product), currency, *params)
+
+def cheapest_channels_query(product: str, currency: str = 'ETB', strength: Optional[str] = None,
+                            start_date: Optional[date] = None, end_date: Optional[date] = None, limit: int = 10):
+    filters, params = product_filters(strength, start_date, end_date)
+    return CHEAPEST_CHANNELS_SQL.format(filters=filters), (normalize_product(product), currency, *params, limit)
+
+def optional_float(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+def product_summary(product: str, currency: str, row) -> Optional[schemas.ProductSummary]:
+    if row is None or row[0] == 0:
+        return None
+    return schemas.ProductSummary(
+        product=normalize_product(product), mention_count=row[0], channel_count=row[1],
+        first_seen=row[2].isoformat(), last_seen=row[3].isoformat(), strengths=list(row[4] or []),
+        currency=currency, price_count=row[5], min_price=optional_float(row[6]),
+        avg_price=optional_float(row[7]), max_price=optional_float(row[8])
+    )
+
+def product_prices(product: str, granularity: str, currency: str, strength: Optional[str],
+                   rows) -> Optional[schemas.ProductPrices]:
+    if not rows:
+        return None
+    periods = [schemas.PricePeriod(
+        period_start=str(row[0]),
+        price_count=row[1],
+        channel_count=row[2],
+        min_price=float(row[3]),
+        avg_price=float(row[4]),
+        max_price=float(row[5])
+    ) for row in rows]
+    return schemas.ProductPrices(
+        product=normalize_product(product),
+        granularity=granularity,
+        currency=currency,
+        strength=normalize_strength(strength) if strength else None,
+        periods=periods
+    )
+
+def channel_price(row) -> schemas.ChannelPrice:
+    return schemas.ChannelPrice(
+        channel_name=row[0], price=float(row[1]), currency=row[2], strength=row[3], message_id=row[4],
+        message_date=row[5].isoformat()
+    )
+
+def repost_group(row) -> schemas.RepostGroup:
+    return schemas.RepostGroup(
+        group_hash=row[0], image_path=row[1], post_count=row[2], channel_count=row[3],
+        channels=list(row[4]), first_seen=row[5].isoformat(), last_seen=row[6].isoformat()
+    )
+
+def channel_activity(channel_name: str, granularity: str, rows) -> Optional[schemas.ChannelActivity]:
+    if not rows:
+        return None
+    periods = [schemas.ActivityPeriod(
+        period_start=str(row[0]),
+        message_count=row[1],
+        image_count=row[2],
+        total_views=row[3],
+        avg_views=row[4],
+        total_forwards=row[5],
+        avg_forwards=row[6]
+    ) for row in rows]
+    return schemas.ChannelActivity(
+        channel_name=channel_name,
+        granularity=granularity,
+        total_messages=sum(period.message_count for period in periods),
+        periods=periods
+    )
+
+def normalize_search_text(text: str) -> str:
+    # Same normalization as fct_messages.search_text
+    return ' '.join(text.lower().split())
+
+def like_pattern(text: str) -> str:
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+def search_messages_query(query: str, channel: Optional[str] = None, start_date: Optional[date] = None,
+                          end_date: Optional[date] = None, limit: Optional[int] = 50,
+                          sort: str = 'rank', after: Optional[str] = None):
+    # sort='rank' orders by relevance; sort='date' orders by (message_date,
+    # message_id) and supports keyset pagination through after.
+    normalized = normalize_search_text(query)
+    filters, filter_params = message_filters(channel, start_date, end_date, after if sort == 'date' else None)
+    limit_sql, limit_params = limit_clause(limit)
+    order = 'rank DESC, m.message_date DESC' if sort == 'rank' else 'm.message_date DESC, m.message_id DESC'
+    sql = SEARCH_MESSAGES_SQL.format(filters=filters, order=order, limit=limit_sql)
+    return sql, (normalized, like_pattern(normalized), *filter_params, *limit_params)
+
+def list_messages_query(channel: Optional[str] = None, start_date: Optional[date] = None,
+                        end_date: Optional[date] = None, limit: Optional[int] = 100, after: Optional[str] = None):
+    filters, filter_params = message_filters(channel, start_date, end_date, after)
+    limit_sql, limit_params = limit_clause(limit)
+    return LIST_MESSAGES_SQL.format(filters=filters, limit=limit_sql), (*filter_params, *limit_params)
+
+def message_row(row) -> dict:
+    return {
+        'message_id': row[0],
+        'channel_name': row[1],
+        'message_date': str(row[2]),
+        'text': row[3],
+    }
+
+def page(rows, limit: int):
+    # Queries for a page fetch limit + 1 rows; the extra row only signals that
+    # another page exists.
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1][2], rows[-1][0])
+    return rows, None
+
+def get_top_products(limit: int = 10, channel: Optional[str] = None,
+                     start_date: Optional[date] = None, end_date: Optional[date] = None) -> List[schemas.TopProduct]:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('top_products') as stats:
+            cur.execute(*top_products_query(limit, channel, start_date, end_date))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
         return [schemas.TopProduct(product=row[0], count=row[1]) for row in rows]
     except Exception as e:
         logging.error(f"Error in get_top_products: {e}")
         raise
 
-def get_channel_activity(channel_name: str) -> Optional[schemas.ChannelActivity]:
+def get_channel_activity(channel_name: str, granularity: str = 'day', start_date: Optional[date] = None,
+                         end_date: Optional[date] = None) -> Optional[schemas.ChannelActivity]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT COUNT(*) FROM raw_marts.fct_messages m
-            JOIN raw_marts.dim_channels c ON m.channel_id = c.channel_id
-            WHERE c.channel_name = %s
-        ''', (channel_name,))
-        row = cur.fetchone()
-        total_messages = row[0] if row else 0
-        cur.execute('''
-            SELECT d.date, COUNT(*)
-            FROM raw_marts.fct_messages m
-            JOIN raw_marts.dim_channels c ON m.channel_id = c.channel_id
-            JOIN raw_marts.dim_dates d ON m.date_id = d.date_id
-            WHERE c.channel_name = %s
-            GROUP BY d.date
-            ORDER BY d.date
-        ''', (channel_name,))
-        messages_per_day = [{'date': str(row[0]), 'count': row[1]} for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        if total_messages == 0:
-            return None
-        return schemas.ChannelActivity(
-            channel_name=channel_name,
-            total_messages=total_messages,
-            messages_per_day=messages_per_day
-        )
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('channel_activity') as stats:
+            cur.execute(*channel_activity_query(channel_name, granularity, start_date, end_date))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        return channel_activity(channel_name, granularity, rows)
     except Exception as e:
         logging.error(f"Error in get_channel_activity: {e}")
         raise
 
-def search_messages(query: str) -> List[schemas.MessageSearchResult]:
+def get_reposts(limit: int = 20, min_posts: int = 2, channel: Optional[str] = None) -> List[schemas.RepostGroup]:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('reposts') as stats:
+            cur.execute(*reposts_query(limit, min_posts, channel))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        return [repost_group(row) for row in rows]
+    except Exception as e:
+        logging.error(f"Error in get_reposts: {e}")
+        raise
+
+def get_product_summary(product: str, currency: str = 'ETB', start_date: Optional[date] = None,
+                        end_date: Optional[date] = None) -> Optional[schemas.ProductSummary]:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('product_summary') as stats:
+            cur.execute(*product_summary_query(product, currency, start_date, end_date))
+            row = cur.fetchone()
+            stats.rows = 1 if row else 0
+        return product_summary(product, currency, row)
+    except Exception as e:
+        logging.error(f"Error in get_product_summary: {e}")
+        raise
+
+def get_product_prices(product: str, granularity: str = 'week', currency: str = 'ETB',
+                       strength: Optional[str] = None, start_date: Optional[date] = None,
+                       end_date: Optional[date] = None) -> Optional[schemas.ProductPrices]:
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT m.message_id, c.channel_name, m.message_date, m.raw_json->>'text' as text
-            FROM raw_marts.fct_messages m
-            JOIN raw_marts.dim_channels c ON m.channel_id = c.channel_id
-            WHERE m.raw_json->>'text' ILIKE %s
-            ORDER BY m.message_date DESC
-            LIMIT 50
-        ''', (f'%{query}%',))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return [schemas.MessageSearchResult(
-            message_id=row[0],
-            channel_name=row[1],
-            message_date=str(row[2]),
-            text=row[3]
-        ) for row in rows]
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('product_prices') as stats:
+            cur.execute(*product_prices_query(product, granularity, currency, strength, start_date, end_date))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        return product_prices(product, granularity, currency, strength, rows)
+    except Exception as e:
+        logging.error(f"Error in get_product_prices: {e}")
+        raise
+
+def get_cheapest_channels(product: str, currency: str = 'ETB', strength: Optional[str] = None,
+                          start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          limit: int = 10) -> List[schemas.ChannelPrice]:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('cheapest_channels') as stats:
+            cur.execute(*cheapest_channels_query(product, currency, strength, start_date, end_date, limit))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        return [channel_price(row) for row in rows]
+    except Exception as e:
+        logging.error(f"Error in get_cheapest_channels: {e}")
+        raise
+
+def search_messages(query: str, channel: Optional[str] = None, start_date: Optional[date] = None,
+                    end_date: Optional[date] = None, limit: int = 50, sort: str = 'rank',
+                    after: Optional[str] = None) -> Tuple[List[schemas.MessageSearchResult], Optional[str]]:
+    try:
+        fetch = limit + 1 if sort == 'date' else limit
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('search_messages') as stats:
+            cur.execute(*search_messages_query(query, channel, start_date, end_date, fetch, sort, after))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        rows, next_cursor = page(rows, limit)
+        return [schemas.MessageSearchResult(**message_row(row), rank=row[4]) for row in rows], next_cursor
     except Exception as e:
         logging.error(f"Error in search_messages: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def list_messages(channel: Optional[str] = None, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                  limit: int = 100, after: Optional[str] = None) -> Tuple[List[schemas.Message], Optional[str]]:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('list_messages') as stats:
+            cur.execute(*list_messages_query(channel, start_date, end_date, limit + 1, after))
+            rows = cur.fetchall()
+            stats.rows = len(rows)
+        rows, next_cursor = page(rows, limit)
+        return [schemas.Message(**message_row(row)) for row in rows], next_cursor
+    except Exception as e:
+        logging.error(f"Error in list_messages: {e}")
+        raise
+
+def stream_messages(sql: str, params) -> Iterator[dict]:
+    # Reads through a named (server-side) cursor so only STREAM_FETCH_SIZE
+    # rows are held in memory at a time. The pooled connection stays checked
+    # out until the generator is exhausted or closed.
+    with get_db() as conn, conn.cursor(name='stream_messages') as cur, metrics.track_query('stream_messages') as stats:
+        cur.itersize = STREAM_FETCH_SIZE
+        cur.execute(sql, params)
+        for row in cur:
+            stats.rows += 1
+            yield message_row(row)
+
+def get_pipeline_version() -> int:
+    try:
+        with get_db() as conn, conn.cursor() as cur, metrics.track_query('pipeline_version') as stats:
+            cur.execute(PIPELINE_VERSION_SQL)
+            row = cur.fetchone()
+            stats.rows = 1 if row else 0
+        return row[0] if row else 0
+    except psycopg2.errors.UndefinedTable:
+        # dbt has not run yet
+        return 0
\ No newline at end of file
@@ -1,5 +1,9 @@
 import os
+import time
+import threading
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import extensions, pool as pg_pool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,11 +14,165 @@ DB_NAME = os.getenv('DB_NAME', 'kara')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 
+# 'async' serves the API through asyncpg (src/api/async_crud.py), 'sync'
+# through psycopg2 in Starlette's threadpool (src/api/crud.py).
+API_DB_MODE = os.getenv('API_DB_MODE', 'async')
+
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Seconds a request waits for a free connection before failing.
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# A connection idle in the pool for longer than this many seconds is pinged
+# with SELECT 1 before it is handed out (0 pings on every checkout).
+DB_POOL_PING_IDLE = float(os.getenv('DB_POOL_PING_IDLE', '30'))
+
+PING_SQL = 'SELECT 1'
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DatabasePool:
+    # psycopg2's ThreadedConnectionPool raises as soon as it is exhausted; the
+    # semaphore makes callers queue for a connection instead, which is what
+    # the waiting and checkout latency statistics measure.
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 ping_idle=DB_POOL_PING_IDLE):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_idle = ping_idle
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        # connection: time.monotonic() when it was last returned to the pool
+        self._returned = {}
+
+    def open(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = pg_pool.ThreadedConnectionPool(
+                    self.minconn,
+                    self.maxconn,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD
+                )
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._returned.clear()
+
+    def _ping(self, conn):
+        # The flags below do not notice a connection the server or a proxy
+        # closed while it sat in the pool; only a round trip does.
+        try:
+            with conn.cursor() as cur:
+                cur.execute(PING_SQL)
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _healthy(self, conn):
+        with self._lock:
+            returned = self._returned.pop(conn, None)
+        if conn.closed or conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        # Connections the pool just opened have never been idle.
+        if returned is None or time.monotonic() - returned < self.ping_idle:
+            return True
+        return self._ping(conn)
+
+    def _checkout(self):
+        # Broken connections are discarded until a healthy one comes out of
+        # the pool; once the idle ones run out, the pool opens a new one.
+        while True:
+            conn = self._pool.getconn()
+            if self._healthy(conn):
+                return conn
+            self._pool.putconn(conn, close=True)
+            with self._lock:
+                self._discarded += 1
+
+    def _checkin(self, conn, close):
+        if not close:
+            with self._lock:
+                self._returned[conn] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+
+    @contextmanager
+    def connection(self):
+        if self._pool is None:
+            self.open()
+        started = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._waiting -= 1
+            if acquired:
+                self._in_use += 1
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+        if not acquired:
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+        conn = None
+        broken = False
+        try:
+            conn = self._checkout()
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn, close=broken or conn.closed != 0)
+                if broken:
+                    with self._lock:
+                        self._discarded += 1
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'discarded': self._discarded,
+                'avg_checkout_ms': (self._wait_total / self._checkouts * 1000) if self._checkouts else 0.0,
+                'max_checkout_ms': self._wait_max * 1000,
+            }
+
+
+pool = DatabasePool()
+
+
 def get_db():
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
\ No newline at end of file
+    # Context manager yielding a pooled connection; it is committed and
+    # returned to the pool on exit, or rolled back if the block raises.
+    return pool.connection()
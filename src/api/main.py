@@ -1,20 +1,215 @@
-from fastapi import FastAPI, Query, HTTPException
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query, HTTPException, Request, Response
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
-from src.api import database, schemas, crud
+import json
+from datetime import date
+from src import profiling
+from src.api import database, metrics, schemas, crud
+from src.api.cache import response_cache
+
+ASYNC_MODE = database.API_DB_MODE == 'async'
+if ASYNC_MODE:
+    from src.api import async_crud, async_database
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if ASYNC_MODE:
+        await async_database.pool.open()
+        app.state.db_pool = async_database.pool
+    else:
+        database.pool.open()
+        app.state.db_pool = database.pool
+    # With PROFILE=1 the event loop is sampled until shutdown.
+    with profiling.profiled('api'):
+        yield
+    if ASYNC_MODE:
+        await async_database.pool.close()
+    else:
+        database.pool.close()
+
+
+app = FastAPI(title="Kara Analytical API", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Routes are labelled by their path template so path parameters do not
+    # create new series. Streamed responses are timed to their headers; the
+    # stream itself shows up in the stream_messages query time.
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        metrics.observe_request(request.method, getattr(route, 'path', 'unmatched'), status,
+                                time.perf_counter() - started)
+
+
+async def cached(key, compute):
+    # Serves key from the response cache, checking the pipeline version stamp
+    # at most every API_CACHE_VERSION_INTERVAL seconds.
+    if response_cache.version_is_stale():
+        if ASYNC_MODE:
+            version = await async_crud.get_pipeline_version()
+        else:
+            version = await run_in_threadpool(crud.get_pipeline_version)
+        response_cache.set_version(version)
+    version = response_cache.version
+    hit, value = response_cache.get(key)
+    if not hit:
+        value = await compute()
+        response_cache.put(key, value, version)
+    return value
 
-app = FastAPI(title="Kara Analytical API")
 
 @app.get("/api/reports/top-products", response_model=List[schemas.TopProduct])
-def get_top_products(limit: int = 10):
-    return crud.get_top_products(limit)
+async def get_top_products(limit: int = 10, channel: Optional[str] = None,
+                           start_date: Optional[date] = None, end_date: Optional[date] = None):
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_top_products(limit, channel, start_date, end_date)
+        return await run_in_threadpool(crud.get_top_products, limit, channel, start_date, end_date)
+    return await cached(('top-products', limit, channel, start_date, end_date), compute)
 
 @app.get("/api/channels/{channel_name}/activity", response_model=schemas.ChannelActivity)
-def get_channel_activity(channel_name: str):
-    result = crud.get_channel_activity(channel_name)
+async def get_channel_activity(channel_name: str, granularity: str = Query('day', pattern='^(hour|day|week|month)$'),
+                               start_date: Optional[date] = None, end_date: Optional[date] = None):
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_channel_activity(channel_name, granularity, start_date, end_date)
+        return await run_in_threadpool(crud.get_channel_activity, channel_name, granularity, start_date, end_date)
+    result = await cached(('channel-activity', channel_name, granularity, start_date, end_date), compute)
     if not result:
         raise HTTPException(status_code=404, detail="Channel not found or no activity.")
     return result
 
+@app.get("/api/reports/reposts", response_model=List[schemas.RepostGroup])
+async def get_reposts(limit: int = Query(20, ge=1, le=200), min_posts: int = Query(2, ge=1),
+                      channel: Optional[str] = None):
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_reposts(limit, min_posts, channel)
+        return await run_in_threadpool(crud.get_reposts, limit, min_posts, channel)
+    return await cached(('reposts', limit, min_posts, channel), compute)
+
+# Product names are the canonical names from the loader's product dictionary
+# (src/loader/product_dictionary.txt); prices are compared within one
+# currency.
+@app.get("/api/products/{product}", response_model=schemas.ProductSummary)
+async def get_product_summary(product: str, currency: str = Query('ETB', pattern='^(ETB|USD)$'),
+                              start_date: Optional[date] = None, end_date: Optional[date] = None):
+    product = crud.normalize_product(product)
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_product_summary(product, currency, start_date, end_date)
+        return await run_in_threadpool(crud.get_product_summary, product, currency, start_date, end_date)
+    result = await cached(('product', product, currency, start_date, end_date), compute)
+    if not result:
+        raise HTTPException(status_code=404, detail="Product not found.")
+    return result
+
+@app.get("/api/products/{product}/prices", response_model=schemas.ProductPrices)
+async def get_product_prices(product: str, granularity: str = Query('week', pattern='^(day|week|month)$'),
+                             currency: str = Query('ETB', pattern='^(ETB|USD)$'), strength: Optional[str] = None,
+                             start_date: Optional[date] = None, end_date: Optional[date] = None):
+    product = crud.normalize_product(product)
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_product_prices(product, granularity, currency, strength, start_date,
+                                                       end_date)
+        return await run_in_threadpool(crud.get_product_prices, product, granularity, currency, strength,
+                                       start_date, end_date)
+    result = await cached(('product-prices', product, granularity, currency, strength, start_date, end_date),
+                          compute)
+    if not result:
+        raise HTTPException(status_code=404, detail="No prices found for this product.")
+    return result
+
+@app.get("/api/products/{product}/cheapest-channels", response_model=List[schemas.ChannelPrice])
+async def get_cheapest_channels(product: str, currency: str = Query('ETB', pattern='^(ETB|USD)$'),
+                                strength: Optional[str] = None, start_date: Optional[date] = None,
+                                end_date: Optional[date] = None, limit: int = Query(10, ge=1, le=100)):
+    product = crud.normalize_product(product)
+    async def compute():
+        if ASYNC_MODE:
+            return await async_crud.get_cheapest_channels(product, currency, strength, start_date, end_date, limit)
+        return await run_in_threadpool(crud.get_cheapest_channels, product, currency, strength, start_date,
+                                       end_date, limit)
+    return await cached(('cheapest-channels', product, currency, strength, start_date, end_date, limit), compute)
+
+def check_cursor(cursor: Optional[str]):
+    if cursor:
+        try:
+            crud.decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def ndjson_response(sql: str, params) -> StreamingResponse:
+    if ASYNC_MODE:
+        rows = async_crud.stream_messages(sql, params)
+    else:
+        rows = iterate_in_threadpool(crud.stream_messages(sql, params))
+    async def lines():
+        async for row in rows:
+            yield json.dumps(row) + '\n'
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+# Paged responses return the cursor for the next page in X-Next-Cursor; the
+# header is omitted on the last page. format=ndjson streams every matching row
+# (from cursor onwards) and ignores limit.
 @app.get("/api/search/messages", response_model=List[schemas.MessageSearchResult])
-def search_messages(query: str = Query(..., min_length=1)):
-    return crud.search_messages(query)
\ No newline at end of file
+async def search_messages(response: Response, query: str = Query(..., min_length=1), channel: Optional[str] = None,
+                          start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          limit: int = Query(50, ge=1, le=200), sort: str = Query('rank', pattern='^(rank|date)$'),
+                          cursor: Optional[str] = None, format: str = Query('json', pattern='^(json|ndjson)$')):
+    if cursor and sort != 'date':
+        raise HTTPException(status_code=400, detail="cursor requires sort=date.")
+    check_cursor(cursor)
+    if format == 'ndjson':
+        return ndjson_response(*crud.search_messages_query(query, channel, start_date, end_date, None, sort, cursor))
+    if ASYNC_MODE:
+        results, next_cursor = await async_crud.search_messages(query, channel, start_date, end_date, limit, sort, cursor)
+    else:
+        results, next_cursor = await run_in_threadpool(
+            crud.search_messages, query, channel, start_date, end_date, limit, sort, cursor)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return results
+
+@app.get("/api/messages", response_model=List[schemas.Message])
+async def list_messages(response: Response, channel: Optional[str] = None,
+                        start_date: Optional[date] = None, end_date: Optional[date] = None,
+                        limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                        format: str = Query('json', pattern='^(json|ndjson)$')):
+    check_cursor(cursor)
+    if format == 'ndjson':
+        return ndjson_response(*crud.list_messages_query(channel, start_date, end_date, None, cursor))
+    if ASYNC_MODE:
+        results, next_cursor = await async_crud.list_messages(channel, start_date, end_date, limit, cursor)
+    else:
+        results, next_cursor = await run_in_threadpool(crud.list_messages, channel, start_date, end_date, limit, cursor)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return results
+
+@app.get("/api/health/db", response_model=schemas.PoolStats)
+def get_db_pool_stats():
+    return app.state.db_pool.stats()
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(
+        metrics.render(app.state.db_pool.stats(), response_cache.stats()),
+        media_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+@app.get("/api/health/cache", response_model=schemas.CacheStats)
+def get_cache_stats():
+    return response_cache.stats()
\ No newline at end of file
@@ -0,0 +1,137 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Prometheus metrics for the API, served in the text exposition format at
+# /metrics. Kept in-process like the response cache: a histogram is a set of
+# bucket counters per label combination, cumulated when rendered.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then the sum.
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                labels = format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {values[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'kara_http_request_duration_seconds', 'Time to the response headers by route.',
+    ('method', 'route', 'status'), LATENCY_BUCKETS
+)
+QUERY_SECONDS = Histogram(
+    'kara_db_query_duration_seconds', 'Time executing and fetching a query (pool wait excluded).',
+    ('query',), LATENCY_BUCKETS
+)
+QUERY_ROWS = Histogram('kara_db_query_rows', 'Rows returned per query.', ('query',), ROW_BUCKETS)
+QUERY_ERRORS = Counter('kara_db_query_errors_total', 'Queries that raised.', ('query',))
+
+
+class QueryStats:
+    def __init__(self):
+        self.rows = 0
+
+
+@contextmanager
+def track_query(name):
+    # The caller sets .rows on the yielded object once it has fetched them.
+    stats = QueryStats()
+    started = time.perf_counter()
+    try:
+        yield stats
+    except Exception:
+        QUERY_ERRORS.inc(name)
+        raise
+    finally:
+        QUERY_SECONDS.observe(time.perf_counter() - started, name)
+        QUERY_ROWS.observe(stats.rows, name)
+
+def observe_request(method, route, status, seconds):
+    REQUEST_SECONDS.observe(seconds, method, route, str(status))
+
+def stat_lines(prefix, documentation, stats, counters=()):
+    # Renders a stats() dict (pool or cache) as gauges, or counters for the
+    # keys in counters; non-numeric entries are skipped.
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f'{prefix}_{key}'
+        kind = 'counter' if key in counters else 'gauge'
+        if kind == 'counter':
+            name += '_total'
+        lines += [f'# HELP {name} {documentation} {key}.', f'# TYPE {name} {kind}', f'{name} {value}']
+    return lines
+
+def render(pool_stats=None, cache_stats=None):
+    lines = []
+    for metric in (REQUEST_SECONDS, QUERY_SECONDS, QUERY_ROWS, QUERY_ERRORS):
+        lines += metric.render()
+    if pool_stats:
+        lines += stat_lines('kara_db_pool', 'Database pool', pool_stats, ('checkouts', 'discarded'))
+    if cache_stats:
+        lines += stat_lines('kara_response_cache', 'Response cache', cache_stats,
+                            ('hits', 'misses', 'evictions', 'invalidations'))
+    return '\n'.join(lines) + '\n'
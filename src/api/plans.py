@@ -0,0 +1,183 @@
+import os
+import re
+import sys
+import logging
+from datetime import date
+
+from src.api import crud
+from src.api.database import get_db, pool
+
+# Checks that the API's queries are served by the marts' indexes (see
+# dbt_project/macros/physical_design.sql). Each query built by crud.py is
+# EXPLAINed with sequential scans disabled: the planner then only scans a
+# mart sequentially when no index can serve the query. A plain EXPLAIN would
+# not tell, since the planner rightly prefers sequential scans on the small
+# tables of a development database.
+#
+# Any index scan is not enough either: a full scan of an unrelated index
+# also avoids the sequential scan. Each query names in PLAN_EXPECTATIONS the
+# index it is meant to use, by relation and leading key columns, and the
+# column that index filters on. The plan must scan that index with an Index
+# Cond (or, under a bitmap heap scan, a Recheck Cond) on the column. Queries
+# served by the index order alone (column None) must use a plain index scan
+# of it, which is checked with sorts disabled too, as a sort is cheaper than
+# an ordered scan of a small table.
+#
+#   python -m src.api.plans     # exits with status 1 if a query misses its index
+#
+# Queries that aggregate a whole mart by design (reposts across all
+# channels) are not checked.
+
+PLAN_CHANNEL = os.getenv('PLAN_CHANNEL', 'tikvahpharma')
+PLAN_PRODUCT = os.getenv('PLAN_PRODUCT', 'paracetamol')
+PLAN_START_DATE = date(2025, 7, 1)
+PLAN_END_DATE = date(2025, 7, 31)
+MARTS_SCHEMA = 'raw_marts'
+
+EXPLAIN_SQL = 'EXPLAIN (FORMAT JSON) '
+
+# query name: (relation, leading index columns, filtered column or None)
+PLAN_EXPECTATIONS = {
+    'top_products': ('fct_term_totals', ['total'], None),
+    'top_products_by_channel': ('fct_term_counts', ['channel_name'], 'channel_name'),
+    'channel_activity': ('fct_channel_activity', ['channel_name'], 'channel_name'),
+    'search_messages': ('fct_messages', ['search_vector'], 'search_vector'),
+    'search_messages_by_date': ('fct_messages', ['channel_id'], 'channel_id'),
+    'list_messages': ('fct_messages', ['message_date', 'message_id'], None),
+    'list_messages_by_channel': ('fct_messages', ['channel_id'], 'channel_id'),
+    'list_messages_by_date': ('fct_messages', ['message_date'], 'message_date'),
+    'reposts_by_channel': ('fct_image_reposts', ['channel_name'], 'channel_name'),
+    'product_summary': ('fct_product_mentions', ['product'], 'product'),
+    'product_prices': ('fct_product_mentions', ['product'], 'product'),
+    'cheapest_channels': ('fct_product_mentions', ['product'], 'product'),
+}
+
+# Key columns of every index on a mart (expression keys are NULL).
+INDEX_COLUMNS_SQL = """
+SELECT t.relname, i.relname, array_agg(a.attname ORDER BY k.position)
+FROM pg_index ix
+JOIN pg_class i ON i.oid = ix.indexrelid
+JOIN pg_class t ON t.oid = ix.indrelid
+JOIN pg_namespace n ON n.oid = t.relnamespace
+CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, position)
+LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+WHERE n.nspname = %s
+GROUP BY t.relname, i.relname
+"""
+
+ORDERED_SCANS = ('Index Scan', 'Index Only Scan')
+
+
+def plan_queries(channel=PLAN_CHANNEL, product=PLAN_PRODUCT, start_date=PLAN_START_DATE, end_date=PLAN_END_DATE):
+    return {
+        'top_products': crud.top_products_query(10),
+        'top_products_by_channel': crud.top_products_query(10, channel),
+        'channel_activity': crud.channel_activity_query(channel, 'day', start_date, end_date),
+        'search_messages': crud.search_messages_query(product, limit=20),
+        'search_messages_by_date': crud.search_messages_query(product, channel, limit=20, sort='date'),
+        'list_messages': crud.list_messages_query(limit=100),
+        'list_messages_by_channel': crud.list_messages_query(channel, limit=100),
+        'list_messages_by_date': crud.list_messages_query(start_date=start_date, end_date=end_date, limit=100),
+        'reposts_by_channel': crud.reposts_query(20, 2, channel),
+        'product_summary': crud.product_summary_query(product),
+        'product_prices': crud.product_prices_query(product, 'week'),
+        'cheapest_channels': crud.cheapest_channels_query(product),
+    }
+
+def plan_nodes(node, parent=None):
+    # (node, parent node) for every node of the plan.
+    yield node, parent
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child, node)
+
+def scans(plan):
+    # (node type, relation, index) for every node that reads a table or an
+    # index; bitmap index scans have no relation.
+    return [
+        (node['Node Type'], node.get('Relation Name'), node.get('Index Name'))
+        for node, _ in plan_nodes(plan)
+        if 'Relation Name' in node or 'Index Name' in node
+    ]
+
+def describe(scan):
+    kind, relation, index = scan
+    return kind + (f' on {relation}' if relation else '') + (f' using {index}' if index else '')
+
+def index_names(cur, schema, relation, columns):
+    # Names of the indexes on relation whose keys start with columns.
+    cur.execute(INDEX_COLUMNS_SQL, (schema,))
+    return {
+        index for table, index, keys in cur.fetchall()
+        if table == relation and keys[:len(columns)] == columns
+    }
+
+def filters_on(node, parent, column):
+    # Whether the index scan node's condition, or the recheck condition of
+    # the bitmap heap scan above it, compares column.
+    pattern = re.compile(rf'\b{re.escape(column)}\b')
+    conditions = [node.get('Index Cond'), (parent or {}).get('Recheck Cond')]
+    return any(condition and pattern.search(condition) for condition in conditions)
+
+def uses_index(plan, indexes, column):
+    for node, parent in plan_nodes(plan):
+        if node.get('Index Name') not in indexes:
+            continue
+        if column is None and node['Node Type'] in ORDERED_SCANS:
+            return True
+        if column is not None and filters_on(node, parent, column):
+            return True
+    return False
+
+def explain(cur, sql, params, ordered=False):
+    cur.execute('SET LOCAL enable_seqscan = off')
+    if ordered:
+        cur.execute('SET LOCAL enable_sort = off')
+    cur.execute(EXPLAIN_SQL + sql, params)
+    plan = cur.fetchone()[0][0]['Plan']
+    # The settings are local to the transaction; roll them back so the next
+    # query is planned with only its own.
+    cur.connection.rollback()
+    return plan
+
+def check_plans(queries, expectations=PLAN_EXPECTATIONS, schema=MARTS_SCHEMA):
+    # Returns {query name: [(node type, relation, index)]} for the queries
+    # that scan a mart sequentially or miss their expected index.
+    failures = {}
+    with get_db() as conn, conn.cursor() as cur:
+        for name, (sql, params) in queries.items():
+            relation, columns, column = expectations[name]
+            indexes = index_names(cur, schema, relation, columns)
+            plan = explain(cur, sql, params, ordered=column is None)
+            read = scans(plan)
+            used = ', '.join(describe(scan) for scan in read)
+            expected = f"{relation} ({', '.join(columns)})" + (f' on {column}' if column else ' in order')
+            if any(kind == 'Seq Scan' for kind, _, _ in read):
+                failures[name] = read
+                logging.error(f'{name}: scans a mart sequentially: {used}')
+            elif not indexes:
+                failures[name] = read
+                logging.error(f'{name}: no index on {relation} ({", ".join(columns)})')
+            elif not uses_index(plan, indexes, column):
+                failures[name] = read
+                logging.error(f'{name}: expected {expected}, got {used}')
+            else:
+                logging.info(f'{name}: {used}')
+    return failures
+
+def main(argv):
+    names = argv or None
+    queries = plan_queries()
+    unknown = set(names or []) - set(queries)
+    if unknown:
+        raise SystemExit(f"Unknown queries: {', '.join(sorted(unknown))} (choose from {', '.join(queries)})")
+    try:
+        failures = check_plans({name: query for name, query in queries.items() if not names or name in names})
+    finally:
+        pool.close()
+    if failures:
+        logging.error(f"{len(failures)} queries miss their index: {', '.join(failures)}")
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
@@ -5,13 +5,97 @@ class TopProduct(BaseModel):
     product: str
     count: int
 
+class ActivityPeriod(BaseModel):
+    period_start: str
+    message_count: int
+    image_count: int
+    total_views: int
+    avg_views: Optional[float] = None
+    total_forwards: int
+    avg_forwards: Optional[float] = None
+
 class ChannelActivity(BaseModel):
     channel_name: str
+    granularity: str
     total_messages: int
-    messages_per_day: List[dict]
+    periods: List[ActivityPeriod]
+
+class RepostGroup(BaseModel):
+    group_hash: str
+    image_path: str
+    post_count: int
+    channel_count: int
+    channels: List[str]
+    first_seen: str
+    last_seen: str
+
+class ProductSummary(BaseModel):
+    product: str
+    mention_count: int
+    channel_count: int
+    first_seen: str
+    last_seen: str
+    strengths: List[str]
+    currency: str
+    price_count: int
+    min_price: Optional[float] = None
+    avg_price: Optional[float] = None
+    max_price: Optional[float] = None
+
+class PricePeriod(BaseModel):
+    period_start: str
+    price_count: int
+    channel_count: int
+    min_price: float
+    avg_price: float
+    max_price: float
+
+class ProductPrices(BaseModel):
+    product: str
+    granularity: str
+    currency: str
+    strength: Optional[str] = None
+    periods: List[PricePeriod]
+
+class ChannelPrice(BaseModel):
+    channel_name: str
+    price: float
+    currency: str
+    strength: Optional[str] = None
+    message_id: int
+    message_date: str
+
+class Message(BaseModel):
+    message_id: int
+    channel_name: str
+    message_date: str
+    text: Optional[str] = None
 
 class MessageSearchResult(BaseModel):
     message_id: int
     channel_name: str
     message_date: str
-    text: str
\ No newline at end of file
+    text: str
+    rank: float = 0.0
+
+class PoolStats(BaseModel):
+    min_size: int
+    max_size: int
+    in_use: int
+    waiting: int
+    checkouts: int
+    discarded: int
+    avg_checkout_ms: float
+    max_checkout_ms: float
+
+
+
+class CacheStats(BaseModel):
+    size: int
+    max_size: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    pipeline_version: Optional[int] = None
\ No newline at end of file
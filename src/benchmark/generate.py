@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import random
+import logging
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.loader import lake
+
+# Synthetic data lake for benchmarks. Writes <root>/YYYY-MM-DD/<channel>/
+# <id>.json (or a compact partition file, see src/loader/lake.py) and
+# <id>.jpg files shaped like the Telethon exports of tikvahpharma and
+# lobelia4cosmetics: the same message fields, price-list style texts, and
+# photo messages with a JPEG next to them. Output is reproducible for a
+# given seed.
+#
+#   python -m src.benchmark.generate /tmp/bench_lake
+
+BENCH_CHANNELS = [name.strip() for name in os.getenv('BENCH_CHANNELS', 'tikvahpharma,lobelia4cosmetics').split(',')
+                  if name.strip()]
+BENCH_DAYS = int(os.getenv('BENCH_DAYS', '7'))
+BENCH_MESSAGES_PER_DAY = int(os.getenv('BENCH_MESSAGES_PER_DAY', '500'))
+# Share of messages that carry a photo.
+BENCH_IMAGE_RATIO = float(os.getenv('BENCH_IMAGE_RATIO', '0.3'))
+BENCH_IMAGE_SIZE = int(os.getenv('BENCH_IMAGE_SIZE', '640'))
+BENCH_START_DATE = os.getenv('BENCH_START_DATE', '2025-01-01')
+BENCH_SEED = int(os.getenv('BENCH_SEED', '42'))
+# 'json' or 'compact', like SCRAPE_LAKE_FORMAT.
+BENCH_LAKE_FORMAT = os.getenv('BENCH_LAKE_FORMAT', 'json')
+
+DRUGS = [
+    'Amoxicillin', 'Ceftriaxone', 'Ibuprofen', 'Paracetamol', 'Metformin', 'Amlodipine', 'Losartan',
+    'Azithromycin', 'Ciprofloxacin', 'Omeprazole', 'Metronidazole', 'Albendazole', 'Atorvastatin',
+    'Diclofenac', 'Clotrimazole', 'Furosemide', 'Vitamin D', 'Folic acid', 'Salbutamol', 'Fluconazole',
+]
+FORMS = ['tab', 'cap', 'syrup 100ml', 'inj', 'cream 15gm', 'susp', 'eye drop 5ml', '10x10', '3x10']
+STRENGTHS = ['5mg', '20mg', '40mg', '250mg', '400mg', '500mg', '625mg', '1g', '50,000 iu', '120mg/5ml']
+COSMETICS = [
+    'LIQUID MULTIVITAMIN 650ML', 'GLUCERNA LIQUID', 'CERAVE MOISTURIZING CREAM', 'NIVEA BODY LOTION',
+    'VASELINE PETROLEUM JELLY', 'THE ORDINARY NIACINAMIDE', 'SUNSCREEN SPF 50', 'BABY DIAPER SIZE 3',
+]
+FOOTER = (
+    '\nTelegram @{channel}\nMsg👉 {channel} pharmacy and cosmetics\n'
+    '☎️ call 09115{phone}\nOpen Monday - Monday from 8am until midnight'
+)
+
+
+def price_list_text(rng):
+    lines = ['🏩 PHARMA IMPORT', '', 'NEW ARRIVAL', '']
+    for _ in range(rng.randint(1, 30)):
+        price = rng.choice([rng.randint(10, 3000), round(rng.uniform(10, 500), 2)])
+        unit = rng.choice(['birr', ' birr', ''])
+        lines.append(f'✅{rng.choice(DRUGS)} {rng.choice(STRENGTHS)} {rng.choice(FORMS)} 💵{price}{unit}')
+    lines.append('\n🚒Free and Fast delivery')
+    return '\n'.join(lines)
+
+def product_text(rng, channel):
+    text = f'{rng.choice(COSMETICS)}\nPrice {rng.randint(1, 80) * 100} birr '
+    return text + FOOTER.format(channel=channel, phone=rng.randint(10000, 99999))
+
+def message_text(rng, channel):
+    return price_list_text(rng) if rng.random() < 0.5 else product_text(rng, channel)
+
+def photo_media(rng, photo_id, date, size):
+    return {
+        '_': 'MessageMediaPhoto',
+        'spoiler': False,
+        'photo': {
+            '_': 'Photo',
+            'id': photo_id,
+            'access_hash': rng.getrandbits(63),
+            'file_reference': "b'\\x00'",
+            'date': date,
+            'sizes': [
+                {'_': 'PhotoSize', 'type': 'm', 'w': 320, 'h': 320, 'size': 16000},
+                {'_': 'PhotoSize', 'type': 'x', 'w': size, 'h': size, 'size': 52000},
+            ],
+            'dc_id': 4,
+            'has_stickers': False,
+            'video_sizes': [],
+        },
+        'ttl_seconds': None,
+    }
+
+def message_dict(rng, message_id, channel_id, date, text, media):
+    # Same fields, in the same order, as Message.to_dict() in the real exports.
+    date = date.isoformat(sep=' ')
+    return {
+        '_': 'Message',
+        'id': message_id,
+        'peer_id': {'_': 'PeerChannel', 'channel_id': channel_id},
+        'date': date,
+        'message': text,
+        'out': False, 'mentioned': False, 'media_unread': False, 'silent': False, 'post': True,
+        'from_scheduled': False, 'legacy': False, 'edit_hide': False, 'pinned': False,
+        'noforwards': False, 'invert_media': False, 'offline': False, 'video_processing_pending': False,
+        'from_id': None, 'from_boosts_applied': None, 'saved_peer_id': None, 'fwd_from': None,
+        'via_bot_id': None, 'via_business_bot_id': None, 'reply_to': None,
+        'media': photo_media(rng, rng.getrandbits(62), date, BENCH_IMAGE_SIZE) if media else None,
+        'reply_markup': None, 'entities': [],
+        'views': rng.randint(50, 5000),
+        'forwards': rng.randint(0, 40),
+        'replies': None, 'edit_date': None, 'post_author': None, 'grouped_id': None, 'reactions': None,
+        'restriction_reason': [], 'ttl_period': None, 'quick_reply_shortcut_id': None, 'effect': None,
+        'factcheck': None, 'report_delivery_until_date': None, 'paid_message_stars': None,
+    }
+
+def product_image(np_rng, size=BENCH_IMAGE_SIZE):
+    # A noisy background with a few boxes, discs and a caption: cheap to
+    # generate, but not trivially compressible, so JPEG sizes and decode
+    # times are close to real product photos.
+    image = np_rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (0, 0), 3)
+    for _ in range(int(np_rng.integers(1, 5))):
+        x, y = (int(v) for v in np_rng.integers(0, size, 2))
+        w, h = (int(v) for v in np_rng.integers(size // 10, size // 2, 2))
+        color = tuple(int(c) for c in np_rng.integers(0, 255, 3))
+        if np_rng.random() < 0.5:
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, -1)
+        else:
+            cv2.circle(image, (x, y), w // 2, color, -1)
+    cv2.putText(image, 'KARA', (size // 8, size // 2), cv2.FONT_HERSHEY_SIMPLEX, size / 200, (255, 255, 255), 3)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if not ok:
+        raise RuntimeError('could not encode JPEG')
+    return encoded.tobytes()
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4, default=str)
+
+def generate(root, channels=None, days=BENCH_DAYS, messages_per_day=BENCH_MESSAGES_PER_DAY,
+             image_ratio=BENCH_IMAGE_RATIO, start_date=BENCH_START_DATE, seed=BENCH_SEED,
+             lake_format=BENCH_LAKE_FORMAT):
+    # Returns {'messages': n, 'images': n, 'bytes': n} for what was written.
+    root = Path(root)
+    channels = channels or BENCH_CHANNELS
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    start = datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc)
+    stats = {'messages': 0, 'images': 0, 'bytes': 0}
+    for channel_index, channel in enumerate(channels):
+        channel_id = 1_500_000_000 + rng.randint(0, 99_999_999)
+        message_id = 10_000 * (channel_index + 1)
+        for day in range(days):
+            day_start = start + timedelta(days=day)
+            output_dir = root / day_start.strftime('%Y-%m-%d') / channel
+            output_dir.mkdir(parents=True, exist_ok=True)
+            seconds = sorted(rng.randrange(86_400) for _ in range(messages_per_day))
+            compact = []
+            for second in seconds:
+                message_id += 1
+                has_photo = rng.random() < image_ratio
+                data = message_dict(
+                    rng, message_id, channel_id, day_start + timedelta(seconds=second),
+                    message_text(rng, channel), has_photo
+                )
+                if has_photo:
+                    image = product_image(np_rng)
+                    (output_dir / f'{message_id}.jpg').write_bytes(image)
+                    stats['images'] += 1
+                    stats['bytes'] += len(image)
+                if lake_format == 'compact':
+                    compact.append((message_id, lake.encode_message(data)))
+                else:
+                    write_json(output_dir / f'{message_id}.json', data)
+                stats['messages'] += 1
+            if compact:
+                lake.append_messages(output_dir, compact)
+        logging.info(f'Generated {days} days of {channel}')
+    stats['bytes'] += sum(p.stat().st_size for p in root.glob('*/*/*') if p.suffix != '.jpg')
+    return stats
+
+def main(argv):
+    if not argv:
+        raise SystemExit('usage: python -m src.benchmark.generate <root>')
+    stats = generate(argv[0])
+    logging.info(f"Generated {stats['messages']} messages and {stats['images']} images "
+                 f"({stats['bytes'] / 1e6:.1f} MB) in {argv[0]}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
@@ -0,0 +1,447 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
+
+from dotenv import load_dotenv
+
+from src.benchmark import generate
+from src.loader import load_to_pg, manifest, products, runs
+from src.loader.parse import create_pool
+
+# End-to-end benchmarks against a local Postgres and a running API:
+#
+#   loader   rows/sec loading a synthetic lake, per LOAD_MODE
+#   enrich   images/sec running detection on its images
+#   api      p50/p95/p99 latency and requests/sec per endpoint under
+#            concurrent load (start the API with API_CACHE_MAXSIZE=0 to
+#            measure the database path rather than the response cache)
+#   backends images/sec of each inference backend on the raw lake's images,
+#            and how closely their detections match the torch backend's
+#
+# The synthetic lake (see generate.py) is loaded under bench_<channel>
+# names, with the manifests bypassed, and its rows, detections, cache and
+# manifest entries are deleted afterwards. Results are written as JSON to
+# BENCH_RESULTS_PATH and compared with the previous result of the same
+# configuration (or BENCH_BASELINE); metrics that got worse by more than
+# BENCH_REGRESSION_THRESHOLD are flagged and the run exits with status 1.
+#
+#   python -m src.benchmark.run                  # all suites
+#   python -m src.benchmark.run loader api
+
+load_dotenv()
+
+BENCH_CHANNEL_PREFIX = 'bench_'
+# Reuse a lake generated earlier (python -m src.benchmark.generate <path>
+# with BENCH_CHANNELS=bench_...); by default one is generated in a
+# temporary directory and removed afterwards.
+BENCH_DATA_PATH = os.getenv('BENCH_DATA_PATH')
+BENCH_LOAD_MODES = [mode.strip() for mode in os.getenv('BENCH_LOAD_MODES', 'bulk').split(',') if mode.strip()]
+BENCH_API_URL = os.getenv('BENCH_API_URL', 'http://localhost:8000')
+BENCH_API_CHANNEL = os.getenv('BENCH_API_CHANNEL', 'tikvahpharma')
+BENCH_API_CONCURRENCY = int(os.getenv('BENCH_API_CONCURRENCY', '16'))
+# Measured requests per endpoint, after the warmup ones.
+BENCH_API_REQUESTS = int(os.getenv('BENCH_API_REQUESTS', '200'))
+BENCH_API_WARMUP = int(os.getenv('BENCH_API_WARMUP', '10'))
+BENCH_API_TIMEOUT = float(os.getenv('BENCH_API_TIMEOUT', '30'))
+
+# Inference backends to compare: torch, onnx and onnx-int8. Their
+# detections are compared with the first one's.
+BENCH_BACKENDS = [name.strip() for name in os.getenv('BENCH_BACKENDS', 'torch,onnx,onnx-int8').split(',') if name.strip()]
+# Images from the raw lake per backend (0 = all).
+BENCH_BACKEND_IMAGES = int(os.getenv('BENCH_BACKEND_IMAGES', '0'))
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+BENCH_RESULTS_PATH = Path(os.getenv('BENCH_RESULTS_PATH', PROJECT_ROOT / 'benchmarks' / 'results'))
+BENCH_BASELINE = os.getenv('BENCH_BASELINE')
+BENCH_REGRESSION_THRESHOLD = float(os.getenv('BENCH_REGRESSION_THRESHOLD', '0.10'))
+
+SUITES = ('loader', 'enrich', 'api', 'backends')
+
+PRODUCTS = ['amoxicillin', 'paracetamol', 'metformin', 'multivitamin']
+SEARCH_TERMS = ['paracetamol', 'amoxicillin', 'vitamin', 'cream', 'syrup', 'price', 'tab', 'birr']
+
+# Each endpoint cycles through its URLs, so cached deployments see a mix of
+# keys rather than one hot entry.
+API_ENDPOINTS = {
+    'top_products': ['/api/reports/top-products?limit={limit}'.format(limit=n) for n in (10, 20, 50)],
+    'channel_activity': [
+        f'/api/channels/{{channel}}/activity?granularity={granularity}'
+        for granularity in ('hour', 'day', 'week', 'month')
+    ],
+    'search_messages': [f'/api/search/messages?query={quote(term)}&limit=20' for term in SEARCH_TERMS],
+    'search_messages_by_date': [
+        f'/api/search/messages?query={quote(term)}&sort=date&limit=20' for term in SEARCH_TERMS
+    ],
+    'list_messages': ['/api/messages?limit=100', '/api/messages?channel={channel}&limit=100'],
+    'product_summary': [f'/api/products/{quote(product)}' for product in PRODUCTS],
+    'product_prices': [f'/api/products/{quote(product)}/prices?granularity=week' for product in PRODUCTS],
+    'cheapest_channels': [f'/api/products/{quote(product)}/cheapest-channels' for product in PRODUCTS],
+}
+
+DELETE_MESSAGES_SQL = """
+DELETE FROM raw.telegram_messages WHERE channel_name = ANY(%s)
+"""
+
+DELETE_MENTIONS_SQL = """
+DELETE FROM raw.product_mentions WHERE channel_name = ANY(%s)
+"""
+
+# The deleted images are queued so fct_image_detections drops them too.
+DELETE_DETECTIONS_SQL = """
+WITH deleted AS (
+    DELETE FROM raw.image_detections WHERE starts_with(image_path, %s) RETURNING image_path
+)
+INSERT INTO raw.image_detection_changes (image_path)
+SELECT DISTINCT image_path FROM deleted
+"""
+
+DELETE_PHASHES_SQL = """
+DELETE FROM raw.image_phashes WHERE starts_with(image_path, %s)
+"""
+
+DELETE_CACHE_SQL = """
+DELETE FROM raw.detection_cache WHERE content_hash = ANY(%s)
+"""
+
+DELETE_MANIFEST_SQL = """
+DELETE FROM raw.file_manifest WHERE split_part(partition_path, '/', 2) = ANY(%s);
+DELETE FROM raw.partition_manifest WHERE split_part(partition_path, '/', 2) = ANY(%s);
+"""
+
+
+def bench_channels():
+    return [BENCH_CHANNEL_PREFIX + name for name in generate.BENCH_CHANNELS]
+
+def partition_dirs(root, channel):
+    return sorted(path for path in Path(root).glob(f'*/{channel}') if path.is_dir())
+
+def delete_loaded(conn, channels):
+    with conn.cursor() as cur:
+        manifest.ensure_manifest_tables(cur)
+        products.ensure_mentions_table(cur)
+        cur.execute(DELETE_MESSAGES_SQL, (channels,))
+        cur.execute(DELETE_MENTIONS_SQL, (channels,))
+        cur.execute(DELETE_MANIFEST_SQL, (channels, channels))
+    conn.commit()
+
+def delete_enriched(conn, root, channels):
+    # The cache entries go too, so every image goes through inference on the
+    # next run.
+    digests = [manifest.content_hash(path.read_bytes()) for path in Path(root).glob('*/*/*.jpg')]
+    with conn.cursor() as cur:
+        cur.execute(DELETE_DETECTIONS_SQL, (str(root),))
+        cur.execute(DELETE_PHASHES_SQL, (str(root),))
+        cur.execute(DELETE_CACHE_SQL, (digests,))
+        cur.execute(DELETE_MANIFEST_SQL, (channels, channels))
+    conn.commit()
+
+def bench_loader(root, channels, modes=BENCH_LOAD_MODES):
+    metrics = {}
+    pool = create_pool(load_to_pg.LOAD_WORKERS)
+    try:
+        for mode in modes:
+            conn = load_to_pg.get_connection()
+            try:
+                conn.autocommit = mode != 'bulk'
+                _, existing = load_to_pg.prepare(conn, mode)
+                # Every mode starts from an empty table, so all of them
+                # measure inserts rather than upserts of existing rows.
+                delete_loaded(conn, channels)
+                rows = failed = 0
+                timer = runs.StageTimer()
+                started = time.perf_counter()
+                for channel in channels:
+                    loaded, bad = load_to_pg.load_partitions(
+                        conn, channel, partition_dirs(root, channel), existing, mode,
+                        pool=pool, full_rescan=True, root=root, timer=timer
+                    )
+                    rows += loaded
+                    failed += bad
+                elapsed = time.perf_counter() - started
+                if failed:
+                    logging.warning(f'{failed} files failed to load in {mode} mode')
+                metrics[f'loader.{mode}.rows'] = rows
+                metrics[f'loader.{mode}.rows_per_sec'] = rows / elapsed if elapsed > 0 else 0.0
+                for stage, seconds in timer.totals.items():
+                    metrics[f'loader.{mode}.stage.{stage}_seconds'] = seconds
+                logging.info(f'Loader ({mode}): {rows} rows in {elapsed:.2f}s ({timer.summary()})')
+            finally:
+                delete_loaded(conn, channels)
+                conn.close()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return metrics
+
+def bench_enrich(root, channels):
+    # Imported here so the other suites run without ultralytics installed.
+    import numpy as np
+    from src.enrichment import enrich
+    from src.enrichment.engine import detect_batch
+
+    model, model_id = enrich.load_model()
+    # The first call initializes the model; keep it out of the timing.
+    detect_batch(model, [np.zeros((enrich.ENRICH_IMGSZ, enrich.ENRICH_IMGSZ, 3), dtype=np.uint8)],
+                 enrich.ENRICH_IMGSZ, enrich.ENRICH_CONF)
+    conn = enrich.get_connection()
+    try:
+        with conn.cursor() as cur:
+            enrich.ensure_tables(cur)
+        delete_enriched(conn, root, channels)
+        dirs = [path for channel in channels for path in partition_dirs(root, channel)]
+        timer = runs.StageTimer()
+        started = time.perf_counter()
+        processed, failed = enrich.enrich_partitions(conn, model, model_id, dirs, timer, full_rescan=True, root=root)
+        elapsed = time.perf_counter() - started
+        if failed:
+            logging.warning(f'Enrichment failed for {len(failed)} partitions')
+        metrics = {
+            'enrich.images': processed,
+            'enrich.images_per_sec': processed / elapsed if elapsed > 0 else 0.0,
+        }
+        for stage, seconds in timer.totals.items():
+            metrics[f'enrich.stage.{stage}_seconds'] = seconds
+        logging.info(f'Enrichment: {processed} images in {elapsed:.2f}s ({timer.summary()})')
+        return metrics
+    finally:
+        delete_enriched(conn, root, channels)
+        conn.close()
+
+def lake_images(root, limit=BENCH_BACKEND_IMAGES):
+    import cv2
+    from src.enrichment.engine import letterbox
+    from src.enrichment.enrich import ENRICH_IMGSZ
+    paths = sorted(Path(root).glob('*/*/*.jpg'))
+    images = []
+    for path in paths[:limit] if limit else paths:
+        image = cv2.imread(str(path))
+        if image is not None:
+            images.append(letterbox(image, ENRICH_IMGSZ))
+    return images
+
+def parity(reference, detections):
+    # Share of images detected with the same classes as the reference, and
+    # the largest score difference between those images' matching boxes
+    # (paired in score order per class).
+    same = 0
+    max_diff = 0.0
+    for expected, actual in zip(reference, detections):
+        if sorted(name for name, _ in expected) != sorted(name for name, _ in actual):
+            continue
+        same += 1
+        for (_, a), (_, b) in zip(sorted(expected), sorted(actual)):
+            max_diff = max(max_diff, abs(a - b))
+    return same / len(reference) if reference else 1.0, max_diff
+
+def bench_backends(root, backends=BENCH_BACKENDS):
+    from src.enrichment import enrich
+    from src.enrichment.engine import detect_batch, iter_batches
+
+    images = lake_images(root)
+    if not images:
+        raise RuntimeError(f'No images under {root}')
+    metrics = {'backends.images': len(images)}
+    reference = None
+    for name in backends:
+        backend, _, variant = name.partition('-')
+        model, _ = enrich.load_model(enrich.ENRICH_WEIGHTS, backend, variant == 'int8')
+        detect_batch(model, images[:1], enrich.ENRICH_IMGSZ, enrich.ENRICH_CONF)
+        detections = []
+        started = time.perf_counter()
+        for batch in iter_batches(images, enrich.ENRICH_BATCH_SIZE):
+            detections += detect_batch(model, batch, enrich.ENRICH_IMGSZ, enrich.ENRICH_CONF)
+        elapsed = time.perf_counter() - started
+        metrics[f'backends.{name}.images_per_sec'] = len(images) / elapsed if elapsed > 0 else 0.0
+        metrics[f'backends.{name}.detections'] = sum(len(boxes) for boxes in detections)
+        if reference is None:
+            reference = detections
+            logging.info(f'{name}: {len(images) / elapsed:.1f} images/sec')
+            continue
+        same, max_diff = parity(reference, detections)
+        metrics[f'backends.{name}.class_parity'] = same
+        metrics[f'backends.{name}.max_score_diff'] = max_diff
+        logging.info(f'{name}: {len(images) / elapsed:.1f} images/sec, same classes as {backends[0]} on '
+                     f'{same:.1%} of images, max score difference {max_diff:.4f}')
+    return metrics
+
+def timed_get(url, timeout=BENCH_API_TIMEOUT):
+    # Returns (seconds, ok); the body is read fully so streamed responses
+    # are timed to their last byte.
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception as e:
+        logging.debug(f'GET {url} failed: {e}')
+        ok = False
+    return time.perf_counter() - started, ok
+
+def percentile(cuts, p):
+    return cuts[p - 1] * 1000
+
+def bench_endpoint(urls, requests=BENCH_API_REQUESTS, concurrency=BENCH_API_CONCURRENCY, warmup=BENCH_API_WARMUP):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed_get, (urls[i % len(urls)] for i in range(warmup))))
+        started = time.perf_counter()
+        results = list(executor.map(timed_get, (urls[i % len(urls)] for i in range(requests))))
+        elapsed = time.perf_counter() - started
+    latencies = [seconds for seconds, ok in results if ok]
+    errors = len(results) - len(latencies)
+    if len(latencies) < 2:
+        return {'errors': errors}
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'p50_ms': percentile(cuts, 50),
+        'p95_ms': percentile(cuts, 95),
+        'p99_ms': percentile(cuts, 99),
+        'requests_per_sec': len(results) / elapsed,
+        'errors': errors,
+    }
+
+def bench_api(base_url=BENCH_API_URL, channel=BENCH_API_CHANNEL):
+    _, ok = timed_get(f'{base_url}/api/health/db')
+    if not ok:
+        raise RuntimeError(f'API not reachable at {base_url}')
+    metrics = {}
+    for name, paths in API_ENDPOINTS.items():
+        urls = [base_url + path.format(channel=quote(channel)) for path in paths]
+        result = bench_endpoint(urls)
+        for key, value in result.items():
+            metrics[f'api.{name}.{key}'] = value
+        if result.get('errors'):
+            logging.warning(f"{name}: {result['errors']} failed requests")
+        if 'p50_ms' in result:
+            logging.info(f"{name}: p50={result['p50_ms']:.1f}ms p95={result['p95_ms']:.1f}ms "
+                         f"p99={result['p99_ms']:.1f}ms {result['requests_per_sec']:.0f} req/s")
+    return metrics
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def higher_is_better(name):
+    # Only rates and latencies are compared; counts are informational.
+    if name.endswith('_per_sec'):
+        return True
+    if name.endswith('_ms'):
+        return False
+    return None
+
+def compare(metrics, baseline, threshold=BENCH_REGRESSION_THRESHOLD):
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        higher = higher_is_better(name)
+        old = baseline.get(name)
+        if higher is None or not old:
+            continue
+        change = (value - old) / old
+        if (-change if higher else change) > threshold:
+            regressions.append({'metric': name, 'baseline': old, 'current': value, 'change': round(change, 4)})
+    return regressions
+
+def load_baseline(current_config, results_path=BENCH_RESULTS_PATH, baseline=BENCH_BASELINE):
+    # The newest earlier result run with the same configuration, unless a
+    # baseline file is given explicitly.
+    if baseline:
+        path = Path(baseline)
+        return path, json.loads(path.read_text())['metrics']
+    for path in sorted(Path(results_path).glob('*.json'), reverse=True):
+        result = json.loads(path.read_text())
+        if result.get('config') == current_config:
+            return path, result['metrics']
+    return None, {}
+
+def config():
+    return {
+        'channels': generate.BENCH_CHANNELS,
+        'days': generate.BENCH_DAYS,
+        'messages_per_day': generate.BENCH_MESSAGES_PER_DAY,
+        'image_ratio': generate.BENCH_IMAGE_RATIO,
+        'image_size': generate.BENCH_IMAGE_SIZE,
+        'lake_format': generate.BENCH_LAKE_FORMAT,
+        'seed': generate.BENCH_SEED,
+        'load_modes': BENCH_LOAD_MODES,
+        'load_workers': load_to_pg.LOAD_WORKERS,
+        'load_batch_size': load_to_pg.LOAD_BATCH_SIZE,
+        'api_url': BENCH_API_URL,
+        'api_concurrency': BENCH_API_CONCURRENCY,
+        'api_requests': BENCH_API_REQUESTS,
+        'enrich_backend': os.getenv('ENRICH_BACKEND', 'torch'),
+        'backends': BENCH_BACKENDS,
+        'cpu_count': os.cpu_count(),
+    }
+
+def run(suites=SUITES):
+    channels = bench_channels()
+    root = Path(BENCH_DATA_PATH) if BENCH_DATA_PATH else Path(tempfile.mkdtemp(prefix='kara_bench_'))
+    metrics = {}
+    data = None
+    try:
+        if {'loader', 'enrich'} & set(suites):
+            if not any(root.glob('*/*')):
+                started = time.perf_counter()
+                data = generate.generate(root, channels)
+                logging.info(f"Generated {data['messages']} messages and {data['images']} images "
+                             f'in {time.perf_counter() - started:.1f}s')
+        if 'loader' in suites:
+            metrics.update(bench_loader(root, channels))
+        if 'enrich' in suites:
+            metrics.update(bench_enrich(root, channels))
+        if 'api' in suites:
+            metrics.update(bench_api())
+        if 'backends' in suites:
+            metrics.update(bench_backends(load_to_pg.RAW_DATA_PATH))
+    finally:
+        if not BENCH_DATA_PATH:
+            shutil.rmtree(root, ignore_errors=True)
+    return data, metrics
+
+def main(argv):
+    suites = argv or list(SUITES)
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        raise SystemExit(f"Unknown suites: {', '.join(sorted(unknown))} (choose from {', '.join(SUITES)})")
+    current_config = config()
+    baseline_path, baseline = load_baseline(current_config)
+    run_at = datetime.now()
+    data, metrics = run(suites)
+    regressions = compare(metrics, baseline)
+    result = {
+        'run_at': run_at.isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'suites': suites,
+        'config': current_config,
+        'data': data,
+        'metrics': metrics,
+        'baseline': str(baseline_path) if baseline_path else None,
+        'regressions': regressions,
+    }
+    BENCH_RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+    path = BENCH_RESULTS_PATH / f'{run_at:%Y%m%dT%H%M%S}.json'
+    path.write_text(json.dumps(result, indent=2))
+    logging.info(f'Wrote {path}')
+    for regression in regressions:
+        logging.warning(f"Regression in {regression['metric']}: {regression['baseline']:.2f} -> "
+                        f"{regression['current']:.2f} ({regression['change']:+.1%})")
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from pathlib import Path
+from psycopg2.extras import execute_values
+
+# Persistent detection cache. Detections depend only on the image content,
+# the model weights and the confidence threshold, so they are stored under
+# that key and reused for reposted images and on later runs.
+
+CREATE_CACHE_SQL = """
+CREATE TABLE IF NOT EXISTS raw.detection_cache (
+    content_hash TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    conf FLOAT NOT NULL,
+    detections JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model_id, conf, content_hash)
+);
+"""
+
+SELECT_KEYS_SQL = """
+SELECT content_hash FROM raw.detection_cache WHERE model_id = %s AND conf = %s
+"""
+
+SELECT_DETECTIONS_SQL = """
+SELECT content_hash, detections
+FROM raw.detection_cache
+WHERE model_id = %s AND conf = %s AND content_hash = ANY(%s)
+"""
+
+INSERT_DETECTIONS_SQL = """
+INSERT INTO raw.detection_cache (content_hash, model_id, conf, detections)
+VALUES %s
+ON CONFLICT DO NOTHING;
+"""
+
+def model_identifier(weights):
+    # Name plus a prefix of the weights file hash, so retrained weights saved
+    # under the same file name get a new identifier.
+    path = Path(weights)
+    if not path.exists():
+        return path.name
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    return f'{path.name}:{digest[:16]}'
+
+def ensure_cache_table(cur):
+    cur.execute(CREATE_CACHE_SQL)
+
+def cached_hashes(cur, model_id, conf):
+    cur.execute(SELECT_KEYS_SQL, (model_id, conf))
+    return {row[0] for row in cur.fetchall()}
+
+def fetch_detections(cur, model_id, conf, digests):
+    if not digests:
+        return {}
+    cur.execute(SELECT_DETECTIONS_SQL, (model_id, conf, list(digests)))
+    return {digest: [tuple(d) for d in detections] for digest, detections in cur.fetchall()}
+
+def store_detections(cur, model_id, conf, detections_by_hash):
+    values = [
+        (digest, model_id, conf, json.dumps(detections))
+        for digest, detections in detections_by_hash.items()
+    ]
+    if values:
+        execute_values(cur, INSERT_DETECTIONS_SQL, values)
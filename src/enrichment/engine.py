@@ -0,0 +1,104 @@
+import time
+from collections import deque, namedtuple
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from src.enrichment import phash
+from src.loader import manifest
+
+# Batched inference engine used by enrich.py. Images are read, hashed,
+# decoded and letterboxed on a thread pool (cv2 releases the GIL) while the
+# main thread runs the model on the previous batch.
+
+DecodedImage = namedtuple(
+    'DecodedImage', ['entry', 'digest', 'image', 'error', 'cached', 'phash'], defaults=[False, None]
+)
+
+def letterbox(image, size=640, color=(114, 114, 114)):
+    # Resize keeping the aspect ratio and pad to a size x size square, the
+    # same transform ultralytics applies before inference.
+    h, w = image.shape[:2]
+    scale = min(size / h, size / w)
+    nh, nw = round(h * scale), round(w * scale)
+    if (nh, nw) != (h, w):
+        image = cv2.resize(image, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top = (size - nh) // 2
+    left = (size - nw) // 2
+    return cv2.copyMakeBorder(
+        image, top, size - nh - top, left, size - nw - left, cv2.BORDER_CONSTANT, value=color
+    )
+
+def decode_entry(entry, imgsz, timer, cached_hashes=frozenset(), hashed=frozenset()):
+    # Unchanged content (hash matches the manifest) is returned without an
+    # image so the caller only refreshes its manifest entry. Content whose
+    # detections are already known (cached_hashes) is returned with
+    # cached=True and no image; it is only decoded to compute its pHash when
+    # it is not in the perceptual index (hashed) yet.
+    started = time.perf_counter()
+    try:
+        content = entry.path.read_bytes()
+        digest = manifest.content_hash(content)
+        if digest == entry.known_hash:
+            return DecodedImage(entry, digest, None, None)
+        if digest in cached_hashes and digest in hashed:
+            return DecodedImage(entry, digest, None, None, True)
+        image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return DecodedImage(entry, digest, None, 'could not decode image')
+        value = phash.phash(image)
+        if digest in cached_hashes:
+            return DecodedImage(entry, digest, None, None, True, value)
+        return DecodedImage(entry, digest, letterbox(image, imgsz), None, False, value)
+    except Exception as e:
+        return DecodedImage(entry, None, None, str(e))
+    finally:
+        timer.add('decode', time.perf_counter() - started)
+
+def iter_decoded(entries, executor, imgsz, prefetch, timer, cached_hashes=frozenset(), hashed=frozenset()):
+    # Keeps up to prefetch images decoding ahead of the consumer.
+    entries = iter(entries)
+    pending = deque(
+        executor.submit(decode_entry, entry, imgsz, timer, cached_hashes, hashed)
+        for entry in islice(entries, prefetch)
+    )
+    while pending:
+        with timer.stage('decode_wait'):
+            item = pending.popleft().result()
+        entry = next(entries, None)
+        if entry is not None:
+            pending.append(executor.submit(decode_entry, entry, imgsz, timer, cached_hashes, hashed))
+        yield item
+
+def iter_batches(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def class_name(names, cls_id):
+    if isinstance(names, dict):
+        return names.get(cls_id, str(cls_id))
+    return names[cls_id] if names and cls_id < len(names) else str(cls_id)
+
+def detect_batch(model, images, imgsz, conf):
+    # Models with their own detect() (the ONNX Runtime backend) return
+    # (class id, score) pairs for the letterboxed images.
+    detect = getattr(model, 'detect', None)
+    if detect is not None:
+        return [[(class_name(model.names, cls_id), score) for cls_id, score in boxes]
+                for boxes in detect(images, conf)]
+    # stream=True makes predict return a generator, so each Results object
+    # (and its tensors) is released as soon as its boxes have been read.
+    detections = []
+    for result in model.predict(source=images, stream=True, imgsz=imgsz, conf=conf, verbose=False):
+        names = result.names
+        boxes = result.boxes
+        detections.append([
+            (class_name(names, int(cls_id)), float(score))
+            for cls_id, score in zip(boxes.cls.tolist(), boxes.conf.tolist())
+        ])
+    return detections
@@ -1,11 +1,21 @@
 import os
+import time
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 from ultralytics import YOLO
 from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import logging
 
+from src import profiling
+from src.loader import manifest, runs
+from src.enrichment import cache, onnx_backend, phash
+from src.enrichment.engine import detect_batch, iter_batches, iter_decoded
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
@@ -17,8 +27,30 @@ DB_PORT = os.getenv('DB_PORT', '5433')
 DB_NAME = os.getenv('DB_NAME', 'kara')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
+# Ignore the manifest and reprocess every partition.
+FULL_RESCAN = os.getenv('FULL_RESCAN', '0') == '1'
+
+# Inference settings: images per model call, decoder threads, how many
+# images may be decoded ahead of inference, input size and confidence.
+ENRICH_BATCH_SIZE = int(os.getenv('ENRICH_BATCH_SIZE', '16'))
+ENRICH_DECODE_WORKERS = int(os.getenv('ENRICH_DECODE_WORKERS', '4'))
+ENRICH_PREFETCH = int(os.getenv('ENRICH_PREFETCH', '64'))
+ENRICH_IMGSZ = int(os.getenv('ENRICH_IMGSZ', '640'))
+ENRICH_CONF = float(os.getenv('ENRICH_CONF', '0.25'))
+ENRICH_WEIGHTS = os.getenv('ENRICH_WEIGHTS', 'yolov8n.pt')
+# torch runs the weights with ultralytics; onnx exports them to ONNX (INT8
+# weights with ENRICH_ONNX_INT8=1) and runs them on ONNX Runtime.
+ENRICH_BACKEND = os.getenv('ENRICH_BACKEND', 'torch')
+ENRICH_ONNX_INT8 = os.getenv('ENRICH_ONNX_INT8', '0') == '1'
+BACKENDS = ('torch', 'onnx')
 
 RAW_DATA_PATH = Path(__file__).parent.parent / 'data' / 'raw' / 'telegram_messages'
+# The manifest consumer name includes the model and threshold (see
+# manifest_consumer), so changing either makes every image eligible again and
+# the detection cache decides which ones actually need inference. Bumped from
+# 'enrich' when the perceptual-hash index was added, so the first run hashes
+# the images already in the lake (their detections come from the cache).
+MANIFEST_CONSUMER = 'enrich:phash'
 
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS raw.image_detections (
@@ -31,60 +63,328 @@ CREATE TABLE IF NOT EXISTS raw.image_detections (
 );
 """
 
+# Images whose detections were replaced, in the transaction that replaced
+# them, for the incremental fct_image_detections model. Detection timestamps
+# cannot drive it: they are taken when a transaction starts, so a batch that
+# commits after a dbt run started would be missed, and an image whose new
+# detections are empty leaves no row behind. The model claims the committed
+# changes, rebuilds those images and deletes the claimed rows, all in one
+# transaction (see the model's hooks).
+CREATE_CHANGES_SQL = """
+CREATE TABLE IF NOT EXISTS raw.image_detection_changes (
+    id BIGSERIAL PRIMARY KEY,
+    image_path TEXT NOT NULL,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    claimed BOOLEAN NOT NULL DEFAULT FALSE
+);
+"""
+
+# detection_index numbers the boxes of one image and gives the table a
+# natural key. Rows written before the column existed are deduplicated and
+# numbered once, when the unique index is created.
+MIGRATE_NATURAL_KEY_SQL = """
+ALTER TABLE raw.image_detections ADD COLUMN IF NOT EXISTS detection_index INTEGER;
+DELETE FROM raw.image_detections a
+USING raw.image_detections b
+WHERE a.detection_index IS NULL AND b.detection_index IS NULL
+  AND a.image_path = b.image_path
+  AND a.detected_object_class = b.detected_object_class
+  AND a.confidence_score = b.confidence_score
+  AND a.id > b.id;
+UPDATE raw.image_detections d
+SET detection_index = n.idx
+FROM (
+    SELECT id, row_number() OVER (PARTITION BY image_path ORDER BY id) - 1 AS idx
+    FROM raw.image_detections
+    WHERE detection_index IS NULL
+) n
+WHERE d.id = n.id;
+CREATE UNIQUE INDEX IF NOT EXISTS image_detections_image_key
+    ON raw.image_detections (image_path, detection_index);
+"""
+
+NATURAL_KEY_EXISTS_SQL = """
+SELECT to_regclass('raw.image_detections_image_key');
+"""
+
 INSERT_SQL = """
-INSERT INTO raw.image_detections (message_id, image_path, detected_object_class, confidence_score)
-VALUES (%s, %s, %s, %s)
-ON CONFLICT DO NOTHING;
+INSERT INTO raw.image_detections (message_id, image_path, detected_object_class, confidence_score, detection_index)
+VALUES %s
+ON CONFLICT (image_path, detection_index) DO UPDATE
+SET message_id = EXCLUDED.message_id,
+    detected_object_class = EXCLUDED.detected_object_class,
+    confidence_score = EXCLUDED.confidence_score,
+    detection_timestamp = CURRENT_TIMESTAMP;
+"""
+
+# Changed images replace their previous detections.
+DELETE_IMAGES_SQL = """
+DELETE FROM raw.image_detections WHERE image_path = ANY(%s);
+"""
+
+INSERT_CHANGES_SQL = """
+INSERT INTO raw.image_detection_changes (image_path) SELECT unnest(%s::text[]);
 """
 
 def get_message_id_from_filename(filename):
     return int(Path(filename).stem)
 
-def main():
-    # Load YOLOv8 model (use 'yolov8n.pt' for speed, or 'yolov8s.pt' for better accuracy)
-    model = YOLO('yolov8n.pt')
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
+def manifest_consumer(model_id, conf):
+    return f'{MANIFEST_CONSUMER}:{model_id}:{conf}'
+
+def ensure_tables(cur):
+    cur.execute(CREATE_TABLE_SQL)
+    cur.execute(CREATE_CHANGES_SQL)
+    cur.execute(NATURAL_KEY_EXISTS_SQL)
+    if cur.fetchone()[0] is None:
+        cur.execute(MIGRATE_NATURAL_KEY_SQL)
+    manifest.ensure_manifest_tables(cur)
+    cache.ensure_cache_table(cur)
+    phash.ensure_phash_table(cur)
+
+def iter_partitions(root=RAW_DATA_PATH):
+    for date_dir in sorted(Path(root).glob('*')):
+        if not date_dir.is_dir():
+            continue
+        for channel_dir in sorted(date_dir.iterdir()):
+            if channel_dir.is_dir():
+                yield channel_dir
+
+def write_batch(conn, consumer, decoded, detections, index=None):
+    # decoded and detections are aligned; unchanged images carry no
+    # detections and only have their manifest entry refreshed. Images in the
+    # perceptual index get their canonical mapping written.
+    cur = conn.cursor()
+    changed = [str(item.entry.path) for item, boxes in zip(decoded, detections) if boxes is not None]
+    if changed:
+        cur.execute(DELETE_IMAGES_SQL, (changed,))
+        cur.execute(INSERT_CHANGES_SQL, (changed,))
+    rows = [
+        (get_message_id_from_filename(item.entry.path.name), str(item.entry.path), detected_class, confidence,
+         detection_index)
+        for item, boxes in zip(decoded, detections) if boxes
+        for detection_index, (detected_class, confidence) in enumerate(boxes)
+    ]
+    if rows:
+        execute_values(cur, INSERT_SQL, rows, page_size=1000)
+    if index is not None:
+        phash.store_images(cur, [
+            (str(item.entry.path), Path(item.entry.partition_path).name,
+             get_message_id_from_filename(item.entry.path.name), item.digest, index.entries[item.digest])
+            for item in decoded if item.digest in index
+        ])
+    manifest.record_files(cur, consumer, [(item.entry, item.digest) for item in decoded])
+    conn.commit()
+    cur.close()
+    return len(rows)
+
+def detection_sources(ok, index, known):
+    # Maps the content hash of every image that needs detections to the
+    # content whose detections it gets: itself when they are cached, its
+    # canonical content when that is cached or inferred in this batch, and
+    # otherwise itself through inference. Returns (sources, images to infer).
+    canonical_in_batch = {
+        item.digest for item in ok if item.image is not None and index.canonical(item.digest) == item.digest
+    }
+    sources = {}
+    to_infer = []
+    for item in ok:
+        if not (item.cached or item.image is not None):
+            continue
+        canonical = index.canonical(item.digest)
+        if item.digest in known:
+            sources[item.digest] = item.digest
+        elif canonical != item.digest and (canonical in known or canonical in canonical_in_batch):
+            sources[item.digest] = canonical
+        else:
+            sources[item.digest] = item.digest
+            if item.image is not None:
+                to_infer.append(item)
+    return sources, to_infer
+
+def enrich_entries(conn, model, model_id, entries, timer, batch_size=ENRICH_BATCH_SIZE, conf=ENRICH_CONF,
+                   max_distance=phash.ENRICH_PHASH_DISTANCE):
+    # Returns the set of partition paths that had at least one failure and
+    # the number of images that went through inference.
+    consumer = manifest_consumer(model_id, conf)
+    cur = conn.cursor()
+    known = cache.cached_hashes(cur, model_id, conf)
+    with timer.stage('phash_index'):
+        index = phash.PhashIndex(max_distance).load(cur)
+    conn.commit()
+    # Content whose detections need no inference: cached itself, or a
+    # near-duplicate of cached content.
+    resolvable = known | {digest for digest, entry in index.entries.items() if entry.canonical in known}
+    failed_partitions = set()
+    processed = 0
+    hits = 0
+    duplicates = 0
+    with ThreadPoolExecutor(max_workers=ENRICH_DECODE_WORKERS) as executor:
+        decoded = iter_decoded(entries, executor, ENRICH_IMGSZ, ENRICH_PREFETCH, timer, resolvable, index.entries)
+        for batch in iter_batches(decoded, batch_size):
+            ok = []
+            for item in batch:
+                if item.error:
+                    failed_partitions.add(item.entry.partition_path)
+                    logging.error(f'Error processing {item.entry.path}: {item.error}')
+                else:
+                    ok.append(item)
+            for item in ok:
+                if item.phash is not None:
+                    index.assign(item.digest, item.phash)
+            sources, to_infer = detection_sources(ok, index, known)
+            try:
+                with timer.stage('cache'):
+                    by_hash = cache.fetch_detections(cur, model_id, conf, {s for s in sources.values() if s in known})
+                if to_infer:
+                    with timer.stage('infer', len(to_infer)):
+                        detections = detect_batch(model, [item.image for item in to_infer], ENRICH_IMGSZ, conf)
+                    inferred = {item.digest: boxes for item, boxes in zip(to_infer, detections)}
+                    cache.store_detections(cur, model_id, conf, inferred)
+                    by_hash.update(inferred)
+                missing = [digest for digest, source in sources.items() if source not in by_hash]
+                if missing:
+                    raise RuntimeError(f'{len(missing)} cache entries disappeared during the run')
+                with timer.stage('write'):
+                    written = write_batch(conn, consumer, ok, [
+                        by_hash[sources[item.digest]] if item.digest in sources else None
+                        for item in ok
+                    ], index)
+            except Exception as e:
+                conn.rollback()
+                failed_partitions.update(item.entry.partition_path for item in ok)
+                logging.error(f'Error processing batch of {len(ok)} images: {e}')
+                continue
+            batch_hits = sum(1 for item in ok if item.digest in sources and item.digest in known)
+            batch_duplicates = sum(1 for item in ok if sources.get(item.digest, item.digest) != item.digest)
+            known.update(item.digest for item in to_infer)
+            resolvable.update(sources)
+            processed += len(to_infer)
+            hits += batch_hits
+            duplicates += batch_duplicates
+            timer.incr('images_inferred', len(to_infer))
+            timer.incr('cache_hits', batch_hits)
+            timer.incr('near_duplicates', batch_duplicates)
+            timer.incr('detections', written)
+            logging.info(f'Enriched batch of {len(ok)} images: {len(to_infer)} inferred; {processed} inferred, '
+                         f'{hits} cache hits and {duplicates} near-duplicates so far')
+    cur.close()
+    return failed_partitions, processed
+
+def get_connection():
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
+@lru_cache(maxsize=None)
+def load_model(weights=ENRICH_WEIGHTS, backend=ENRICH_BACKEND, int8=ENRICH_ONNX_INT8):
+    # Loaded once per process, so in-process callers (the Dagster assets)
+    # reuse the model across partitions. The identifier hashes the file that
+    # actually runs, so each backend gets its own detection cache entries.
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ENRICH_BACKEND {backend!r} (choose from {', '.join(BACKENDS)})")
+    if backend == 'onnx':
+        path = onnx_backend.export(weights, ENRICH_IMGSZ, int8)
+        return onnx_backend.OnnxDetector(path), cache.model_identifier(path)
+    model = YOLO(weights)
+    return model, cache.model_identifier(getattr(model, 'ckpt_path', None) or weights)
+
+def enrich_partitions(conn, model, model_id, partition_dirs, timer, full_rescan=FULL_RESCAN,
+                      batch_size=ENRICH_BATCH_SIZE, conf=ENRICH_CONF, root=RAW_DATA_PATH, ensure=True):
+    # Runs detection on the new or changed images of the given
+    # YYYY-MM-DD/<channel> directories under root. Returns (images inferred,
+    # partition paths with failures). Parallel workers pass ensure=False: the
+    # DDL in ensure_tables can deadlock with another worker's batch.
+    consumer = manifest_consumer(model_id, conf)
+    cur = conn.cursor()
+    if ensure:
+        ensure_tables(cur)
+        conn.commit()
+    with timer.stage('discover'):
+        partitions = manifest.changed_partitions(
+            cur, consumer, partition_dirs, root, force=full_rescan
         )
-        conn.autocommit = True
-        cur = conn.cursor()
-        logging.info('Connected to PostgreSQL')
-        cur.execute(CREATE_TABLE_SQL)
-        logging.info('Ensured raw.image_detections table exists')
-
-        # Scan all images
-        for date_dir in RAW_DATA_PATH.glob('*'):
-            for channel_dir in date_dir.iterdir():
-                if not channel_dir.is_dir():
-                    continue
-                for image_file in channel_dir.glob('*.jpg'):
-                    message_id = get_message_id_from_filename(image_file.name)
-                    try:
-                        results = model(image_file)
-                        for r in results:
-                            boxes = r.boxes
-                            names = r.names
-                            for box in boxes:
-                                cls_id = int(box.cls[0])
-                                detected_class = names[cls_id] if names and cls_id < len(names) else str(cls_id)
-                                confidence = float(box.conf[0])
-                                cur.execute(
-                                    INSERT_SQL,
-                                    (message_id, str(image_file), detected_class, confidence)
-                                )
-                        logging.info(f'Processed {image_file}')
-                    except Exception as e:
-                        logging.error(f'Error processing {image_file}: {e}')
-        cur.close()
+        entries = []
+        for partition_dir, _, _ in partitions:
+            entries.extend(manifest.changed_files(
+                cur, consumer, partition_dir, '*.jpg', root, force=full_rescan
+            ))
+    logging.info(f'{len(partitions)} new or changed partitions, {len(entries)} images to check')
+    timer.incr('partitions', len(partitions))
+    timer.incr('images_checked', len(entries))
+
+    failed_partitions, processed = enrich_entries(conn, model, model_id, entries, timer, batch_size, conf)
+    timer.incr('failed_partitions', len(failed_partitions))
+
+    for _, partition_path, mtime_ns in partitions:
+        if partition_path not in failed_partitions:
+            manifest.record_partition(cur, consumer, partition_path, mtime_ns)
+    conn.commit()
+    cur.close()
+    return processed, failed_partitions
+
+def enrich_partition(date, channel, full_rescan=FULL_RESCAN, batch_size=ENRICH_BATCH_SIZE, conf=ENRICH_CONF,
+                     run_id=None, root=RAW_DATA_PATH, ensure=True):
+    # Enriches a single YYYY-MM-DD/<channel> partition in-process (used by the
+    # Dagster assets and the sharded workers). Unlike main(), errors are
+    # raised. Returns images inferred.
+    partition_dir = Path(root) / date / channel
+    if not partition_dir.is_dir():
+        logging.info(f'No images for {date}/{channel}')
+        return 0
+    model, model_id = load_model()
+    timer = runs.StageTimer()
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    status = 'failed'
+    conn = get_connection()
+    try:
+        processed, failed = enrich_partitions(conn, model, model_id, [partition_dir], timer, full_rescan, batch_size,
+                                              conf, root, ensure)
+        logging.info(f'Stage timings: {timer.summary()}')
+        if failed:
+            raise RuntimeError(f'Enrichment failed for {date}/{channel}')
+        status = 'success'
+        return processed
+    finally:
+        conn.close()
+        runs.record_run(get_connection, run_id or runs.new_run_id(), 'enrich', f'{date}/{channel}', status,
+                        started_at, time.perf_counter() - started, timer)
+
+def main(full_rescan=FULL_RESCAN, batch_size=ENRICH_BATCH_SIZE, conf=ENRICH_CONF):
+    run_id = runs.new_run_id()
+    timer = runs.StageTimer()
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    status = 'failed'
+    try:
+        # Load YOLOv8 model (use 'yolov8n.pt' for speed, or 'yolov8s.pt' for better accuracy)
+        with timer.stage('load_model'):
+            model, model_id = load_model()
+        conn = get_connection()
+        logging.info(f'Connected to PostgreSQL (run {run_id})')
+
+        # Scan only partitions and images that changed since the last run
+        enrich_started = time.perf_counter()
+        processed, _ = enrich_partitions(conn, model, model_id, iter_partitions(), timer, full_rescan, batch_size, conf)
+
+        elapsed = time.perf_counter() - enrich_started
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        logging.info(f'Enriched {processed} images in {elapsed:.2f}s ({rate:.1f} images/sec)')
+        logging.info(f'Stage timings: {timer.summary()}')
         conn.close()
+        status = 'success'
         logging.info('Done with image enrichment.')
     except Exception as e:
         logging.error(f'Failed to enrich images: {e}')
+    finally:
+        runs.record_run(get_connection, run_id, 'enrich', runs.ALL_PARTITIONS, status, started_at,
+                        time.perf_counter() - started, timer)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.profiled('enrich'):
+        main()
@@ -0,0 +1,109 @@
+import os
+import ast
+from pathlib import Path
+
+import numpy as np
+
+# ONNX Runtime backend for enrichment (ENRICH_BACKEND=onnx). The weights are
+# exported to ONNX once with a dynamic batch size, optionally quantized to
+# INT8 weights (ENRICH_ONNX_INT8=1), and run on ONNX Runtime's CPU provider.
+# Decoding and NMS mirror ultralytics' own post-processing, so detections
+# match the PyTorch path up to numerical differences (see the backends
+# benchmark suite).
+
+# IoU above which a lower-scoring box of the same class is suppressed, the
+# maximum number of boxes kept per image, and the class offset that keeps
+# NMS per class: ultralytics' defaults.
+NMS_IOU = float(os.getenv('ENRICH_NMS_IOU', '0.7'))
+MAX_DETECTIONS = 300
+MAX_NMS_CANDIDATES = 30000
+CLASS_OFFSET = 7680
+
+
+def export(weights, imgsz=640, int8=False):
+    # Returns the path of the ONNX model for weights, exporting it next to
+    # the weights file unless an export newer than the weights exists.
+    weights = Path(weights)
+    if weights.suffix == '.onnx':
+        return weights
+    if not weights.exists():
+        # Downloads the released weights, as YOLO() does for the torch path.
+        from ultralytics import YOLO
+        weights = Path(YOLO(str(weights)).ckpt_path)
+    fp32 = weights.with_suffix('.onnx')
+    if not is_fresh(fp32, weights):
+        from ultralytics import YOLO
+        fp32 = Path(YOLO(str(weights)).export(format='onnx', imgsz=imgsz, dynamic=True))
+    if not int8:
+        return fp32
+    quantized = weights.with_suffix('.int8.onnx')
+    if not is_fresh(quantized, fp32):
+        # Dynamic quantization: INT8 weights, activations quantized on the
+        # fly. ONNX Runtime's ConvInteger kernel needs unsigned weights.
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(str(fp32), str(quantized), weight_type=QuantType.QUInt8)
+    return quantized
+
+def is_fresh(path, source):
+    return path.exists() and path.stat().st_mtime >= source.stat().st_mtime
+
+def preprocess(images):
+    # Letterboxed BGR uint8 HWC images -> RGB float32 NCHW in [0, 1].
+    batch = np.stack(images)[..., ::-1].transpose(0, 3, 1, 2)
+    return np.ascontiguousarray(batch, dtype=np.float32) / 255.0
+
+def nms(boxes, scores, iou):
+    # Greedy NMS on xyxy boxes; returns the kept indices, best first.
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        w = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        h = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        inter = w * h
+        order = rest[inter / (areas[best] + areas[rest] - inter + 1e-9) <= iou]
+    return keep
+
+def postprocess(prediction, conf, iou=NMS_IOU, max_det=MAX_DETECTIONS):
+    # prediction is one image's (4 + classes, anchors) output: center x/y,
+    # width, height, then a score per class. Returns [(class id, score)],
+    # best first.
+    prediction = prediction.T
+    class_scores = prediction[:, 4:]
+    classes = class_scores.argmax(1)
+    scores = class_scores[np.arange(len(classes)), classes]
+    mask = scores > conf
+    if not mask.any():
+        return []
+    xywh, classes, scores = prediction[mask, :4], classes[mask], scores[mask]
+    order = scores.argsort()[::-1][:MAX_NMS_CANDIDATES]
+    xywh, classes, scores = xywh[order], classes[order], scores[order]
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    keep = nms(boxes + classes[:, None] * CLASS_OFFSET, scores, iou)[:max_det]
+    return [(int(classes[i]), float(scores[i])) for i in keep]
+
+
+class OnnxDetector:
+    # Stands in for the ultralytics model: engine.detect_batch calls detect()
+    # when a model has one. Intra-op threads follow OMP_NUM_THREADS, which
+    # the sharded workers set per process.
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        threads = int(os.getenv('OMP_NUM_THREADS', '0'))
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.path = str(path)
+        self.session = ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        # The ultralytics export stores the class names as a dict literal.
+        self.names = ast.literal_eval(self.session.get_modelmeta().custom_metadata_map.get('names', '{}'))
+
+    def detect(self, images, conf):
+        output = self.session.run(None, {self.input_name: preprocess(images)})[0]
+        return [postprocess(prediction, conf) for prediction in output]
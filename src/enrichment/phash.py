@@ -0,0 +1,168 @@
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from psycopg2.extras import execute_values
+
+# Perceptual-hash index of every image in the lake. Channels repost the same
+# product photos re-encoded or resized, which changes the content hash but
+# barely moves the 64-bit DCT pHash. Each distinct content is assigned a
+# canonical content: the first one seen within ENRICH_PHASH_DISTANCE bits
+# (Hamming distance) of it, or itself. Near-duplicates reuse the canonical
+# content's detections instead of running the model, and the
+# image -> canonical mapping in raw.image_phashes lets the marts and the API
+# group reposts.
+#
+# Canonical pHashes are kept in a BK-tree, so a lookup visits only the
+# subtrees whose edge distance can still be within the threshold.
+
+# Hamming distance (out of 64 bits) under which two images are considered
+# the same photo; negative disables near-duplicate matching.
+ENRICH_PHASH_DISTANCE = int(os.getenv('ENRICH_PHASH_DISTANCE', '8'))
+
+MASK64 = (1 << 64) - 1
+
+CREATE_PHASH_SQL = """
+CREATE TABLE IF NOT EXISTS raw.image_phashes (
+    image_path TEXT PRIMARY KEY,
+    channel_name TEXT NOT NULL,
+    message_id BIGINT NOT NULL,
+    content_hash TEXT NOT NULL,
+    phash BIGINT NOT NULL,
+    canonical_hash TEXT NOT NULL,
+    distance SMALLINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS image_phashes_canonical_idx ON raw.image_phashes (canonical_hash);
+CREATE INDEX IF NOT EXISTS image_phashes_content_idx ON raw.image_phashes (content_hash);
+"""
+
+# One row per content; the earliest row wins if a content was ever mapped
+# twice.
+SELECT_INDEX_SQL = """
+SELECT DISTINCT ON (content_hash) content_hash, phash, canonical_hash, distance
+FROM raw.image_phashes
+ORDER BY content_hash, created_at
+"""
+
+UPSERT_IMAGES_SQL = """
+INSERT INTO raw.image_phashes (image_path, channel_name, message_id, content_hash, phash, canonical_hash, distance)
+VALUES %s
+ON CONFLICT (image_path) DO UPDATE
+SET channel_name = EXCLUDED.channel_name,
+    message_id = EXCLUDED.message_id,
+    content_hash = EXCLUDED.content_hash,
+    phash = EXCLUDED.phash,
+    canonical_hash = EXCLUDED.canonical_hash,
+    distance = EXCLUDED.distance;
+"""
+
+IndexEntry = namedtuple('IndexEntry', ['phash', 'canonical', 'distance'])
+
+
+def phash(image):
+    # DCT hash: the signs of the 8x8 lowest frequencies of a 32x32 grayscale
+    # thumbnail relative to their median (the DC term is left out of the
+    # median). Returned as a signed 64-bit integer so it fits a BIGINT.
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big', signed=True)
+
+def hamming(a, b):
+    return ((a ^ b) & MASK64).bit_count()
+
+
+class BKTree:
+    # Nodes are [phash, value, {distance: child}]. Insert and search are
+    # iterative so a degenerate tree cannot hit the recursion limit.
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                return
+            node = child
+
+    def nearest(self, key, max_distance):
+        # Returns (value, distance) of the closest key within max_distance,
+        # or None.
+        if self.root is None or max_distance < 0:
+            return None
+        best = None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance and (best is None or distance < best[1]):
+                best = (node[1], distance)
+                if distance == 0:
+                    break
+            limit = best[1] if best else max_distance
+            for edge, child in node[2].items():
+                if abs(edge - distance) <= limit:
+                    stack.append(child)
+        return best
+
+
+class PhashIndex:
+    def __init__(self, max_distance=ENRICH_PHASH_DISTANCE):
+        self.max_distance = max_distance
+        self.entries = {}
+        self.tree = BKTree()
+
+    def __contains__(self, content_hash):
+        return content_hash in self.entries
+
+    def load(self, cur):
+        cur.execute(SELECT_INDEX_SQL)
+        for content_hash, value, canonical, distance in cur.fetchall():
+            self.entries[content_hash] = IndexEntry(value, canonical, distance)
+            if canonical == content_hash:
+                self.tree.add(value, content_hash)
+        return self
+
+    def assign(self, content_hash, value):
+        # Maps new content to the nearest canonical content, or makes it
+        # canonical itself.
+        entry = self.entries.get(content_hash)
+        if entry is not None:
+            return entry
+        match = self.tree.nearest(value, self.max_distance)
+        if match is None:
+            entry = IndexEntry(value, content_hash, 0)
+            self.tree.add(value, content_hash)
+        else:
+            entry = IndexEntry(value, *match)
+        self.entries[content_hash] = entry
+        return entry
+
+    def canonical(self, content_hash):
+        entry = self.entries.get(content_hash)
+        return entry.canonical if entry else content_hash
+
+
+def ensure_phash_table(cur):
+    cur.execute(CREATE_PHASH_SQL)
+
+def store_images(cur, rows):
+    # rows: (image_path, channel_name, message_id, content_hash, IndexEntry)
+    values = [
+        (image_path, channel, message_id, content_hash, entry.phash, entry.canonical, entry.distance)
+        for image_path, channel, message_id, content_hash, entry in rows
+    ]
+    if values:
+        execute_values(cur, UPSERT_IMAGES_SQL, values)
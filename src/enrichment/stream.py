@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import select
+import logging
+from datetime import datetime
+from pathlib import Path
+from psycopg2 import sql
+
+from src import profiling
+from src.loader import manifest, notify, runs
+from src.enrichment import enrich
+
+# Near-real-time enrichment. The loader, run with LOAD_NOTIFY=1, notifies
+# STREAM_CHANNEL with the ids of the messages it merged (see
+# src/loader/notify.py). This long-running worker LISTENs on the channel,
+# gathers notifications into micro-batches and enriches just the images of
+# the notified messages, then refreshes the incremental marts, which only
+# pick up the new rows. Data reaches the API seconds after it is loaded
+# instead of after the next pipeline cycle:
+#
+#   LOAD_NOTIFY=1 python -m src.enrichment.stream
+#
+# It LISTENs before catching up on the partitions that changed while it was
+# not running, so no load is missed in between. Images it enriches are
+# recorded in the enrichment manifest, so the batch job skips them.
+
+# A micro-batch is processed STREAM_BATCH_SECONDS after its first
+# notification, or as soon as it names STREAM_BATCH_MESSAGES messages.
+STREAM_BATCH_SECONDS = float(os.getenv('STREAM_BATCH_SECONDS', '2'))
+STREAM_BATCH_MESSAGES = int(os.getenv('STREAM_BATCH_MESSAGES', '500'))
+# The marts are refreshed at most this often, so a steady trickle of loads
+# does not keep dbt running back to back.
+STREAM_REFRESH_SECONDS = float(os.getenv('STREAM_REFRESH_SECONDS', '30'))
+# dbt selection refreshed after each micro-batch. The tables that aggregate
+# the whole lake (fct_image_reposts) are left to the scheduled dbt run.
+STREAM_DBT_SELECT = os.getenv('STREAM_DBT_SELECT', 'config.materialized:incremental')
+# Seconds to wait for a notification before checking for a due refresh.
+STREAM_IDLE_SECONDS = 5.0
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+
+LISTEN_SQL = sql.SQL('LISTEN {}')
+
+
+def listen(conn, channel=notify.STREAM_CHANNEL):
+    # Notifications are delivered between transactions, so the listening
+    # connection stays in autocommit and does nothing else.
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(LISTEN_SQL.format(sql.Identifier(channel)))
+
+def wait_notifications(conn, timeout):
+    if select.select([conn], [], [], timeout) == ([], [], []):
+        return []
+    conn.poll()
+    notifications = list(conn.notifies)
+    conn.notifies.clear()
+    return notifications
+
+def collect(conn, batch_seconds=STREAM_BATCH_SECONDS, batch_messages=STREAM_BATCH_MESSAGES,
+            idle_seconds=STREAM_IDLE_SECONDS):
+    # Returns {partition path: message ids} for the next micro-batch, or {}
+    # when nothing arrived within idle_seconds.
+    pending = {}
+    deadline = None
+    while True:
+        timeout = idle_seconds if deadline is None else max(0.0, deadline - time.monotonic())
+        for notification in wait_notifications(conn, timeout):
+            try:
+                partition_path, message_ids = notify.parse_payload(notification.payload)
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f'Ignoring notification {notification.payload!r}: {e}')
+                continue
+            pending.setdefault(partition_path, set()).update(message_ids)
+            if deadline is None:
+                deadline = time.monotonic() + batch_seconds
+        if deadline is None or time.monotonic() >= deadline \
+                or sum(len(ids) for ids in pending.values()) >= batch_messages:
+            return pending
+
+def image_paths(pending, root=enrich.RAW_DATA_PATH):
+    # Messages are scraped into their partition with their photo saved as
+    # <message id>.jpg next to them; messages without one have no file.
+    return [
+        Path(root) / partition_path / f'{message_id}.jpg'
+        for partition_path, message_ids in sorted(pending.items())
+        for message_id in sorted(message_ids)
+    ]
+
+def enrich_messages(conn, model, model_id, pending, timer, batch_size=enrich.ENRICH_BATCH_SIZE,
+                    conf=enrich.ENRICH_CONF, root=enrich.RAW_DATA_PATH):
+    # Enriches the new or changed images of the notified messages. Returns
+    # (images inferred, partition paths with failures).
+    consumer = enrich.manifest_consumer(model_id, conf)
+    with timer.stage('discover'):
+        with conn.cursor() as cur:
+            entries = manifest.changed_paths(cur, consumer, image_paths(pending, root), root)
+        conn.commit()
+    timer.incr('messages', sum(len(ids) for ids in pending.values()))
+    timer.incr('images_checked', len(entries))
+    failed, processed = enrich.enrich_entries(conn, model, model_id, entries, timer, batch_size, conf)
+    return processed, failed
+
+def refresh_marts(select_models=STREAM_DBT_SELECT):
+    # In-process, as the Dagster dbt_marts asset does, so dbt is imported
+    # once. The on-run-end hook stamps the pipeline version, which expires
+    # the API's response cache.
+    from dbt.cli.main import dbtRunner
+    result = dbtRunner().invoke(['run', '--project-dir', str(PROJECT_ROOT), '--select', select_models])
+    if not result.success:
+        raise RuntimeError(f'dbt run failed: {result.exception}')
+
+def process(run_id, scope, work):
+    # Runs work(timer) and records it in raw.pipeline_runs. Errors are
+    # logged, not raised: the worker keeps listening and the manifest makes
+    # the next catch-up retry what failed.
+    timer = runs.StageTimer()
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    status = 'failed'
+    try:
+        work(timer)
+        status = 'success'
+        return True
+    except Exception as e:
+        logging.error(f'Stream {scope} failed: {e}')
+        return False
+    finally:
+        runs.record_run(enrich.get_connection, run_id, 'stream', scope, status, started_at,
+                        time.perf_counter() - started, timer)
+
+def catch_up(conn, model, model_id, timer, batch_size=enrich.ENRICH_BATCH_SIZE, conf=enrich.ENRICH_CONF,
+             root=enrich.RAW_DATA_PATH):
+    processed, failed = enrich.enrich_partitions(conn, model, model_id, enrich.iter_partitions(root), timer,
+                                                 batch_size=batch_size, conf=conf, root=root)
+    logging.info(f'Caught up: {processed} images inferred, {len(failed)} partitions failed')
+
+def micro_batch(conn, model, model_id, pending, timer, batch_size=enrich.ENRICH_BATCH_SIZE, conf=enrich.ENRICH_CONF,
+                root=enrich.RAW_DATA_PATH):
+    processed, failed = enrich_messages(conn, model, model_id, pending, timer, batch_size, conf, root)
+    logging.info(f'Micro-batch of {sum(len(ids) for ids in pending.values())} messages: '
+                 f'{processed} images inferred')
+    if failed:
+        raise RuntimeError(f"Enrichment failed for {', '.join(sorted(failed))}")
+
+def refresh(timer):
+    with timer.stage('dbt'):
+        refresh_marts()
+
+def run(run_id=None, batch_size=enrich.ENRICH_BATCH_SIZE, conf=enrich.ENRICH_CONF, root=enrich.RAW_DATA_PATH,
+        refresh_seconds=STREAM_REFRESH_SECONDS):
+    # Listens until interrupted or the listening connection is lost. Each
+    # micro-batch and refresh is recorded under the run id with a numbered
+    # scope (micro-batch/1, refresh/1, ...).
+    run_id = run_id or runs.new_run_id()
+    model, model_id = enrich.load_model()
+    listener = enrich.get_connection()
+    conn = enrich.get_connection()
+    try:
+        listen(listener)
+        logging.info(f'Listening on {notify.STREAM_CHANNEL} (run {run_id})')
+        process(run_id, 'catch-up', lambda timer: catch_up(conn, model, model_id, timer, batch_size, conf, root))
+        stale = True
+        refreshed = None
+        batches = refreshes = 0
+        while True:
+            pending = collect(listener)
+            if pending:
+                if conn.closed:
+                    conn = enrich.get_connection()
+                batches += 1
+                process(run_id, f'micro-batch/{batches}',
+                        lambda timer: micro_batch(conn, model, model_id, pending, timer, batch_size, conf, root))
+                stale = True
+            # A failed refresh is retried after the next interval.
+            if stale and (refreshed is None or time.monotonic() - refreshed >= refresh_seconds):
+                refreshes += 1
+                stale = not process(run_id, f'refresh/{refreshes}', refresh)
+                refreshed = time.monotonic()
+    finally:
+        conn.close()
+        listener.close()
+
+def main(argv):
+    if argv:
+        raise SystemExit(f'Unexpected arguments: {" ".join(argv)}')
+    try:
+        run()
+    except KeyboardInterrupt:
+        logging.info('Stopped listening.')
+
+if __name__ == '__main__':
+    with profiling.profiled('enrich-stream'):
+        main(sys.argv[1:])
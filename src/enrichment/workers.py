@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import socket
+import logging
+import multiprocessing
+
+from src import profiling
+from src.loader import manifest, runs
+from src.enrichment import enrich
+
+# Sharded enrichment. The changed YYYY-MM-DD/<channel> partitions are queued
+# in raw.enrich_queue and ENRICH_WORKERS processes drain the queue, each with
+# its own model. A partition is claimed with FOR UPDATE SKIP LOCKED, so any
+# number of processes on any number of machines can share one backlog:
+#
+#   python -m src.enrichment.workers            # queue changed partitions, then work
+#   python -m src.enrichment.workers work       # only drain the queue (extra machines)
+#   python -m src.enrichment.workers enqueue    # only queue
+#
+# Workers load the pHash index per partition, so two workers can pick
+# different canonical images for near-duplicates they see at the same time;
+# both mappings reuse valid detections.
+#
+# Each process runs ENRICH_THREADS intra-op threads (by default the cores
+# divided among the workers) so N workers do not oversubscribe the machine.
+
+ENRICH_WORKERS = int(os.getenv('ENRICH_WORKERS', '1'))
+ENRICH_THREADS = int(os.getenv('ENRICH_THREADS', '0'))
+# A running claim older than this is assumed to belong to a dead worker and
+# can be claimed again.
+ENRICH_CLAIM_TIMEOUT = int(os.getenv('ENRICH_CLAIM_TIMEOUT', '3600'))
+# Failed partitions are retried until they have been attempted this often.
+ENRICH_MAX_ATTEMPTS = int(os.getenv('ENRICH_MAX_ATTEMPTS', '3'))
+
+CREATE_QUEUE_SQL = """
+CREATE TABLE IF NOT EXISTS raw.enrich_queue (
+    consumer TEXT NOT NULL,
+    partition_path TEXT NOT NULL,
+    mtime_ns BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    claimed_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    error TEXT,
+    PRIMARY KEY (consumer, partition_path)
+);
+CREATE INDEX IF NOT EXISTS enrich_queue_status_idx ON raw.enrich_queue (consumer, status);
+"""
+
+# Finished partitions go back to pending when they change again; a partition
+# that is being worked on is left alone and picked up by the next enqueue,
+# since its manifest entry keeps the mtime the worker saw.
+ENQUEUE_SQL = """
+INSERT INTO raw.enrich_queue (consumer, partition_path, mtime_ns)
+VALUES (%s, %s, %s)
+ON CONFLICT (consumer, partition_path) DO UPDATE
+SET mtime_ns = EXCLUDED.mtime_ns,
+    status = 'pending',
+    attempts = 0,
+    worker = NULL,
+    error = NULL
+WHERE raw.enrich_queue.status IN ('done', 'failed');
+"""
+
+CLAIM_SQL = """
+UPDATE raw.enrich_queue q
+SET status = 'running', worker = %s, claimed_at = now(), attempts = q.attempts + 1
+WHERE (q.consumer, q.partition_path) = (
+    SELECT consumer, partition_path
+    FROM raw.enrich_queue
+    WHERE consumer = %s
+      AND attempts < %s
+      AND (status IN ('pending', 'failed')
+           OR (status = 'running' AND claimed_at < now() - %s * interval '1 second'))
+    ORDER BY partition_path
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING q.partition_path;
+"""
+
+# Only the claiming worker may finish a claim; one that was reclaimed after
+# the timeout belongs to the new worker.
+FINISH_SQL = """
+UPDATE raw.enrich_queue
+SET status = %s, finished_at = now(), error = %s
+WHERE consumer = %s AND partition_path = %s AND worker = %s;
+"""
+
+QUEUE_EXISTS_SQL = """
+SELECT to_regclass('raw.enrich_queue');
+"""
+
+QUEUE_STATUS_SQL = """
+SELECT status, count(*) FROM raw.enrich_queue WHERE consumer = %s GROUP BY status
+"""
+
+
+def ensure_queue_table(cur):
+    cur.execute(CREATE_QUEUE_SQL)
+
+def threads_per_worker(workers, threads=ENRICH_THREADS):
+    return threads if threads > 0 else max(1, (os.cpu_count() or 1) // max(1, workers))
+
+def limit_threads(threads):
+    # Caps torch's and OpenCV's intra-op thread pools for this process. The
+    # OpenMP variables are also exported so spawned workers start with them.
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    import cv2
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+def ensure_tables(conn):
+    # Run before the workers start; they skip the DDL themselves. The queue
+    # is created last, so once it exists the DDL is skipped here too and a
+    # machine joining a running backlog does not lock the tables the other
+    # workers are writing.
+    with conn, conn.cursor() as cur:
+        cur.execute(QUEUE_EXISTS_SQL)
+        if cur.fetchone()[0] is None:
+            enrich.ensure_tables(cur)
+            ensure_queue_table(cur)
+
+def enqueue(conn, consumer, full_rescan=enrich.FULL_RESCAN, root=enrich.RAW_DATA_PATH):
+    # Queues the partitions that changed since they were last enriched.
+    # Returns the number of partitions queued.
+    with conn, conn.cursor() as cur:
+        partitions = manifest.changed_partitions(cur, consumer, enrich.iter_partitions(root), root, force=full_rescan)
+        for _, partition_path, mtime_ns in partitions:
+            cur.execute(ENQUEUE_SQL, (consumer, partition_path, mtime_ns))
+    return len(partitions)
+
+def claim(conn, consumer, worker):
+    with conn, conn.cursor() as cur:
+        cur.execute(CLAIM_SQL, (worker, consumer, ENRICH_MAX_ATTEMPTS, ENRICH_CLAIM_TIMEOUT))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def finish(conn, consumer, partition_path, worker, error=None):
+    with conn, conn.cursor() as cur:
+        cur.execute(FINISH_SQL, ('failed' if error else 'done', error, consumer, partition_path, worker))
+
+def queue_status(conn, consumer):
+    with conn, conn.cursor() as cur:
+        cur.execute(QUEUE_STATUS_SQL, (consumer,))
+        return dict(cur.fetchall())
+
+def work(worker, run_id, threads, full_rescan=enrich.FULL_RESCAN, batch_size=enrich.ENRICH_BATCH_SIZE,
+         conf=enrich.ENRICH_CONF, root=enrich.RAW_DATA_PATH):
+    # Claims partitions until the queue is empty. Each partition is enriched
+    # and recorded in raw.pipeline_runs like a Dagster partition run. Returns
+    # (partitions done, partitions failed, images inferred).
+    limit_threads(threads)
+    model, model_id = enrich.load_model()
+    consumer = enrich.manifest_consumer(model_id, conf)
+    conn = enrich.get_connection()
+    done = failed = processed = 0
+    try:
+        while True:
+            partition_path = claim(conn, consumer, worker)
+            if partition_path is None:
+                break
+            date, channel = partition_path.split('/')
+            try:
+                processed += enrich.enrich_partition(date, channel, full_rescan, batch_size, conf, run_id, root,
+                                                     ensure=False)
+            except Exception as e:
+                logging.error(f'{worker}: failed to enrich {partition_path}: {e}')
+                finish(conn, consumer, partition_path, worker, str(e))
+                failed += 1
+            else:
+                finish(conn, consumer, partition_path, worker)
+                done += 1
+    finally:
+        conn.close()
+    logging.info(f'{worker}: {done} partitions done, {failed} failed, {processed} images inferred')
+    return done, failed, processed
+
+def worker_name(index):
+    return f'{socket.gethostname()}:{os.getpid()}:{index}'
+
+def run_worker(index, run_id, threads, full_rescan, batch_size, conf, root):
+    work(worker_name(index), run_id, threads, full_rescan, batch_size, conf, root)
+
+def run_workers(workers=ENRICH_WORKERS, run_id=None, full_rescan=enrich.FULL_RESCAN,
+                batch_size=enrich.ENRICH_BATCH_SIZE, conf=enrich.ENRICH_CONF, root=enrich.RAW_DATA_PATH):
+    # Spawned rather than forked: torch and the decode pools do not survive a
+    # fork, and spawn starts each worker with the thread limits already in
+    # its environment.
+    run_id = run_id or runs.new_run_id()
+    threads = threads_per_worker(workers)
+    limit_threads(threads)
+    logging.info(f'Starting {workers} enrichment workers with {threads} threads each (run {run_id})')
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_worker, args=(index, run_id, threads, full_rescan, batch_size, conf, root))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+def main(command='run', workers=ENRICH_WORKERS, full_rescan=enrich.FULL_RESCAN):
+    run_id = runs.new_run_id()
+    started = time.perf_counter()
+    _, model_id = enrich.load_model()
+    consumer = enrich.manifest_consumer(model_id, enrich.ENRICH_CONF)
+    conn = enrich.get_connection()
+    try:
+        ensure_tables(conn)
+        if command in ('run', 'enqueue'):
+            queued = enqueue(conn, consumer, full_rescan)
+            logging.info(f'Queued {queued} changed partitions for {consumer}')
+        if command in ('run', 'work'):
+            exitcodes = run_workers(workers, run_id, full_rescan)
+            crashed = sum(1 for code in exitcodes if code != 0)
+            if crashed:
+                logging.error(f'{crashed} of {workers} enrichment workers exited abnormally')
+        elif command != 'enqueue':
+            raise SystemExit(f'Unknown command: {command}')
+        status = queue_status(conn, consumer)
+        logging.info(f'Queue after {time.perf_counter() - started:.2f}s: '
+                     + ', '.join(f'{key}={value}' for key, value in sorted(status.items())))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    with profiling.profiled('enrich-workers'):
+        main(*sys.argv[1:2])
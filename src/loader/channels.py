@@ -0,0 +1,37 @@
+from psycopg2.extras import execute_values
+
+# Channel registry. Channels found in the data lake are registered
+# automatically; setting active = false stops them from being loaded without
+# touching the data that is already in the warehouse.
+
+CREATE_CHANNELS_SQL = """
+CREATE TABLE IF NOT EXISTS raw.channels (
+    channel_name TEXT PRIMARY KEY,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+REGISTER_CHANNELS_SQL = """
+INSERT INTO raw.channels (channel_name) VALUES %s
+ON CONFLICT (channel_name) DO NOTHING
+"""
+
+ACTIVE_CHANNELS_SQL = """
+SELECT channel_name FROM raw.channels WHERE active ORDER BY channel_name
+"""
+
+def ensure_channels_table(cur):
+    cur.execute(CREATE_CHANNELS_SQL)
+
+def discover_channels(root):
+    # The lake is laid out as <root>/YYYY-MM-DD/<channel>/
+    return sorted({path.name for path in root.glob('*/*') if path.is_dir()})
+
+def register_channels(cur, channel_names):
+    if channel_names:
+        execute_values(cur, REGISTER_CHANNELS_SQL, [(name,) for name in channel_names])
+
+def active_channels(cur):
+    cur.execute(ACTIVE_CHANNELS_SQL)
+    return [row[0] for row in cur.fetchall()]
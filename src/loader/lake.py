@@ -0,0 +1,175 @@
+import os
+import sys
+import gzip
+import json
+import mmap
+import logging
+from pathlib import Path
+
+# Compact data lake format. Instead of one pretty-printed JSON file per
+# message, a YYYY-MM-DD/<channel> partition can hold all of its messages in a
+# single NDJSON file (one compact JSON object per line), gzip-compressed or
+# plain, next to an index of where each message starts:
+#
+#   messages.ndjson.gz | messages.ndjson   one message per line
+#   messages.idx                           {"<message_id>": [offset, length], ...}
+#
+# Offsets refer to the uncompressed stream. Plain files are read through mmap;
+# gzip files are streamed (appending writes a new gzip member, which readers
+# see as one continuous stream). Images stay as <message_id>.jpg files, and
+# per-message JSON files are still read for partitions that were never
+# compacted.
+#
+#   python -m src.loader.lake compact        # compact every partition
+
+# 'gzip' or 'none'
+LAKE_COMPRESSION = os.getenv('LAKE_COMPRESSION', 'gzip')
+# Keep the per-message JSON files after compacting them.
+LAKE_COMPACT_KEEP = os.getenv('LAKE_COMPACT_KEEP', '0') == '1'
+
+COMPACT_NAME = 'messages.ndjson'
+COMPACT_GZIP_NAME = 'messages.ndjson.gz'
+INDEX_NAME = 'messages.idx'
+COMPACT_NAMES = (COMPACT_GZIP_NAME, COMPACT_NAME)
+
+def is_compact(path):
+    return Path(path).name in COMPACT_NAMES
+
+def compact_file(partition_dir):
+    for name in COMPACT_NAMES:
+        path = Path(partition_dir) / name
+        if path.exists():
+            return path
+    return None
+
+def iter_lines(path):
+    # Yields (offset, line) with offsets into the uncompressed stream and
+    # without the trailing newline.
+    path = Path(path)
+    if path.stat().st_size == 0:
+        return
+    if path.name == COMPACT_GZIP_NAME:
+        offset = 0
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                yield offset, line.rstrip(b'\n')
+                offset += len(line)
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offset = 0
+        while offset < len(mm):
+            end = mm.find(b'\n', offset)
+            end = len(mm) if end == -1 else end
+            yield offset, mm[offset:end]
+            offset = end + 1
+
+def read_index(partition_dir):
+    path = Path(partition_dir) / INDEX_NAME
+    if not path.exists():
+        return {}
+    return {int(key): tuple(value) for key, value in json.loads(path.read_text()).items()}
+
+def write_index(partition_dir, index):
+    path = Path(partition_dir) / INDEX_NAME
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps({str(key): list(value) for key, value in sorted(index.items())}))
+    os.replace(tmp, path)
+
+def read_message(partition_dir, message_id):
+    # Random access through the index: a slice of the mmap for plain files, a
+    # forward seek in the decompressed stream for gzip files.
+    location = read_index(partition_dir).get(message_id)
+    path = compact_file(partition_dir)
+    if location is None or path is None:
+        return None
+    offset, length = location
+    if path.name == COMPACT_GZIP_NAME:
+        with gzip.open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return json.loads(mm[offset:offset + length])
+
+def encode_message(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+def uncompressed_size(path):
+    if path.name == COMPACT_GZIP_NAME:
+        with gzip.open(path, 'rb') as f:
+            return f.seek(0, os.SEEK_END)
+    return path.stat().st_size
+
+def append_messages(partition_dir, messages, compression=LAKE_COMPRESSION):
+    # messages: iterable of (message_id, encoded line). Appends to the
+    # partition's compact file (creating it if needed) and updates the index;
+    # a re-appended message id points at its newest copy.
+    partition_dir = Path(partition_dir)
+    partition_dir.mkdir(parents=True, exist_ok=True)
+    path = compact_file(partition_dir)
+    if path is None:
+        path = partition_dir / (COMPACT_GZIP_NAME if compression == 'gzip' else COMPACT_NAME)
+    index = read_index(partition_dir)
+    # The newest line always ends the stream, so the index gives its length
+    # without decompressing the file.
+    offset = max((o + length + 1 for o, length in index.values()), default=None)
+    if offset is None:
+        offset = uncompressed_size(path) if path.exists() else 0
+    lines = []
+    for message_id, line in messages:
+        index[int(message_id)] = (offset, len(line))
+        lines.append(line + b'\n')
+        offset += len(line) + 1
+    if not lines:
+        return 0
+    if path.name == COMPACT_GZIP_NAME:
+        with open(path, 'ab') as f, gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.writelines(lines)
+    else:
+        with open(path, 'ab') as f:
+            f.writelines(lines)
+    write_index(partition_dir, index)
+    return len(lines)
+
+def compact_partition(partition_dir, compression=LAKE_COMPRESSION, keep=LAKE_COMPACT_KEEP):
+    # Moves the partition's per-message JSON files into its compact file. The
+    # originals are only removed once the compact file and index are written.
+    partition_dir = Path(partition_dir)
+    paths = sorted(partition_dir.glob('*.json'))
+    # Kept files stay behind, so on later runs only new ones are appended.
+    indexed = read_index(partition_dir) if keep else {}
+    messages = []
+    for path in paths:
+        data = json.loads(path.read_bytes())
+        message_id = data.get('id') or data.get('message_id')
+        if message_id not in indexed:
+            messages.append((message_id, encode_message(data)))
+    count = append_messages(partition_dir, messages, compression)
+    if not keep:
+        for path in paths:
+            path.unlink()
+    return count
+
+def iter_partition_dirs(root):
+    for date_dir in sorted(Path(root).glob('*')):
+        if date_dir.is_dir():
+            for channel_dir in sorted(date_dir.iterdir()):
+                if channel_dir.is_dir():
+                    yield channel_dir
+
+def main(argv):
+    from src.loader.load_to_pg import RAW_DATA_PATH
+    command = argv[0] if argv else 'compact'
+    if command != 'compact':
+        raise SystemExit(f'Unknown command: {command}')
+    root = Path(argv[1]) if len(argv) > 1 else RAW_DATA_PATH
+    total = 0
+    for partition_dir in iter_partition_dirs(root):
+        count = compact_partition(partition_dir)
+        if count:
+            logging.info(f'Compacted {count} messages in {partition_dir.relative_to(root)}')
+        total += count
+    logging.info(f'Compacted {total} messages')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(sys.argv[1:])
@@ -1,11 +1,17 @@
 import os
-import json
+import io
+import time
 import psycopg2
-from psycopg2 import sql
 from dotenv import load_dotenv
 import logging
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
 
+from src import profiling
+from src.loader import channels, lake, manifest, notify, partitions, products, runs
+from src.loader.parse import create_pool, iter_parsed
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
@@ -18,84 +24,341 @@ DB_NAME = os.getenv('DB_NAME', 'kara')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 
+# 'bulk' streams rows through COPY into a staging table, 'row' keeps the
+# original one-INSERT-per-file behaviour.
+LOAD_MODE = os.getenv('LOAD_MODE', 'bulk')
+LOAD_BATCH_SIZE = int(os.getenv('LOAD_BATCH_SIZE', '5000'))
+# Parse stage: worker processes (0 parses in the writer process), files per
+# chunk handed to a worker, and how many chunks may be in flight at once.
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', str(os.cpu_count() or 1)))
+LOAD_PARSE_CHUNK = int(os.getenv('LOAD_PARSE_CHUNK', '500'))
+LOAD_QUEUE_DEPTH = int(os.getenv('LOAD_QUEUE_DEPTH', '4'))
+# Ignore the manifest and reprocess every partition.
+FULL_RESCAN = os.getenv('FULL_RESCAN', '0') == '1'
+
 RAW_DATA_PATH = Path(__file__).parent.parent / 'data' / 'raw' / 'telegram_messages'
-CHANNELS = ['lobelia4cosmetics', 'tikvahpharma']
+# Bumped from 'loader' when the per-channel raw tables were replaced by
+# raw.telegram_messages, so the first run reloads the whole lake into it.
+MANIFEST_CONSUMER = 'loader:telegram_messages'
+# Per-message JSON files and compact partition files (see src/loader/lake.py).
+LAKE_PATTERNS = ('*.json', *lake.COMPACT_NAMES)
 
 CREATE_SCHEMA_SQL = """
 CREATE SCHEMA IF NOT EXISTS raw;
 """
 
-CREATE_TABLE_SQL = """
-CREATE TABLE IF NOT EXISTS raw.{table_name} (
-    id SERIAL PRIMARY KEY,
+INSERT_SQL = """
+INSERT INTO raw.telegram_messages (channel_name, message_id, date, text, image_path, raw_json)
+VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT (channel_name, message_id, date) DO UPDATE
+SET text = EXCLUDED.text,
+    image_path = EXCLUDED.image_path,
+    raw_json = EXCLUDED.raw_json,
+    loaded_at = CURRENT_TIMESTAMP;
+"""
+
+# Session-local staging table; ON COMMIT DELETE ROWS empties it after every
+# batch so it never has to be truncated explicitly. seq preserves COPY order so
+# the newest copy of a message wins when a batch contains it twice.
+CREATE_STAGING_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS load_staging (
+    seq BIGSERIAL,
+    channel_name TEXT,
     message_id BIGINT,
     date TIMESTAMP,
     text TEXT,
     image_path TEXT,
     raw_json JSONB
-);
+) ON COMMIT DELETE ROWS;
 """
 
-INSERT_SQL = """
-INSERT INTO raw.{table_name} (message_id, date, text, image_path, raw_json)
-VALUES (%s, %s, %s, %s, %s)
-ON CONFLICT DO NOTHING;
+COPY_STAGING_SQL = """
+COPY load_staging (channel_name, message_id, date, text, image_path, raw_json) FROM STDIN
+"""
+
+# Months present in the batch, so their partitions exist before the merge.
+STAGING_MONTHS_SQL = """
+SELECT DISTINCT date_trunc('month', date)::date FROM load_staging
+"""
+
+MERGE_STAGING_SQL = """
+INSERT INTO raw.telegram_messages (channel_name, message_id, date, text, image_path, raw_json)
+SELECT DISTINCT ON (channel_name, message_id, date) channel_name, message_id, date, text, image_path, raw_json
+FROM load_staging
+ORDER BY channel_name, message_id, date, seq DESC
+ON CONFLICT (channel_name, message_id, date) DO UPDATE
+SET text = EXCLUDED.text,
+    image_path = EXCLUDED.image_path,
+    raw_json = EXCLUDED.raw_json,
+    loaded_at = CURRENT_TIMESTAMP;
 """
 
-def extract_fields(json_data):
-    message_id = json_data.get('message_id') or json_data.get('id')
-    date = json_data.get('date')
-    text = json_data.get('text')
-    image_path = json_data.get('image_path') or json_data.get('image')
-    return message_id, date, text, image_path
+def get_connection():
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
+def iter_partitions(channel):
+    for date_dir in sorted(RAW_DATA_PATH.glob('*')):
+        channel_dir = date_dir / channel
+        if channel_dir.is_dir():
+            yield channel_dir
+
+def parse_entries(entries, pool):
+    return iter_parsed(
+        entries,
+        pool=pool,
+        chunk_size=LOAD_PARSE_CHUNK,
+        queue_depth=LOAD_QUEUE_DEPTH,
+        on_error=lambda path, e: logging.error(f'Error processing {path}: {e}')
+    )
+
+def copy_escape(value):
+    # Text-format COPY: NULL is \N and backslash, tab, newline and carriage
+    # return have to be escaped.
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+def rows_to_copy_buffer(rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_escape(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
 
-def main():
+def dated_rows(channel, batch):
+    # Returns (message rows, product mention rows). raw.telegram_messages is
+    # partitioned by date, so messages without one cannot be stored. Like
+    # MERGE_STAGING_SQL, the newest copy of a message wins, so only its
+    # mentions are kept.
+    rows = []
+    mentions = {}
+    for row, entry, _ in batch:
+        if row is None:
+            continue
+        if row[1] is None:
+            logging.warning(f'Skipping {entry.path}: message has no date')
+            continue
+        *fields, found = row
+        rows.append((channel, *fields))
+        mentions[fields[0]] = products.mention_rows(channel, fields[0], fields[1], found)
+    return rows, [mention for message in mentions.values() for mention in message]
+
+def without_failed(batch, failed):
+    # A compact file carries its digest on its last row only. Once one of its
+    # rows failed to load, the digest is dropped from its later rows, so
+    # neither the file nor its partition is recorded until a run loads all of
+    # it. (iter_parsed does the same for slices that failed to parse.)
+    return [(row, entry, None if entry.path in failed else digest) for row, entry, digest in batch]
+
+def load_entries_rows(conn, channel, entries, existing, pool=None, timer=None):
+    timer = timer or runs.StageTimer()
+    cur = conn.cursor()
+    loaded = 0
+    seen = 0
+    failed = set()
+    for row, entry, digest in runs.timed(parse_entries(entries, pool), timer, 'parse'):
+        if entry.path in failed:
+            digest = None
+        try:
+            rows, mentions = dated_rows(channel, [(row, entry, digest)])
+            for dated in rows:
+                with timer.stage('insert'):
+                    partitions.ensure_partitions(cur, [partitions.month_start(dated[2])], existing)
+                    cur.execute(INSERT_SQL, dated)
+                    products.replace_message(cur, channel, dated[1], mentions)
+                    if notify.LOAD_NOTIFY:
+                        notify.notify_loaded(cur, entry.partition_path, [dated[1]])
+                loaded += 1
+                logging.info(f'Inserted {entry.path} into raw.telegram_messages')
+            manifest.record_files(cur, MANIFEST_CONSUMER, [(entry, digest)])
+            if digest is not None:
+                seen += 1
+        except Exception as e:
+            failed.add(entry.path)
+            logging.error(f'Error processing {entry.path}: {e}')
+    cur.close()
+    return loaded, len(entries) - seen
+
+def load_entries_bulk(conn, channel, entries, existing, batch_size=LOAD_BATCH_SIZE, pool=None, timer=None):
+    timer = timer or runs.StageTimer()
+    cur = conn.cursor()
+    parsed = runs.timed(parse_entries(entries, pool), timer, 'parse')
+    loaded = 0
+    seen = 0
+    batch_no = 0
+    failed = set()
+    while True:
+        batch = without_failed(islice(parsed, batch_size), failed)
+        if not batch:
+            break
+        batch_no += 1
+        rows, mentions = dated_rows(channel, batch)
+        attached = set(existing)
+        try:
+            with timer.stage('insert', len(rows)):
+                if rows:
+                    cur.copy_expert(COPY_STAGING_SQL, rows_to_copy_buffer(rows))
+                    cur.execute(STAGING_MONTHS_SQL)
+                    partitions.ensure_partitions(cur, [row[0] for row in cur.fetchall()], attached)
+                    cur.execute(MERGE_STAGING_SQL)
+                    products.replace_staged(cur, mentions, rows_to_copy_buffer)
+                    if notify.LOAD_NOTIFY:
+                        # The entries all come from one partition.
+                        notify.notify_loaded(cur, batch[0][1].partition_path, [row[1] for row in rows])
+                manifest.record_files(cur, MANIFEST_CONSUMER, [(entry, digest) for _, entry, digest in batch])
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            failed.update(entry.path for _, entry, _ in batch)
+            logging.error(f'Error loading batch {batch_no} of {channel} into raw.telegram_messages: {e}')
+            continue
+        existing |= attached
+        seen += sum(1 for _, _, digest in batch if digest is not None)
+        loaded += len(rows)
+        logging.info(f'Batch {batch_no}: merged {len(rows)} {channel} rows into raw.telegram_messages')
+    cur.close()
+    # Files that failed to parse or had rows in a rolled-back batch are not in
+    # seen.
+    return loaded, len(entries) - seen
+
+def prepare(conn, mode=LOAD_MODE):
+    # Creates the raw tables and returns (active channels, attached months).
+    # Concurrent loaders (e.g. parallel Dagster runs) serialize on the DDL lock.
+    cur = conn.cursor()
+    with partitions.ddl_lock(cur):
+        cur.execute(CREATE_SCHEMA_SQL)
+        manifest.ensure_manifest_tables(cur)
+        partitions.ensure_messages_table(cur)
+        products.ensure_mentions_table(cur)
+        channels.ensure_channels_table(cur)
+        channels.register_channels(cur, channels.discover_channels(RAW_DATA_PATH))
+        conn.commit()
+    active = channels.active_channels(cur)
+    existing = partitions.existing_partitions(cur)
+    logging.info(f'Ensured raw.telegram_messages exists, {len(active)} active channels')
+    if mode == 'bulk':
+        cur.execute(CREATE_STAGING_SQL)
+    conn.commit()
+    cur.close()
+    return active, existing
+
+def load_partitions(conn, channel, partition_dirs, existing, mode=LOAD_MODE, batch_size=LOAD_BATCH_SIZE,
+                    pool=None, full_rescan=FULL_RESCAN, root=RAW_DATA_PATH, timer=None):
+    # Loads the new or changed files of the given YYYY-MM-DD/<channel>
+    # directories under root. Returns (rows loaded, files that failed).
+    timer = timer or runs.StageTimer()
+    cur = conn.cursor()
+    with timer.stage('discover'):
+        changed = manifest.changed_partitions(cur, MANIFEST_CONSUMER, partition_dirs, root, force=full_rescan)
+    logging.info(f'{len(changed)} new or changed partitions for {channel}')
+    total_rows = 0
+    total_failed = 0
+    for partition_dir, partition_path, mtime_ns in changed:
+        with timer.stage('discover'):
+            entries = manifest.changed_files(
+                cur, MANIFEST_CONSUMER, partition_dir, LAKE_PATTERNS, root, force=full_rescan
+            )
+        if mode == 'bulk':
+            loaded, failed = load_entries_bulk(conn, channel, entries, existing, batch_size, pool, timer)
+        else:
+            loaded, failed = load_entries_rows(conn, channel, entries, existing, pool, timer)
+        total_rows += loaded
+        total_failed += failed
+        timer.incr('partitions')
+        timer.incr('files', len(entries))
+        timer.incr('rows', loaded)
+        timer.incr('files_failed', failed)
+        # A partition with failures is left unmarked so the next run
+        # retries its remaining files.
+        if not failed:
+            manifest.record_partition(cur, MANIFEST_CONSUMER, partition_path, mtime_ns)
+        if mode == 'bulk':
+            conn.commit()
+        logging.info(f'{partition_path}: {len(entries)} changed files, {loaded} rows loaded, {failed} failed')
+    cur.close()
+    return total_rows, total_failed
+
+def load_partition(date, channel, mode=LOAD_MODE, batch_size=LOAD_BATCH_SIZE, full_rescan=FULL_RESCAN, workers=0,
+                   run_id=None):
+    # Loads a single YYYY-MM-DD/<channel> partition in-process (used by the
+    # Dagster assets). Unlike main(), errors are raised. Returns rows loaded.
+    partition_dir = RAW_DATA_PATH / date / channel
+    if not partition_dir.is_dir():
+        logging.info(f'No data for {date}/{channel}')
+        return 0
+    timer = runs.StageTimer()
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    status = 'failed'
+    pool = create_pool(workers)
+    conn = get_connection()
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
+        conn.autocommit = mode != 'bulk'
+        _, existing = prepare(conn, mode)
+        loaded, failed = load_partitions(
+            conn, channel, [partition_dir], existing, mode, batch_size, pool, full_rescan, timer=timer
         )
-        conn.autocommit = True
-        cur = conn.cursor()
-        logging.info('Connected to PostgreSQL')
+        if failed:
+            raise RuntimeError(f'{failed} files in {date}/{channel} failed to load')
+        status = 'success'
+        return loaded
+    finally:
+        conn.close()
+        if pool is not None:
+            pool.shutdown()
+        runs.record_run(get_connection, run_id or runs.new_run_id(), 'loader', f'{date}/{channel}', status,
+                        started_at, time.perf_counter() - started, timer)
+
+def main(mode=LOAD_MODE, batch_size=LOAD_BATCH_SIZE, full_rescan=FULL_RESCAN, workers=LOAD_WORKERS):
+    run_id = runs.new_run_id()
+    timer = runs.StageTimer()
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    status = 'failed'
+    pool = create_pool(workers)
+    try:
+        conn = get_connection()
+        conn.autocommit = mode != 'bulk'
+        logging.info(f'Connected to PostgreSQL (run {run_id})')
+        with timer.stage('prepare'):
+            active, existing = prepare(conn, mode)
+
+        total_rows = 0
+        for channel in active:
+            loaded, _ = load_partitions(
+                conn, channel, iter_partitions(channel), existing, mode, batch_size, pool, full_rescan, timer=timer
+            )
+            total_rows += loaded
+
+        elapsed = time.perf_counter() - started
+        rate = total_rows / elapsed if elapsed > 0 else 0.0
+        logging.info(f'Loaded {total_rows} rows in {elapsed:.2f}s ({rate:.0f} rows/sec, mode={mode})')
+        logging.info(f'Stage timings: {timer.summary()}')
 
-        # Create schema
-        cur.execute(CREATE_SCHEMA_SQL)
-        logging.info('Ensured raw schema exists')
-
-        for channel in CHANNELS:
-            table_name = channel
-            # Create table for channel
-            cur.execute(sql.SQL(CREATE_TABLE_SQL).format(table_name=sql.Identifier(table_name)))
-            logging.info(f'Ensured table raw.{table_name} exists')
-
-            # Find all JSON files for this channel
-            for date_dir in RAW_DATA_PATH.glob('*'):
-                channel_dir = date_dir / channel
-                if not channel_dir.exists():
-                    continue
-                for json_file in channel_dir.glob('*.json'):
-                    try:
-                        with open(json_file, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                        message_id, date, text, image_path = extract_fields(data)
-                        # Insert row
-                        cur.execute(
-                            sql.SQL(INSERT_SQL).format(table_name=sql.Identifier(table_name)),
-                            (message_id, date, text, image_path, json.dumps(data))
-                        )
-                        logging.info(f'Inserted {json_file} into raw.{table_name}')
-                    except Exception as e:
-                        logging.error(f'Error processing {json_file}: {e}')
-
-        cur.close()
         conn.close()
+        status = 'success'
         logging.info('Done loading all data.')
     except Exception as e:
         logging.error(f'Failed to load data: {e}')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        runs.record_run(get_connection, run_id, 'loader', runs.ALL_PARTITIONS, status, started_at,
+                        time.perf_counter() - started, timer)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with profiling.profiled('loader'):
+        main()
@@ -0,0 +1,149 @@
+import os
+import hashlib
+from collections import namedtuple
+from pathlib import Path
+from psycopg2.extras import execute_values
+
+# File manifest shared by the loader and the enrichment job. Each consumer
+# records the partitions (YYYY-MM-DD/<channel> directories) and files it has
+# processed, so a run only has to look at what changed since the last one.
+
+CREATE_MANIFEST_SQL = """
+CREATE TABLE IF NOT EXISTS raw.partition_manifest (
+    consumer TEXT NOT NULL,
+    partition_path TEXT NOT NULL,
+    mtime_ns BIGINT NOT NULL,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (consumer, partition_path)
+);
+CREATE TABLE IF NOT EXISTS raw.file_manifest (
+    consumer TEXT NOT NULL,
+    path TEXT NOT NULL,
+    partition_path TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime_ns BIGINT NOT NULL,
+    content_hash TEXT NOT NULL,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (consumer, path)
+);
+CREATE INDEX IF NOT EXISTS file_manifest_partition_idx
+    ON raw.file_manifest (consumer, partition_path);
+"""
+
+SELECT_PARTITIONS_SQL = """
+SELECT partition_path, mtime_ns FROM raw.partition_manifest WHERE consumer = %s
+"""
+
+SELECT_FILES_SQL = """
+SELECT path, size, mtime_ns, content_hash
+FROM raw.file_manifest
+WHERE consumer = %s AND partition_path = %s
+"""
+
+SELECT_PATHS_SQL = """
+SELECT path, size, mtime_ns, content_hash
+FROM raw.file_manifest
+WHERE consumer = %s AND path = ANY(%s)
+"""
+
+UPSERT_PARTITION_SQL = """
+INSERT INTO raw.partition_manifest (consumer, partition_path, mtime_ns)
+VALUES (%s, %s, %s)
+ON CONFLICT (consumer, partition_path) DO UPDATE
+SET mtime_ns = EXCLUDED.mtime_ns, processed_at = CURRENT_TIMESTAMP;
+"""
+
+UPSERT_FILES_SQL = """
+INSERT INTO raw.file_manifest (consumer, path, partition_path, size, mtime_ns, content_hash)
+VALUES %s
+ON CONFLICT (consumer, path) DO UPDATE
+SET size = EXCLUDED.size,
+    mtime_ns = EXCLUDED.mtime_ns,
+    content_hash = EXCLUDED.content_hash,
+    processed_at = CURRENT_TIMESTAMP;
+"""
+
+FileEntry = namedtuple('FileEntry', ['path', 'rel_path', 'partition_path', 'size', 'mtime_ns', 'known_hash'])
+
+def ensure_manifest_tables(cur):
+    cur.execute(CREATE_MANIFEST_SQL)
+
+def relative_path(path, root):
+    return Path(path).relative_to(root).as_posix()
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def content_hasher():
+    return hashlib.sha256()
+
+def partition_mtime(partition_dir):
+    # A directory's mtime only changes when files are added, removed or
+    # renamed in it, not when a file is rewritten in place, so a partition's
+    # mtime is the newest of the directory's and its files'.
+    mtime_ns = os.stat(partition_dir).st_mtime_ns
+    with os.scandir(partition_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                mtime_ns = max(mtime_ns, entry.stat().st_mtime_ns)
+    return mtime_ns
+
+def changed_partitions(cur, consumer, partition_dirs, root, force=False):
+    cur.execute(SELECT_PARTITIONS_SQL, (consumer,))
+    seen = dict(cur.fetchall())
+    changed = []
+    for partition_dir in partition_dirs:
+        rel = relative_path(partition_dir, root)
+        mtime_ns = partition_mtime(partition_dir)
+        if force or seen.get(rel) != mtime_ns:
+            changed.append((partition_dir, rel, mtime_ns))
+    return changed
+
+def changed_files(cur, consumer, partition_dir, pattern, root, force=False):
+    # Only stat() is used here; callers hash the content they read anyway and
+    # compare it with known_hash to catch files that were touched but not
+    # actually modified. force returns every file with no known hash.
+    # pattern may be a tuple of glob patterns.
+    partition_path = relative_path(partition_dir, root)
+    cur.execute(SELECT_FILES_SQL, (consumer, partition_path))
+    seen = {row[0]: row[1:] for row in cur.fetchall()}
+    patterns = (pattern,) if isinstance(pattern, str) else pattern
+    changed = []
+    for path in sorted({path for p in patterns for path in partition_dir.glob(p)}):
+        rel = relative_path(path, root)
+        st = path.stat()
+        known = None if force else seen.get(rel)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            continue
+        changed.append(FileEntry(path, rel, partition_path, st.st_size, st.st_mtime_ns, known[2] if known else None))
+    return changed
+
+def changed_paths(cur, consumer, paths, root):
+    # Like changed_files for a list of files instead of a whole partition.
+    # Files that do not exist are skipped.
+    paths = [Path(path) for path in paths if Path(path).is_file()]
+    cur.execute(SELECT_PATHS_SQL, (consumer, [relative_path(path, root) for path in paths]))
+    seen = {row[0]: row[1:] for row in cur.fetchall()}
+    changed = []
+    for path in sorted(paths):
+        rel = relative_path(path, root)
+        st = path.stat()
+        known = seen.get(rel)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            continue
+        changed.append(FileEntry(path, rel, relative_path(path.parent, root), st.st_size, st.st_mtime_ns,
+                                 known[2] if known else None))
+    return changed
+
+def record_files(cur, consumer, entries):
+    # entries is an iterable of (FileEntry, content_hash) pairs; pairs without
+    # a hash (rows of a compact file before its last) are skipped.
+    values = [
+        (consumer, entry.rel_path, entry.partition_path, entry.size, entry.mtime_ns, digest)
+        for entry, digest in entries if digest is not None
+    ]
+    if values:
+        execute_values(cur, UPSERT_FILES_SQL, values)
+
+def record_partition(cur, consumer, partition_path, mtime_ns):
+    cur.execute(UPSERT_PARTITION_SQL, (consumer, partition_path, mtime_ns))
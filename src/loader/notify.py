@@ -0,0 +1,39 @@
+import os
+import json
+
+from dotenv import load_dotenv
+
+# Change notifications for the streaming enrichment worker (see
+# src/enrichment/stream.py). With LOAD_NOTIFY=1 the loader sends the ids of
+# the messages it merged on STREAM_CHANNEL, in the transaction that merged
+# them: Postgres delivers a notification only when its transaction commits,
+# so listeners never see rows that were rolled back. Each payload names one
+# YYYY-MM-DD/<channel> lake partition, so the worker finds the images next
+# to the messages without reading raw.telegram_messages.
+
+load_dotenv()
+
+LOAD_NOTIFY = os.getenv('LOAD_NOTIFY', '0') == '1'
+STREAM_CHANNEL = os.getenv('STREAM_CHANNEL', 'kara_new_messages')
+# Payloads are capped at 8000 bytes; 300 bigint ids and a partition path
+# stay well below.
+NOTIFY_IDS_PER_PAYLOAD = 300
+
+NOTIFY_SQL = """
+SELECT pg_notify(%s, %s)
+"""
+
+
+def payloads(partition_path, message_ids):
+    ids = sorted(set(message_ids))
+    for start in range(0, len(ids), NOTIFY_IDS_PER_PAYLOAD):
+        yield json.dumps({'partition': partition_path, 'ids': ids[start:start + NOTIFY_IDS_PER_PAYLOAD]})
+
+def notify_loaded(cur, partition_path, message_ids, channel=STREAM_CHANNEL):
+    for payload in payloads(partition_path, message_ids):
+        cur.execute(NOTIFY_SQL, (channel, payload))
+
+def parse_payload(payload):
+    # Returns (partition path, message ids).
+    data = json.loads(payload)
+    return data['partition'], [int(message_id) for message_id in data['ids']]
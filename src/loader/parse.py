@@ -0,0 +1,151 @@
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src.loader import lake, manifest, products
+
+# orjson parses the scraped files several times faster than the standard
+# library; it is optional and json is used when it is not installed.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+def extract_fields(json_data):
+    message_id = json_data.get('message_id') or json_data.get('id')
+    date = json_data.get('date')
+    text = json_data.get('text')
+    image_path = json_data.get('image_path') or json_data.get('image')
+    return message_id, date, text, image_path
+
+def parse_row(json_data, raw_json):
+    # The product mentions are extracted here so the matching runs in the
+    # parse workers. Telethon exports keep the post text under "message".
+    message_id, date, text, image_path = extract_fields(json_data)
+    mentions = products.extract_mentions(text or json_data.get('message'))
+    return message_id, date, text, image_path, raw_json, mentions
+
+def parse_entry(entry):
+    # Returns (row, digest). row is None when the content hash matches the
+    # manifest, i.e. the file was touched but not modified. raw_json is the
+    # file's own text: Postgres parses it into JSONB, so it is never
+    # re-serialized here. The row ends with the message's product mentions.
+    content = entry.path.read_bytes()
+    digest = manifest.content_hash(content)
+    if digest == entry.known_hash:
+        return None, digest
+    return parse_row(json_loads(content), content.decode('utf-8')), digest
+
+def compact_digest(path):
+    # Hashes a compact file line by line without holding it in memory.
+    hasher = manifest.content_hasher()
+    for _, line in lake.iter_lines(path):
+        hasher.update(line)
+    return hasher.hexdigest()
+
+def parse_chunk(entries):
+    # Parses a chunk of per-message JSON files. Results are (row, entry,
+    # digest).
+    results = []
+    errors = []
+    for entry in entries:
+        try:
+            row, digest = parse_entry(entry)
+            results.append((row, entry, digest))
+        except Exception as e:
+            errors.append((entry.path, str(e)))
+    return results, errors
+
+def parse_lines(entry, lines, digest):
+    # Parses a slice of a compact file's lines, one row per line. Only the
+    # last slice of a file carries its digest, on its last result, so
+    # callers record the file in the manifest once all of its rows are
+    # written. An unchanged file is a single slice without lines.
+    try:
+        rows = [parse_row(json_loads(line), line.decode('utf-8')) for line in lines]
+    except Exception as e:
+        return [], [(entry.path, str(e))]
+    results = [(row, entry, None) for row in rows[:-1]]
+    results.append((rows[-1] if rows else None, entry, digest))
+    return results, []
+
+def report_error(path, message):
+    return [], [(path, message)]
+
+def compact_tasks(entry, chunk_size):
+    # Yields parse_lines tasks for a compact file. The file is hashed in one
+    # pass first, so an unchanged file is never parsed, then read again as a
+    # stream and handed out chunk_size lines at a time. A slice is only
+    # yielded once the next line is read, so the last one is known.
+    try:
+        digest = compact_digest(entry.path)
+        if digest == entry.known_hash:
+            yield parse_lines, (entry, [], digest)
+            return
+        lines = []
+        for _, line in lake.iter_lines(entry.path):
+            if len(lines) >= chunk_size:
+                yield parse_lines, (entry, lines, None)
+                lines = []
+            lines.append(bytes(line))
+        yield parse_lines, (entry, lines, digest)
+    except Exception as e:
+        yield report_error, (entry.path, str(e))
+
+def iter_tasks(entries, chunk_size):
+    # Yields (function, args) in file order: chunks of up to chunk_size
+    # per-message files, and slices of up to chunk_size lines of each
+    # compact file. Every task returns (results, errors).
+    chunk = []
+    for entry in entries:
+        if not lake.is_compact(entry.path):
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                yield parse_chunk, (chunk,)
+                chunk = []
+            continue
+        if chunk:
+            yield parse_chunk, (chunk,)
+            chunk = []
+        yield from compact_tasks(entry, chunk_size)
+    if chunk:
+        yield parse_chunk, (chunk,)
+
+def iter_results(tasks, pool, queue_depth):
+    if pool is None:
+        for function, args in tasks:
+            yield function(*args)
+        return
+    pending = deque()
+    for function, args in tasks:
+        pending.append(pool.submit(function, *args))
+        if len(pending) >= queue_depth:
+            break
+    while pending:
+        result = pending.popleft().result()
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(pool.submit(task[0], *task[1]))
+        yield result
+
+def iter_parsed(entries, pool=None, chunk_size=500, queue_depth=4, on_error=None):
+    # Yields (row, entry, digest) in file order. With a pool, at most
+    # queue_depth tasks are parsed or waiting to be written at any time, and
+    # a task holds at most chunk_size files or compact file lines, so memory
+    # stays bounded by queue_depth * chunk_size messages regardless of the
+    # partition or compact file size. A compact file with a failed slice
+    # loses its digest, so it is not recorded as loaded.
+    failed = set()
+    for results, errors in iter_results(iter_tasks(entries, chunk_size), pool, queue_depth):
+        for path, message in errors:
+            failed.add(path)
+            if on_error:
+                on_error(path, message)
+        for row, entry, digest in results:
+            yield row, entry, None if entry.path in failed else digest
+
+def create_pool(workers):
+    if workers <= 0:
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
@@ -0,0 +1,166 @@
+import sys
+import logging
+from contextlib import contextmanager
+from datetime import date, datetime
+from psycopg2 import sql
+
+# raw.telegram_messages holds every channel's messages, range-partitioned by
+# message month. Partitions are created by the loader as data for a month
+# arrives; old months can be detached for retention (the detached table stays
+# in the raw schema and can be archived, dropped or attached again).
+#
+#   python -m src.loader.partitions list
+#   python -m src.loader.partitions detach-before 2024-01
+#   python -m src.loader.partitions attach 2023-12
+
+# The primary key of a partitioned table has to include the partition key, so
+# it is (channel_name, message_id, date) rather than (channel_name, message_id).
+CREATE_MESSAGES_SQL = """
+CREATE TABLE IF NOT EXISTS raw.telegram_messages (
+    channel_name TEXT NOT NULL,
+    message_id BIGINT NOT NULL,
+    date TIMESTAMP NOT NULL,
+    text TEXT,
+    image_path TEXT,
+    raw_json JSONB,
+    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (channel_name, message_id, date)
+) PARTITION BY RANGE (date);
+CREATE INDEX IF NOT EXISTS telegram_messages_date_idx ON raw.telegram_messages (date);
+"""
+
+LIST_PARTITIONS_SQL = """
+SELECT c.relname
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = 'raw.telegram_messages'::regclass
+ORDER BY c.relname
+"""
+
+# Month tables left in the raw schema by detach_partition.
+LIST_DETACHED_SQL = """
+SELECT c.relname
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = 'raw' AND c.relkind = 'r' AND c.relname ~ '^telegram_messages_[0-9]{4}_[0-9]{2}$'
+  AND NOT c.relispartition
+ORDER BY c.relname
+"""
+
+CREATE_PARTITION_SQL = """
+CREATE TABLE IF NOT EXISTS raw.{partition} PARTITION OF raw.telegram_messages
+FOR VALUES FROM ({start}) TO ({end})
+"""
+
+DETACH_PARTITION_SQL = """
+ALTER TABLE raw.telegram_messages DETACH PARTITION raw.{partition}
+"""
+
+ATTACH_PARTITION_SQL = """
+ALTER TABLE raw.telegram_messages ATTACH PARTITION raw.{partition}
+FOR VALUES FROM ({start}) TO ({end})
+"""
+
+PARTITION_PREFIX = 'telegram_messages_'
+
+# Session-level advisory lock serializing DDL on raw.telegram_messages between
+# concurrent loaders.
+DDL_LOCK_KEY = 'raw.telegram_messages'
+
+def ensure_messages_table(cur):
+    cur.execute(CREATE_MESSAGES_SQL)
+
+def month_start(value) -> date:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.replace(day=1)
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f'{PARTITION_PREFIX}{month:%Y_%m}'
+
+def partition_month(name: str) -> date:
+    return datetime.strptime(name[len(PARTITION_PREFIX):], '%Y_%m').date()
+
+def existing_partitions(cur):
+    cur.execute(LIST_PARTITIONS_SQL)
+    return {partition_month(row[0]) for row in cur.fetchall()}
+
+def detached_partitions(cur):
+    cur.execute(LIST_DETACHED_SQL)
+    return {partition_month(row[0]) for row in cur.fetchall()}
+
+def partition_statement(template, month: date):
+    return sql.SQL(template).format(
+        partition=sql.Identifier(partition_name(month)),
+        start=sql.Literal(month.isoformat()),
+        end=sql.Literal(next_month(month).isoformat())
+    )
+
+@contextmanager
+def ddl_lock(cur):
+    cur.execute('SELECT pg_advisory_lock(hashtext(%s))', (DDL_LOCK_KEY,))
+    try:
+        yield
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(hashtext(%s))', (DDL_LOCK_KEY,))
+
+def ensure_partitions(cur, months, existing):
+    # existing is the caller's set of attached months; it is updated in place
+    # so each partition is only created once per run.
+    missing = sorted(set(months) - existing)
+    if not missing:
+        return
+    with ddl_lock(cur):
+        # A detached month keeps its table, so CREATE TABLE IF NOT EXISTS
+        # would silently do nothing and the rows would have no partition.
+        detached = sorted(set(missing) & detached_partitions(cur))
+        if detached:
+            months = ', '.join(f'{month:%Y-%m}' for month in detached)
+            raise RuntimeError(f'Months {months} of raw.telegram_messages are detached; attach them first '
+                               f'(python -m src.loader.partitions attach YYYY-MM)')
+        for month in missing:
+            cur.execute(partition_statement(CREATE_PARTITION_SQL, month))
+            existing.add(month)
+            logging.info(f'Created partition raw.{partition_name(month)}')
+
+def detach_partition(cur, month: date):
+    cur.execute(partition_statement(DETACH_PARTITION_SQL, month))
+    logging.info(f'Detached partition raw.{partition_name(month)}')
+
+def attach_partition(cur, month: date):
+    cur.execute(partition_statement(ATTACH_PARTITION_SQL, month))
+    logging.info(f'Attached partition raw.{partition_name(month)}')
+
+def detach_before(cur, cutoff: date):
+    detached = sorted(month for month in existing_partitions(cur) if month < month_start(cutoff))
+    for month in detached:
+        detach_partition(cur, month)
+    return detached
+
+def main(argv):
+    from src.loader.load_to_pg import get_connection
+    command = argv[0] if argv else 'list'
+    conn = get_connection()
+    try:
+        with conn, conn.cursor() as cur:
+            if command == 'list':
+                for month in sorted(existing_partitions(cur)):
+                    print(partition_name(month))
+            elif command == 'detach-before':
+                detach_before(cur, month_start(argv[1] + '-01'))
+            elif command == 'detach':
+                detach_partition(cur, month_start(argv[1] + '-01'))
+            elif command == 'attach':
+                attach_partition(cur, month_start(argv[1] + '-01'))
+            else:
+                raise SystemExit(f'Unknown command: {command}')
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
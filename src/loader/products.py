@@ -0,0 +1,289 @@
+import os
+import re
+import sys
+import logging
+from collections import deque, namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+# Product and price extraction, run by the loader's parse workers. Product
+# names come from a dictionary (PRODUCT_DICTIONARY, see
+# product_dictionary.txt) compiled into one Aho-Corasick automaton, so a post
+# is scanned once however many products and aliases the dictionary holds.
+# Each whole-word match is a mention. Its strength and price are read from
+# the rest of the line up to the next product (the "✅<drug> <strength>
+# 💵<price>" price lists), or the price from the next line if it starts with
+# one (the "<product>\nPrice <n> birr" posts).
+#
+# Mentions are stored in raw.product_mentions, one row per mention, and
+# replaced whenever their message is reloaded. Messages loaded before the
+# table existed are extracted with:
+#
+#   python -m src.loader.products backfill
+
+load_dotenv()
+
+PRODUCT_DICTIONARY = Path(os.getenv('PRODUCT_DICTIONARY') or Path(__file__).parent / 'product_dictionary.txt')
+BACKFILL_FETCH_SIZE = 2000
+
+CREATE_MENTIONS_SQL = """
+CREATE TABLE IF NOT EXISTS raw.product_mentions (
+    channel_name TEXT NOT NULL,
+    message_id BIGINT NOT NULL,
+    message_date TIMESTAMP NOT NULL,
+    position INTEGER NOT NULL,
+    product TEXT NOT NULL,
+    matched_text TEXT NOT NULL,
+    strength TEXT,
+    price NUMERIC(12, 2),
+    currency TEXT,
+    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (channel_name, message_id, position)
+);
+CREATE INDEX IF NOT EXISTS product_mentions_loaded_idx ON raw.product_mentions (loaded_at);
+"""
+
+# Reloaded messages replace all of their mentions.
+DELETE_STAGED_SQL = """
+DELETE FROM raw.product_mentions p
+USING load_staging s
+WHERE p.channel_name = s.channel_name AND p.message_id = s.message_id
+"""
+
+DELETE_MESSAGE_SQL = """
+DELETE FROM raw.product_mentions WHERE channel_name = %s AND message_id = %s
+"""
+
+COPY_MENTIONS_SQL = """
+COPY raw.product_mentions (channel_name, message_id, message_date, position, product, matched_text, strength,
+                           price, currency) FROM STDIN
+"""
+
+INSERT_MENTIONS_SQL = """
+INSERT INTO raw.product_mentions (channel_name, message_id, message_date, position, product, matched_text,
+                                  strength, price, currency)
+VALUES %s
+"""
+
+# Telethon exports keep the post text under "message", as in fct_messages.
+BACKFILL_SQL = """
+SELECT channel_name, message_id, date, coalesce(text, raw_json->>'text', raw_json->>'message')
+FROM raw.telegram_messages
+"""
+
+SPACES_RE = re.compile(r'[ \t\xa0]+')
+
+Mention = namedtuple('Mention', ['position', 'product', 'matched_text', 'strength', 'price', 'currency'])
+
+NUMBER = r'\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?'
+CURRENCY = r'birr|br\b\.?|etb|ብር|usd|\$'
+# A price after a price marker (the unit is optional), or any amount
+# followed by a currency.
+MARKED_PRICE_RE = re.compile(rf'(?:💵|price\b|ዋጋ)\s*[:=\-]?\s*({NUMBER})\s*({CURRENCY})?')
+BARE_PRICE_RE = re.compile(rf'({NUMBER})\s*({CURRENCY})')
+# 500mg, 1.8kg, 50,000 iu, 120mg/5ml, 200mg 5ml is not a ratio.
+STRENGTH_RE = re.compile(
+    r'(?<![\w.])(\d+(?:[.,]\d+)*)\s*(mcg|µg|mg|gm|g|kg|ml|l|miu|iu|%)(?![a-z])'
+    r'(?:\s*/\s*(\d+(?:\.\d+)?)?\s*(ml|l|g|gm|tab)(?![a-z]))?'
+)
+
+
+class Matcher:
+    # Aho-Corasick automaton over lower-cased patterns. Node i has goto
+    # transitions, a failure link, the pattern ending at it (length, value)
+    # and a link to the nearest failure-chain node that ends a pattern.
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.dict_link = [0]
+        for pattern, value in patterns.items():
+            node = 0
+            for char in pattern:
+                node = self.goto[node].get(char) or self._new_node(node, char)
+            self.output[node] = (len(pattern), value)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail
+                self.dict_link[child] = fail if self.output[fail] else self.dict_link[fail]
+
+    def _new_node(self, parent, char):
+        self.goto.append({})
+        self.fail.append(0)
+        self.output.append(None)
+        self.dict_link.append(0)
+        self.goto[parent][char] = len(self.goto) - 1
+        return len(self.goto) - 1
+
+    def iter_matches(self, text):
+        # Yields (start, end, value) for every occurrence of every pattern.
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            found = node if self.output[node] else self.dict_link[node]
+            while found:
+                length, value = self.output[found]
+                yield i + 1 - length, i + 1, value
+                found = self.dict_link[found]
+
+    def find(self, text):
+        # Leftmost-longest whole-word matches that do not overlap. Words may
+        # be followed by digits ("Amoxicillin500mg").
+        matches = sorted(
+            (match for match in self.iter_matches(text)
+             if (match[0] == 0 or not text[match[0] - 1].isalnum())
+             and (match[1] == len(text) or not text[match[1]].isalpha())),
+            key=lambda match: (match[0], match[0] - match[1])
+        )
+        selected = []
+        end = 0
+        for match in matches:
+            if match[0] >= end:
+                selected.append(match)
+                end = match[1]
+        return selected
+
+
+def normalize(text):
+    # Lower-cased with runs of spaces collapsed; line breaks are kept since
+    # they bound strengths and prices.
+    return SPACES_RE.sub(' ', text.lower())
+
+def read_dictionary(path=PRODUCT_DICTIONARY):
+    # Returns {alias: canonical name}, including each canonical name itself.
+    patterns = {}
+    for line in Path(path).read_text(encoding='utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        canonical, _, aliases = line.partition('=')
+        canonical = normalize(canonical.strip())
+        patterns[canonical] = canonical
+        for alias in aliases.split(','):
+            if alias.strip():
+                patterns[normalize(alias.strip())] = canonical
+    return patterns
+
+@lru_cache(maxsize=None)
+def matcher(path=PRODUCT_DICTIONARY):
+    # Built once per process (each parse worker compiles its own).
+    return Matcher(read_dictionary(path))
+
+def parse_amount(value):
+    return float(value.replace(',', ''))
+
+def parse_currency(unit):
+    return 'USD' if unit in ('usd', '$') else 'ETB'
+
+def parse_strength(text):
+    match = STRENGTH_RE.search(text)
+    if match is None:
+        return None
+    amount, unit, per_amount, per_unit = match.groups()
+    unit = 'g' if unit == 'gm' else unit
+    strength = amount.replace(',', '') + unit
+    if per_unit:
+        strength += '/' + (per_amount or '') + ('g' if per_unit == 'gm' else per_unit)
+    return strength
+
+def parse_price(text):
+    # Returns (price, currency) or (None, None). Prices after a marker
+    # without a unit are in birr: every tracked channel is Ethiopian.
+    match = MARKED_PRICE_RE.search(text) or BARE_PRICE_RE.search(text)
+    if match is None:
+        return None, None
+    return parse_amount(match.group(1)), parse_currency(match.group(2))
+
+def line_end(text, start):
+    end = text.find('\n', start)
+    return len(text) if end == -1 else end
+
+def extract_mentions(text, path=PRODUCT_DICTIONARY):
+    if not text:
+        return []
+    text = normalize(text)
+    matches = matcher(path).find(text)
+    mentions = []
+    for position, (start, end, product) in enumerate(matches):
+        next_start = matches[position + 1][0] if position + 1 < len(matches) else len(text)
+        eol = line_end(text, end)
+        rest = text[end:min(next_start, eol)]
+        price, currency = parse_price(rest)
+        if price is None and next_start > eol:
+            # "<product>\nPrice <n> birr": only a line that starts with a
+            # price marker, so an unknown product's price is not taken.
+            next_line = text[eol + 1:min(next_start, line_end(text, eol + 1))].lstrip()
+            if MARKED_PRICE_RE.match(next_line):
+                price, currency = parse_price(next_line)
+        mentions.append(Mention(position, product, text[start:end], parse_strength(rest), price, currency))
+    return mentions
+
+def mention_rows(channel, message_id, date, mentions):
+    return [(channel, message_id, date, *mention) for mention in mentions]
+
+def ensure_mentions_table(cur):
+    cur.execute(CREATE_MENTIONS_SQL)
+
+def replace_staged(cur, rows, to_copy_buffer):
+    # Bulk mode: the batch's messages are in load_staging.
+    cur.execute(DELETE_STAGED_SQL)
+    if rows:
+        cur.copy_expert(COPY_MENTIONS_SQL, to_copy_buffer(rows))
+
+def replace_message(cur, channel, message_id, rows):
+    cur.execute(DELETE_MESSAGE_SQL, (channel, message_id))
+    if rows:
+        execute_values(cur, INSERT_MENTIONS_SQL, rows)
+
+def backfill(conn):
+    # Re-extracts the mentions of every loaded message. Returns the number of
+    # mentions written.
+    written = 0
+    with conn.cursor() as cur:
+        ensure_mentions_table(cur)
+    conn.commit()
+    read = conn.cursor(name='backfill_product_mentions')
+    read.itersize = BACKFILL_FETCH_SIZE
+    read.execute(BACKFILL_SQL)
+    with conn.cursor() as cur:
+        while True:
+            batch = read.fetchmany(BACKFILL_FETCH_SIZE)
+            if not batch:
+                break
+            rows = []
+            for channel, message_id, date, text in batch:
+                cur.execute(DELETE_MESSAGE_SQL, (channel, message_id))
+                rows += mention_rows(channel, message_id, date, extract_mentions(text))
+            if rows:
+                execute_values(cur, INSERT_MENTIONS_SQL, rows, page_size=1000)
+            written += len(rows)
+    read.close()
+    conn.commit()
+    return written
+
+def main(argv):
+    from src.loader.load_to_pg import get_connection
+    command = argv[0] if argv else 'backfill'
+    if command != 'backfill':
+        raise SystemExit(f'Unknown command: {command}')
+    conn = get_connection()
+    try:
+        logging.info(f'Wrote {backfill(conn)} product mentions')
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+import os
+import time
+import uuid
+import json
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+# Per-run stage timings and counters for the loader and the enrichment job,
+# stored in raw.pipeline_runs. A row is keyed by (run_id, job, scope): the
+# run id comes from PIPELINE_RUN_ID (so a nightly script can give the loader
+# and enrichment one id) or the Dagster run, and scope is the
+# YYYY-MM-DD/<channel> partition for per-partition runs or '*' for a full one.
+#
+#   SELECT job, scope, elapsed_seconds, stages, counters
+#   FROM raw.pipeline_runs WHERE run_id = '...';
+
+PIPELINE_RUN_ID = os.getenv('PIPELINE_RUN_ID')
+
+ALL_PARTITIONS = '*'
+
+CREATE_RUNS_SQL = """
+CREATE SCHEMA IF NOT EXISTS raw;
+CREATE TABLE IF NOT EXISTS raw.pipeline_runs (
+    run_id TEXT NOT NULL,
+    job TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL,
+    elapsed_seconds FLOAT NOT NULL,
+    stages JSONB NOT NULL,
+    counters JSONB NOT NULL,
+    PRIMARY KEY (run_id, job, scope)
+);
+CREATE INDEX IF NOT EXISTS pipeline_runs_started_idx ON raw.pipeline_runs (started_at);
+"""
+
+# A retried partition within the same run replaces its earlier row.
+UPSERT_RUN_SQL = """
+INSERT INTO raw.pipeline_runs (run_id, job, scope, status, started_at, finished_at, elapsed_seconds, stages, counters)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (run_id, job, scope) DO UPDATE
+SET status = EXCLUDED.status,
+    started_at = EXCLUDED.started_at,
+    finished_at = EXCLUDED.finished_at,
+    elapsed_seconds = EXCLUDED.elapsed_seconds,
+    stages = EXCLUDED.stages,
+    counters = EXCLUDED.counters;
+"""
+
+
+class StageTimer:
+    # Wall-clock seconds and item counts per stage, plus free-form counters.
+    # Stages may be timed from several threads at once (the decode pool), so
+    # their totals can add up to more than the elapsed time.
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.counters = {}
+        self._lock = Lock()
+
+    def add(self, stage, seconds, count=1):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + count
+
+    @contextmanager
+    def stage(self, name, count=1):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, count)
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def stages(self):
+        with self._lock:
+            return {stage: {'seconds': round(seconds, 6), 'count': self.counts[stage]}
+                    for stage, seconds in self.totals.items()}
+
+    def summary(self):
+        return ', '.join(f'{stage}={seconds:.2f}s' for stage, seconds in self.totals.items())
+
+
+def timed(items, timer, stage):
+    # Yields from items, adding the time spent producing each one to stage.
+    items = iter(items)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            timer.add(stage, time.perf_counter() - started, 0)
+            return
+        timer.add(stage, time.perf_counter() - started)
+        yield item
+
+def new_run_id():
+    return PIPELINE_RUN_ID or uuid.uuid4().hex
+
+def ensure_runs_table(cur):
+    cur.execute(CREATE_RUNS_SQL)
+
+def record_run(connect, run_id, job, scope, status, started_at, elapsed, timer):
+    # Uses its own connection, so a run is recorded even when the job's
+    # connection is broken; failing to record never fails the job.
+    try:
+        conn = connect()
+        try:
+            with conn, conn.cursor() as cur:
+                # CREATE INDEX IF NOT EXISTS still takes a share lock, which
+                # deadlocks with a concurrent recorder's insert; parallel
+                # workers record one at a time.
+                cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', ('raw.pipeline_runs',))
+                ensure_runs_table(cur)
+                cur.execute(UPSERT_RUN_SQL, (
+                    run_id, job, scope, status, started_at, datetime.utcnow(), elapsed,
+                    json.dumps(timer.stages()), json.dumps(timer.counters),
+                ))
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.warning(f'Could not record {job} run {run_id}: {e}')
@@ -1,36 +1,153 @@
-from dagster import op, Definitions, job
-import subprocess
+import os
+import asyncio
+from pathlib import Path
+from dagster import (
+    AssetExecutionContext, AssetSelection, AutomationCondition, BackfillPolicy, Config,
+    DailyPartitionsDefinition, DataVersion, DataVersionsByPartition, Definitions,
+    DynamicPartitionsDefinition, MaterializeResult, MultiPartitionKey, MultiPartitionsDefinition,
+    ScheduleDefinition, SensorResult, asset, define_asset_job, job, observable_source_asset, op, sensor,
+)
+from dotenv import load_dotenv
 
-@op
-def scrape_telegram_data():
-    subprocess.run(["python", "src/scraper/scrape.py"], check=True)
+from src.loader import channels, lake, load_to_pg, manifest
+from src.enrichment import enrich
+from src.scraper import scrape
 
-@op
-def load_raw_to_postgres():
-    subprocess.run(["python", "src/loader/load_to_pg.py"], check=True)
+load_dotenv()
+
+# The pipeline as software-defined assets, partitioned by day and channel.
+# Loading and enrichment run in-process, one YYYY-MM-DD/<channel> lake
+# partition at a time; enrichment only depends on the lake (it reads the
+# images), so it runs in parallel with loading and dbt. Assets are
+# materialized by automation when the lake partition they read changes, so
+# only stale partitions are reprocessed.
+
+PIPELINE_START_DATE = os.getenv('PIPELINE_START_DATE', '2025-07-01')
+# Partitions handled by each run of a backfill. How many runs execute at once
+# is capped by the run queue (DAGSTER_MAX_CONCURRENT_RUNS, see dagster.yaml).
+PIPELINE_PARTITIONS_PER_RUN = int(os.getenv('PIPELINE_PARTITIONS_PER_RUN', '1'))
+# Steps executing at once inside a single run.
+PIPELINE_MAX_CONCURRENT_STEPS = int(os.getenv('PIPELINE_MAX_CONCURRENT_STEPS', '4'))
+PIPELINE_OBSERVE_MINUTES = float(os.getenv('PIPELINE_OBSERVE_MINUTES', '15'))
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+
+channel_partitions = DynamicPartitionsDefinition(name='channels')
+daily_channel_partitions = MultiPartitionsDefinition({
+    'date': DailyPartitionsDefinition(start_date=PIPELINE_START_DATE),
+    'channel': channel_partitions,
+})
+backfill_policy = BackfillPolicy.multi_run(max_partitions_per_run=PIPELINE_PARTITIONS_PER_RUN)
+
+
+class PartitionConfig(Config):
+    # Ignore the manifests and reprocess every file of the partition.
+    full_rescan: bool = False
+
+
+def partition_keys(context):
+    for key in context.partition_keys:
+        dimensions = key.keys_by_dimension
+        yield dimensions['date'], dimensions['channel']
+
+def partition_version(partition_dir):
+    # The same mtime the loader's manifest compares, so a partition is stale
+    # exactly when the loader would reload it: adding or removing files
+    # changes the directory, rewriting one (or appending to a compact file
+    # and its index) changes the file.
+    return DataVersion(str(manifest.partition_mtime(partition_dir)))
 
-@op
-def run_dbt_transformations():
-    subprocess.run(["dotenv", "run", "--", "dbt", "run"], check=True)
-    subprocess.run(["dotenv", "run", "--", "dbt", "test"], check=True)
 
 @op
-def run_yolo_enrichment():
-    subprocess.run(["python", "src/enrichment/enrich.py"], check=True)
+def scrape_telegram_data():
+    asyncio.run(scrape.main())
 
 @job
-def kara_pipeline():
-    scrape = scrape_telegram_data()
-    load = load_raw_to_postgres()
-    dbt = run_dbt_transformations()
-    yolo = run_yolo_enrichment()
+def scrape_job():
+    scrape_telegram_data()
+
+
+@sensor(minimum_interval_seconds=300)
+def channel_partitions_sensor(context):
+    # Keeps the channel partitions in sync with the raw.channels registry and
+    # the channel directories in the lake.
+    conn = load_to_pg.get_connection()
+    try:
+        with conn, conn.cursor() as cur:
+            channels.ensure_channels_table(cur)
+            channels.register_channels(cur, channels.discover_channels(load_to_pg.RAW_DATA_PATH))
+            active = channels.active_channels(cur)
+    finally:
+        conn.close()
+    known = set(context.instance.get_dynamic_partitions(channel_partitions.name))
+    new = [name for name in active if name not in known]
+    return SensorResult(dynamic_partitions_requests=[channel_partitions.build_add_request(new)] if new else [])
+
+
+@observable_source_asset(partitions_def=daily_channel_partitions, auto_observe_interval_minutes=PIPELINE_OBSERVE_MINUTES)
+def telegram_lake(context):
+    registered = set(context.instance.get_dynamic_partitions(channel_partitions.name))
+    versions = {}
+    for partition_dir in lake.iter_partition_dirs(load_to_pg.RAW_DATA_PATH):
+        date, channel = partition_dir.parent.name, partition_dir.name
+        if channel in registered and date >= PIPELINE_START_DATE:
+            versions[MultiPartitionKey({'date': date, 'channel': channel})] = partition_version(partition_dir)
+    return DataVersionsByPartition(versions)
+
+
+@asset(
+    partitions_def=daily_channel_partitions,
+    deps=[telegram_lake],
+    backfill_policy=backfill_policy,
+    automation_condition=AutomationCondition.eager(),
+    group_name='raw',
+)
+def raw_telegram_messages(context: AssetExecutionContext, config: PartitionConfig):
+    rows = 0
+    for date, channel in partition_keys(context):
+        rows += load_to_pg.load_partition(date, channel, full_rescan=config.full_rescan, run_id=context.run_id)
+    return MaterializeResult(metadata={'rows_loaded': rows})
+
+@asset(
+    partitions_def=daily_channel_partitions,
+    deps=[telegram_lake],
+    backfill_policy=backfill_policy,
+    automation_condition=AutomationCondition.eager(),
+    group_name='raw',
+)
+def image_detections(context: AssetExecutionContext, config: PartitionConfig):
+    images = 0
+    for date, channel in partition_keys(context):
+        images += enrich.enrich_partition(date, channel, full_rescan=config.full_rescan, run_id=context.run_id)
+    return MaterializeResult(metadata={'images_inferred': images})
+
+@asset(
+    deps=[raw_telegram_messages],
+    automation_condition=AutomationCondition.eager(),
+    group_name='marts',
+)
+def dbt_marts(context: AssetExecutionContext):
+    # The marts are incremental, so one run after any number of loaded
+    # partitions only processes the new data.
+    from dbt.cli.main import dbtRunner
+    runner = dbtRunner()
+    for command in ('run', 'test'):
+        result = runner.invoke([command, '--project-dir', str(PROJECT_ROOT)])
+        if not result.success:
+            raise Exception(f'dbt {command} failed: {result.exception}')
+    return MaterializeResult()
 
-    load = load.alias("load_raw_to_postgres")(scrape)
-    dbt = dbt.alias("run_dbt_transformations")(load)
-    yolo = yolo.alias("run_yolo_enrichment")(dbt)
 
-# Register the job in Definitions
+partitions_job = define_asset_job(
+    'kara_partitions',
+    selection=AssetSelection.assets(raw_telegram_messages, image_detections),
+    partitions_def=daily_channel_partitions,
+    config={'execution': {'config': {'multiprocess': {'max_concurrent': PIPELINE_MAX_CONCURRENT_STEPS}}}},
+)
 
 defs = Definitions(
-    jobs=[kara_pipeline],
-)
\ No newline at end of file
+    assets=[telegram_lake, raw_telegram_messages, image_detections, dbt_marts],
+    jobs=[scrape_job, partitions_job],
+    schedules=[ScheduleDefinition(job=scrape_job, cron_schedule='0 2 * * *')],
+    sensors=[channel_partitions_sensor],
+)
@@ -0,0 +1,40 @@
+import os
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Sampling profiler for the entry points (loader, enrichment, scraper and the
+# API process). With PROFILE=1 the wrapped block runs under pyinstrument,
+# which samples the call stack every PROFILE_INTERVAL seconds, and an HTML
+# report is written to PROFILE_PATH when it finishes. Worker processes (the
+# loader's parse pool) are not sampled.
+
+PROFILE = os.getenv('PROFILE', '0') == '1'
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.001'))
+PROFILE_PATH = Path(os.getenv('PROFILE_PATH', Path(__file__).parent.parent / 'profiles'))
+
+
+@contextmanager
+def profiled(name, enabled=PROFILE):
+    if not enabled:
+        yield
+        return
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        logging.warning('PROFILE=1 needs pyinstrument (pip install pyinstrument); running without profiling')
+        yield
+        return
+    # Samples the calling thread whatever task is running on it, so the API's
+    # event loop is profiled across requests (threadpool work is not).
+    profiler = Profiler(interval=PROFILE_INTERVAL, async_mode='disabled')
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        PROFILE_PATH.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_PATH / f'{name}-{datetime.now():%Y%m%dT%H%M%S}.html'
+        path.write_text(profiler.output_html())
+        logging.info(f'Wrote {name} profile to {path}')
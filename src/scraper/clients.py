@@ -0,0 +1,91 @@
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+# Clients used by the scraper. Both expose the same small async interface:
+#
+#   await client.start()
+#   async for message in client.iter_messages(channel, min_id, limit): ...
+#   await client.download_media(message, path)
+#   await client.close()
+#
+# iter_messages yields the messages of a channel with id > min_id in ascending
+# id order; with a limit, only the newest `limit` of them. Messages expose
+# .id, .date, .photo and .to_dict() like Telethon's Message.
+
+
+class TelethonClient:
+    def __init__(self, session_name, api_id, api_hash):
+        self.session_name = session_name
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.client = None
+
+    async def start(self):
+        # Imported here so the scraper module (and the local client) work
+        # without telethon installed.
+        from telethon import TelegramClient
+        self.client = TelegramClient(self.session_name, int(self.api_id), self.api_hash)
+        await self.client.start()
+
+    async def iter_messages(self, channel, min_id=0, limit=None):
+        if limit:
+            # Telethon returns the newest messages first; reverse=True would
+            # return the oldest `limit` instead.
+            messages = [m async for m in self.client.iter_messages(channel, min_id=min_id, limit=limit)]
+            for message in reversed(messages):
+                yield message
+        else:
+            async for message in self.client.iter_messages(channel, min_id=min_id, reverse=True):
+                yield message
+
+    async def download_media(self, message, path):
+        await self.client.download_media(message, file=str(path))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.disconnect()
+
+
+class LocalMessage:
+    def __init__(self, data, image_path=None):
+        self.data = data
+        self.id = data['id']
+        self.date = datetime.fromisoformat(str(data['date']))
+        self.photo = image_path
+        self.image_path = image_path
+
+    def to_dict(self):
+        return self.data
+
+
+class LocalClient:
+    # Serves messages from a directory laid out like the data lake
+    # (<root>/YYYY-MM-DD/<channel>/<id>.json and <id>.jpg), for tests and
+    # local runs without Telegram credentials.
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    async def start(self):
+        pass
+
+    async def iter_messages(self, channel, min_id=0, limit=None):
+        messages = {}
+        for path in self.root.glob(f'*/{channel}/*.json'):
+            data = json.loads(path.read_text(encoding='utf-8'))
+            if data['id'] > min_id:
+                image = path.with_suffix('.jpg')
+                messages[data['id']] = LocalMessage(data, image if image.exists() else None)
+        ids = sorted(messages)
+        if limit:
+            ids = ids[-limit:]
+        for message_id in ids:
+            yield messages[message_id]
+
+    async def download_media(self, message, path):
+        shutil.copyfile(message.image_path, path)
+
+    async def close(self):
+        pass
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from pathlib import Path
+from dotenv import load_dotenv
+
+from src import profiling
+from src.loader import lake
+from src.scraper.clients import LocalClient, TelethonClient
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+load_dotenv()
+
+TELEGRAM_API_ID = os.getenv('TELEGRAM_API_ID')
+TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH')
+TELEGRAM_SESSION_NAME = os.getenv('TELEGRAM_SESSION_NAME', 'my_telegram_session')
+
+# Comma-separated channel names; when empty the active channels of the
+# raw.channels registry are scraped.
+SCRAPE_CHANNELS = [name.strip() for name in os.getenv('SCRAPE_CHANNELS', '').split(',') if name.strip()]
+# Channels scraped at once, and media downloads in flight across all of them.
+SCRAPE_CONCURRENCY = int(os.getenv('SCRAPE_CONCURRENCY', '4'))
+SCRAPE_MEDIA_CONCURRENCY = int(os.getenv('SCRAPE_MEDIA_CONCURRENCY', '8'))
+# Newest messages fetched for a channel without a watermark yet.
+SCRAPE_INITIAL_LIMIT = int(os.getenv('SCRAPE_INITIAL_LIMIT', '50'))
+# Messages written between watermark checkpoints.
+SCRAPE_CHECKPOINT_EVERY = int(os.getenv('SCRAPE_CHECKPOINT_EVERY', '100'))
+# 'json' writes one file per message, 'compact' appends to the partition's
+# compact NDJSON file (see src/loader/lake.py).
+SCRAPE_LAKE_FORMAT = os.getenv('SCRAPE_LAKE_FORMAT', 'json')
+# Read messages from a local lake-shaped directory instead of Telegram.
+SCRAPE_LOCAL_SOURCE = os.getenv('SCRAPE_LOCAL_SOURCE')
+
+RAW_DATA_PATH = Path(__file__).parent.parent / 'data' / 'raw' / 'telegram_messages'
+STATE_PATH = RAW_DATA_PATH.parent / 'scraper_state.json'
+
+
+class Watermarks:
+    # Highest message id written per channel. Saved with write-and-rename so
+    # an interrupted run never leaves a partial file; a channel is only
+    # advanced once its messages and media up to that id are on disk.
+
+    def __init__(self, path=STATE_PATH, data_path=RAW_DATA_PATH):
+        self.path = path
+        self.data_path = data_path
+        self.state = json.loads(path.read_text()) if path.exists() else {}
+
+    def get(self, channel):
+        if channel not in self.state:
+            # No state yet (first run, or the lake was scraped before
+            # watermarks existed): resume after the newest file on disk.
+            ids = [int(p.stem) for p in self.data_path.glob(f'*/{channel}/*.json') if p.stem.isdigit()]
+            for partition_dir in self.data_path.glob(f'*/{channel}'):
+                ids.extend(lake.read_index(partition_dir))
+            self.state[channel] = {'min_id': max(ids, default=0)}
+        return self.state[channel]['min_id']
+
+    def advance(self, channel, min_id):
+        self.state[channel] = {'min_id': min_id, 'updated_at': datetime.utcnow().isoformat()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+        os.replace(tmp, self.path)
+
+
+def write_json(path, data):
+    tmp = path.with_suffix('.json.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4, default=str)
+    os.replace(tmp, path)
+
+def message_dir(channel, message):
+    # Partitioned by the message's own date, not the scrape date.
+    return RAW_DATA_PATH / message.date.strftime('%Y-%m-%d') / channel
+
+async def download(client, message, path, media_semaphore):
+    async with media_semaphore:
+        try:
+            await client.download_media(message, path)
+            return True
+        except Exception as e:
+            logging.error(f'Could not download image for message {message.id} to {path}: {e}')
+            return False
+
+async def scrape_channel(client, channel, watermarks, media_semaphore, initial_limit=SCRAPE_INITIAL_LIMIT,
+                         checkpoint_every=SCRAPE_CHECKPOINT_EVERY, lake_format=SCRAPE_LAKE_FORMAT):
+    min_id = watermarks.get(channel)
+    limit = None if min_id else initial_limit
+    logging.info(f'Scraping {channel} after message {min_id}')
+    written = 0
+    images = 0
+    pending = []
+    compact = {}
+    last_id = min_id
+    failed_id = None
+
+    async def checkpoint():
+        nonlocal images, pending, compact, failed_id
+        # The watermark only moves once every download before it finished,
+        # and never past a failed download: it stops just before the first
+        # one, so the next run fetches that message and its image again.
+        results = await asyncio.gather(*(task for _, task in pending))
+        images += sum(results)
+        for (message_id, _), ok in zip(pending, results):
+            if not ok and (failed_id is None or message_id < failed_id):
+                failed_id = message_id
+        pending = []
+        for output_dir, messages in compact.items():
+            lake.append_messages(output_dir, messages)
+        compact = {}
+        watermark = last_id if failed_id is None else min(last_id, failed_id - 1)
+        if watermark > watermarks.get(channel):
+            watermarks.advance(channel, watermark)
+
+    async for message in client.iter_messages(channel, min_id=min_id, limit=limit):
+        output_dir = message_dir(channel, message)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if message.photo:
+            pending.append((message.id, asyncio.create_task(
+                download(client, message, output_dir / f'{message.id}.jpg', media_semaphore)
+            )))
+        if lake_format == 'compact':
+            compact.setdefault(output_dir, []).append((message.id, lake.encode_message(message.to_dict())))
+        else:
+            write_json(output_dir / f'{message.id}.json', message.to_dict())
+        written += 1
+        last_id = message.id
+        if written % checkpoint_every == 0:
+            await checkpoint()
+    await checkpoint()
+    if failed_id is not None:
+        logging.warning(f'{channel}: image download failed for message {failed_id}, will retry from there')
+    logging.info(f'Finished {channel}: {written} messages, {images} images, watermark {watermarks.get(channel)}')
+    return written
+
+async def scrape(client, channels, concurrency=SCRAPE_CONCURRENCY, media_concurrency=SCRAPE_MEDIA_CONCURRENCY,
+                 watermarks=None):
+    watermarks = watermarks or Watermarks()
+    channel_semaphore = asyncio.Semaphore(concurrency)
+    media_semaphore = asyncio.Semaphore(media_concurrency)
+
+    async def run(channel):
+        async with channel_semaphore:
+            try:
+                return await scrape_channel(client, channel, watermarks, media_semaphore)
+            except Exception as e:
+                # One failing channel keeps its watermark and is retried on
+                # the next run; the others carry on.
+                logging.error(f'Failed to scrape {channel}: {e}')
+                return 0
+
+    return sum(await asyncio.gather(*(run(channel) for channel in channels)))
+
+def registry_channels():
+    from src.loader import channels
+    from src.loader.load_to_pg import get_connection
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            channels.ensure_channels_table(cur)
+            return channels.active_channels(cur)
+    finally:
+        conn.close()
+
+def create_client():
+    if SCRAPE_LOCAL_SOURCE:
+        return LocalClient(SCRAPE_LOCAL_SOURCE)
+    if not all([TELEGRAM_API_ID, TELEGRAM_API_HASH]):
+        raise SystemExit('TELEGRAM_API_ID and TELEGRAM_API_HASH must be set (or SCRAPE_LOCAL_SOURCE).')
+    return TelethonClient(TELEGRAM_SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+
+async def main(channels=None):
+    channels = channels or SCRAPE_CHANNELS or registry_channels()
+    if not channels:
+        logging.warning('No channels to scrape: set SCRAPE_CHANNELS or add channels to raw.channels')
+        return
+    client = create_client()
+    await client.start()
+    started = time.perf_counter()
+    try:
+        total = await scrape(client, channels)
+    finally:
+        await client.close()
+    elapsed = time.perf_counter() - started
+    logging.info(f'Scraped {total} messages from {len(channels)} channels in {elapsed:.2f}s')
+
+if __name__ == '__main__':
+    with profiling.profiled('scraper'):
+        asyncio.run(main())